@@ -0,0 +1,145 @@
+import os
+import glob
+import json
+import hashlib
+import time
+import random
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+# Checkpoints are written in the background: the state dicts are first copied to the host (the live networks stay where they
+# are), then a single background thread writes them. Every file is written to a temporary file which is renamed once it is
+# complete, so a crash never leaves a truncated checkpoint behind. The manifest (manifest.json in save_dir) lists the checkpoints
+# and the latest file of every network, so the latest checkpoint is found without searching save_dir
+
+
+# Copies every tensor in the (nested) state to the host. The copies from the GPU are queued into pinned memory and waited for once
+def snapshot(state):
+    pending = []
+
+    def copy(value):
+        if isinstance(value, torch.Tensor):
+            if value.device.type == 'cuda':
+                host = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+                host.copy_(value.detach(), non_blocking=True)
+                pending.append(host)
+                return host
+            return value.detach().clone()
+        if isinstance(value, dict):
+            return type(value)((k, copy(v)) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return type(value)(copy(v) for v in value)
+        return value
+
+    state = copy(state)
+    if pending:
+        torch.cuda.synchronize()
+    return state
+
+
+def atomic_save(state, path):
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as checkpoint_file:
+        torch.save(state, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temporary_path, path)
+
+
+def manifest_path(save_dir):
+    return os.path.join(save_dir, 'manifest.json')
+
+
+def read_manifest(save_dir):
+    try:
+        with open(manifest_path(save_dir)) as manifest_file:
+            return json.load(manifest_file)
+    except (IOError, ValueError):
+        return {'latest': {}, 'checkpoints': []}
+
+
+# Finds the most recently saved checkpoint of network_name (e.g. 'Gener') in save_dir. Without a manifest (e.g. for older
+# experiments), the latest file that contains network_name in its name is used
+def latest_checkpoint(save_dir, network_name):
+    latest = read_manifest(save_dir)['latest'].get(network_name)
+    if latest is not None:
+        return os.path.join(save_dir, latest)
+    list_of_files = glob.glob(str(save_dir) + "/*")  # * means all if need specific format then *.csv
+    res = list(filter(lambda x: network_name in x and not x.endswith('.tmp'), list_of_files))
+    return max(res, key=os.path.getctime)
+
+
+# sha256 of the names, types, shapes and values of the tensors in a state dict (e.g. to tell whether two generators are the same)
+def state_dict_hash(state_dict):
+    digest = hashlib.sha256()
+    for name, tensor in sorted(state_dict.items()):
+        tensor = tensor.detach().cpu().contiguous()
+        digest.update(('%s %s %s' % (name, tensor.dtype, tuple(tensor.shape))).encode())
+        digest.update(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+# The states of all the random number generators, so that a resumed run continues with the same random numbers
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+# Seeds all the random number generators from their current state plus the offset, e.g. so that every process of a distributed run
+# draws different random numbers after restoring the state of the first process (the same state and offset give the same seed)
+def offset_rng_state(offset):
+    seed = int(torch.randint(2 ** 31, ()).item()) + offset
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)  # Also seeds the GPU's
+
+
+class CheckpointWriter:
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+        self.executor = ThreadPoolExecutor(max_workers=1)  # The checkpoints (and the manifest) are written in order
+        self.pending = None
+
+    # The state dicts of the networks (e.g. {'Gener': ...}) are written to '<label>_net_<name>.pth' and the training state
+    # (optimizers, progress and RNG states) to '<label>_training_state.pth'. Everything is snapshotted before this returns
+    def save(self, label, networks, training_state=None):
+        self.wait()  # At most one checkpoint is kept in host memory
+        files = [(name, '%s_net_%s.pth' % (label, name), snapshot(state)) for name, state in networks.items()]
+        if training_state is not None:
+            files.append(('training_state', '%s_training_state.pth' % label, snapshot(training_state)))
+        self.pending = self.executor.submit(self.write, label, files)
+
+    def write(self, label, files):
+        file_names = {}
+        for name, file_name, state in files:
+            atomic_save(state, os.path.join(self.save_dir, file_name))
+            file_names[name] = file_name
+
+        manifest = read_manifest(self.save_dir)
+        manifest['latest'].update(file_names)
+        manifest['checkpoints'].append({'label': label, 'time': time.time(), 'files': file_names})
+        temporary_path = manifest_path(self.save_dir) + '.tmp'
+        with open(temporary_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        os.replace(temporary_path, manifest_path(self.save_dir))  # The checkpoint only becomes the latest once all of its files are complete
+
+    # Waits until the previous checkpoint has been written (and re-raises its error, if any)
+    def wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
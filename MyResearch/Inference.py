@@ -0,0 +1,270 @@
+import time
+import queue
+import threading
+import torch
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from ManageData import illumination_map, normalize
+from Monitor import percentile
+import Networks
+
+# Inference-time utilities built around the (trained) generator
+
+
+# Loads the latest generator of the experiment for inference (without the discriminators and vgg of The_Model), with its batch
+# normalization folded into the convolutions
+def load_generator(opt):
+    checkpoint = Networks.latest_checkpoint(opt.save_dir, 'Gener')
+    generator = Networks.make_G(opt)
+    generator.load_state_dict(torch.load(checkpoint, map_location=opt.device))
+    generator = Networks.fold_batchnorm(generator.module.eval())
+    if opt.compile:
+        generator.compile(dynamic=False, mode=opt.compile_mode)
+    print('Loaded %s' % checkpoint)
+    return generator
+
+
+# Passes a batch of normalized images (Nx3xHxW, on the host or the device) with their illumination maps through the generator
+# (in mixed precision with --amp) and returns the enhanced images on the device
+def enhance(generator, images, opt):
+    with torch.no_grad(), Networks.amp_autocast(opt.device.type, opt.amp):
+        images = images.to(opt.device, non_blocking=True)
+        return generator(torch.cat([images, illumination_map(images)], 1))
+
+
+# Rough estimate of the memory needed to enhance a single tile. The largest activations that are alive at the same time are
+# the upsampled (and then reflection-padded) 2*ngf channels of the outermost U-net level, both at the full resolution of the tile
+def estimate_tile_bytes(tile_size, ngf=64):
+    return 4 * (2 * 2 * ngf + 8) * (tile_size + 2) ** 2
+
+
+# The start positions of the tiles along a side of the image (the last tile is aligned with the end of the image)
+def tile_starts(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, length - tile_size, stride))
+    return starts + [length - tile_size]
+
+
+# Weight of every pixel of a tile when the overlapping tiles are blended: it ramps up linearly over the overlap
+# (it never reaches 0, so that the borders of the image which are only covered by one tile keep their value)
+def blend_window(tile_size, overlap):
+    ramp = torch.ones(tile_size)
+    if overlap > 0:
+        edge = torch.arange(1, overlap + 1, dtype=torch.float32) / (overlap + 1)
+        ramp[:overlap] = edge
+        ramp[-overlap:] = torch.flip(edge, [0])
+    return (ramp.view(-1, 1) * ramp.view(1, -1)).view(1, 1, tile_size, tile_size)
+
+
+# Enhances images of arbitrary resolution by splitting them into overlapping tiles, which are passed through the generator in
+# batches (sized to fit into memory_mb) and then blended back together. Only the tiles of a single batch are ever on the
+# device, so the device memory does not depend on the size of the image (the blended result is accumulated on the host).
+# The generator should be in eval() mode (with instance normalization the tiles are normalized seperately, so the result
+# can differ slightly from enhancing the whole image at once). amp is the mixed precision mode of the tiles (see --amp)
+class TiledInference:
+    def __init__(self, generator, tile_size=512, overlap=64, memory_mb=2048, amp='none'):
+        self.generator = generator
+        self.amp = amp
+        self.tile_size = tile_size
+        self.overlap = min(overlap, tile_size // 2)
+        self.tile_batch = max(1, int(memory_mb * 1024 * 1024 // estimate_tile_bytes(tile_size)))
+        self.window = blend_window(tile_size, self.overlap)
+        self.device = next(generator.parameters()).device
+
+    # Expects a batch of normalized images (Nx3xHxW, on the host) and returns the enhanced images (also on the host)
+    def __call__(self, images):
+        return torch.stack([self.enhance(image) for image in images])
+
+    def enhance(self, image):
+        channels, height, width = image.shape
+        if height <= self.tile_size and width <= self.tile_size:  # Small enough to be enhanced in one go
+            return self.run(image.unsqueeze(0))[0]
+
+        # The tiles have to be the same size to be batched, smaller images are padded by the generator as usual
+        tile_h = min(self.tile_size, height)
+        tile_w = min(self.tile_size, width)
+        window = self.window[:, :, :tile_h, :tile_w]
+        output = torch.zeros(channels, height, width)
+        weights = torch.zeros(1, height, width)
+        positions = [(top, left) for top in tile_starts(height, tile_h, self.overlap) for left in tile_starts(width, tile_w, self.overlap)]
+
+        for i in range(0, len(positions), self.tile_batch):
+            batch_positions = positions[i:i + self.tile_batch]
+            tiles = torch.stack([image[:, top:top + tile_h, left:left + tile_w] for top, left in batch_positions])
+            enhanced = self.run(tiles) * window
+            for (top, left), tile in zip(batch_positions, enhanced):
+                output[:, top:top + tile_h, left:left + tile_w] += tile
+                weights[:, top:top + tile_h, left:left + tile_w] += window[0]
+        return output / weights
+
+    def run(self, tiles):
+        with torch.no_grad(), Networks.amp_autocast(self.device.type, self.amp):
+            tiles = tiles.to(self.device)
+            the_input = torch.cat([tiles, illumination_map(tiles)], 1)
+            return self.generator(the_input).float().cpu()
+
+
+# Collects the images submitted by concurrent clients (e.g. the requests of serve.py) into micro-batches, which are run by a
+# single background thread: a batch is run as soon as it holds batch_size images of the same size, or once its first image has
+# waited max_wait seconds. run(images) gets a batch (Nx3xHxW) and returns one result per image. submit() raises queue.Full when
+# max_queue images are already waiting (in the queue, or set aside for a later batch of their size). The wait and latency
+# (from submit() to the result) of the last `window` images are kept
+class MicroBatcher:
+    def __init__(self, run, batch_size=8, max_wait=0.005, max_queue=64, window=1000):
+        self.run = run
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.requests = queue.Queue()
+        self.pending = []  # Images of a different size than the current batch, they start the next batches
+        self.waiting = 0  # The images that were submitted but are not running yet (including the pending images)
+        self.lock = threading.Lock()
+        self.waits = deque(maxlen=window)
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.served = 0
+        self.batches = 0
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    # Returns a Future of the result of the image
+    def submit(self, image):
+        future = Future()
+        with self.lock:
+            if self.waiting >= self.max_queue:
+                raise queue.Full
+            self.waiting += 1
+        self.requests.put_nowait((image, future, time.perf_counter()))
+        return future
+
+    def next_batch(self):
+        first = self.pending.pop(0) if self.pending else self.requests.get()
+        if first is None:
+            return None
+        batch = [first] + [item for item in self.pending if item is not None and item[0].shape == first[0].shape][:self.batch_size - 1]
+        self.pending = [item for item in self.pending if not any(item is taken for taken in batch)]
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.pending.append(item)  # Stops after the images that are already waiting
+                break
+            if item[0].shape == first[0].shape:
+                batch.append(item)
+            else:
+                self.pending.append(item)
+        return batch
+
+    def loop(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            with self.lock:
+                self.waiting -= len(batch)
+            start = time.perf_counter()
+            try:
+                results = self.run(torch.stack([image for image, _, _ in batch]))
+            except Exception as error:  # Every client of the batch gets the error
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+            end = time.perf_counter()
+            with self.lock:
+                self.waits.extend(start - submitted for _, _, submitted in batch)
+                self.latencies.extend(end - submitted for _, _, submitted in batch)
+                self.batch_sizes.append(len(batch))
+                self.served += len(batch)
+                self.batches += 1
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self):
+        with self.lock:
+            waits = [1000 * wait for wait in self.waits] or [0.0]
+            latencies = [1000 * latency for latency in self.latencies] or [0.0]
+            batch_sizes = list(self.batch_sizes) or [0]
+            served, batches, waiting = self.served, self.batches, self.waiting
+        return OrderedDict([('queue_depth', waiting), ('served', served), ('batches', batches),
+                            ('mean_batch_size', sum(batch_sizes) / float(len(batch_sizes))),
+                            ('wait_ms_p50', percentile(waits, 50)), ('wait_ms_p99', percentile(waits, 99)),
+                            ('latency_ms_p50', percentile(latencies, 50)), ('latency_ms_p90', percentile(latencies, 90)), ('latency_ms_p99', percentile(latencies, 99))])
+
+    # Waits until the images that were already submitted have been run
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+
+# Enhances a stream of frames (uint8 tensors of shape 3xHxW, in order) and yields the enhanced frames in the same order, holding
+# at most batch_size frames at a time (the frames of the stream are only read when they are needed). The stream consists of
+# (key, frame) pairs and (key, enhanced frame, reused) triples are yielded, where the key is passed through (e.g. the file name).
+# enhance(images) gets a batch of normalized images (Nx3xHxW) and returns the enhanced images (on the host).
+# With reuse_threshold > 0, a frame is only passed through the generator (it becomes the keyframe) when it differs from the
+# previous keyframe by at least reuse_threshold (mean absolute difference, with the pixels in [0,1]). The other frames reuse the
+# enhancement of the keyframe: either its output ('output') or its residual, the difference between its output and its input,
+# which is added to the frame ('residual', this keeps the small changes, e.g. noise or slow motion). After max_reuse reused
+# frames in a row, the next frame is always a keyframe, so that the errors do not accumulate
+class TemporalReuse:
+    def __init__(self, enhance, batch_size=4, reuse_threshold=0.0, reuse='residual', max_reuse=30):
+        if reuse not in ('residual', 'output'):
+            raise ValueError('The reuse mode has to be residual or output, got %s' % reuse)
+        self.enhance = enhance
+        self.batch_size = batch_size
+        self.reuse_threshold = reuse_threshold
+        self.reuse = reuse
+        self.max_reuse = max_reuse
+        self.frames = 0
+        self.reused = 0
+
+    @property
+    def skip_ratio(self):
+        return self.reused / float(max(self.frames, 1))
+
+    # Compared on every 4th pixel, which is enough to tell a (nearly) static scene apart and much cheaper
+    def difference(self, frame, reference):
+        return (frame[:, ::4, ::4].float() - reference[:, ::4, ::4].float()).abs().mean().item() / 255.0
+
+    def __call__(self, stream):
+        reference, streak = None, 0  # The input of the latest keyframe and the number of frames that reused it
+        keyframe = None  # The (normalized) input and output of the latest keyframe that was enhanced
+        pending = []
+        for key, frame in stream:
+            is_keyframe = (reference is None or frame.shape != reference.shape or streak >= self.max_reuse
+                           or self.reuse_threshold <= 0 or self.difference(frame, reference) >= self.reuse_threshold)
+            if is_keyframe:
+                reference, streak = frame, 0
+            else:
+                streak += 1
+            pending.append((key, frame, is_keyframe))
+            if len(pending) == self.batch_size:
+                for result, keyframe in self.flush(pending, keyframe):
+                    yield result
+                pending = []
+        for result, keyframe in self.flush(pending, keyframe):
+            yield result
+
+    # Enhances the keyframes among the pending frames (as one batch when they have the same size) and yields the results in order
+    def flush(self, pending, keyframe):
+        inputs = [normalize(frame) for _, frame, is_keyframe in pending if is_keyframe]
+        if inputs and all(image.shape == inputs[0].shape for image in inputs):
+            outputs = list(self.enhance(torch.stack(inputs)))
+        else:
+            outputs = [self.enhance(image.unsqueeze(0))[0] for image in inputs]
+        outputs = iter(zip(inputs, outputs))
+        for key, frame, is_keyframe in pending:
+            self.frames += 1
+            if is_keyframe:
+                keyframe = next(outputs)
+                enhanced = keyframe[1]
+            else:
+                self.reused += 1
+                image, output = keyframe
+                enhanced = output if self.reuse == 'output' else (normalize(frame) + output - image).clamp(-1, 1)
+            yield (key, enhanced, not is_keyframe), keyframe
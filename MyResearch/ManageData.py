@@ -6,63 +6,355 @@ import PIL
 from PIL import Image
 import numpy as np
 import glob
+import io
+import json
+import time
+import queue
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # Create the dataloader (used for returning batches of the dataset in an efficient manner)
 def DataLoader(opt):
     data_loader = DataLoader(opt)
     return data_loader
 
-# Import the dataset
+# Stages the next batch while the model trains on the current one (double buffering): the batches of the DataLoader are moved to
+# the device and transformed (see prepare_batch) ahead of time. On the GPU, the copies (from pinned memory) and the transformations
+# are queued on a side stream, which the main stream only waits for when the batch is used. On the CPU, a background thread fetches
+# and transforms the batches. stall_time is the time the training loop spent waiting for a batch
+class Prefetcher:
+    def __init__(self, loader, device, augment=False, depth=2):
+        self.loader = loader
+        self.device = device
+        self.augment = augment
+        self.depth = depth  # The number of batches that are staged on the CPU
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        # The background thread draws the flips from its own generator (seeded from the global one, so that runs stay reproducible)
+        self.generator = torch.Generator().manual_seed(int(torch.randint(2 ** 62, (1,))))
+        self.stall_time = 0.0
+
+    def __iter__(self):
+        return self.stream_batches() if self.stream is not None else self.thread_batches()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def stage(self, batch):
+        if batch is None:
+            return None
+        with torch.cuda.stream(self.stream):
+            return prepare_batch(batch, self.device, self.augment, self.generator)
+
+    def stream_batches(self):
+        batches = iter(self.loader)
+        start = time.perf_counter()
+        next_batch = self.stage(next(batches, None))
+        while next_batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            batch = next_batch
+            for value in batch.values():
+                if torch.is_tensor(value) and value.is_cuda:
+                    value.record_stream(torch.cuda.current_stream(self.device))  # The memory was allocated on the side stream
+            next_batch = self.stage(next(batches, None))  # Queued behind the current batch, but before its training step
+            self.stall_time += time.perf_counter() - start
+            yield batch
+            start = time.perf_counter()
+
+    def thread_batches(self):
+        staged = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    staged.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def produce():
+            try:
+                for batch in self.loader:
+                    put(prepare_batch(batch, self.device, self.augment, self.generator))
+                    if stop.is_set():
+                        return
+            except Exception as error:  # Re-raised in the training loop
+                put(error)
+            put(None)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = staged.get()
+                self.stall_time += time.perf_counter() - start
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()  # E.g. when the loop stops early
+            thread.join()
+
+
+# Collect the paths of the images in a directory (sorted so that the order is the same on every run)
+def make_dataset(directory):
+    return sorted(glob.glob(directory + str("/*.png"))) or sorted(glob.glob(directory + str("/*.jpg")))  # This will only allow for .png anf .jpg to be imported
+
+
+def load_image(path):
+    return Image.open(path).convert('RGB')
+
+
+# Import the dataset (eagerly decodes every image, FullDataset now only keeps the paths and decodes in __getitem__)
 def import_dataset(directory):
     images = []
-    for filename in glob.glob(directory + str("/*.png")) or glob.glob(directory + str("/*.jpg")): # This will only allow for .png anf .jpg to be imported
-        im = Image.open(filename).convert('RGB')
-        images.append(im)
+    for filename in make_dataset(directory):
+        images.append(load_image(filename))
     return images
 
 
-def config_transforms(opt):
-    trans_list = []
-    # For data augmentation, we probilisitically flip the image horizontally or vertically with a probability of 0.5
-    # In addition, we normalize the image to [-1, 1]
-    if opt.phase == 'train':
-        trans_list += [transforms.Resize((512,512)),
-                       transforms.RandomHorizontalFlip(p=0.5),
-                       transforms.RandomVerticalFlip(p=0.5),
-                       transforms.ToTensor(),
-                       transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]  # Get the image to [-1,1]
-    else:
-        trans_list += [
-            transforms.Resize((512,512)),
-            transforms.ToTensor(),
-            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]  # Get the image to [-1,1]
+# LRU cache which is bounded by the number of bytes it holds (size_of gives the number of bytes of a value). on_evict is called
+# with the key and the value of every evicted entry. E.g. every DataLoader worker gets its own (initially empty) copy of the dataset
+# and therefore its own cache of decoded images
+class LRUCache:
+    def __init__(self, max_bytes, size_of, on_evict=None):
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.on_evict = on_evict
+        self.cur_bytes = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    # Returns False when the value is larger than the whole budget (it is then not cached)
+    def put(self, key, value):
+        num_bytes = self.size_of(value)
+        if num_bytes > self.max_bytes:
+            return False
+        if key in self.entries:
+            self.cur_bytes -= self.size_of(self.entries.pop(key))
+        self.entries[key] = value
+        self.cur_bytes += num_bytes
+        while self.cur_bytes > self.max_bytes:  # Evict the least recently used entries until we are within the budget
+            old_key, old_value = self.entries.popitem(last=False)
+            self.cur_bytes -= self.size_of(old_value)
+            self.evicted += 1
+            if self.on_evict is not None:
+                self.on_evict(old_key, old_value)
+        return True
+
+
+def image_bytes(img):
+    return img.width * img.height * len(img.getbands())
 
-    return transforms.Compose(trans_list)
 
-def gray_transform():
+# Whether the images are enhanced at their native resolution (either in tiles or in batches of images of the same size)
+# instead of being resized to crop_size
+def keeps_native_size(opt):
+    return opt.phase != 'train' and (opt.tile_size > 0 or opt.keep_size)
+
+
+# The workers only resize the images and deliver the raw pixels (uint8 tensors of shape 3xHxW, a quarter of the size of float images).
+# The flips, the normalization and the illumination map are computed for the whole batch on the device by prepare_batch
+# (size is the size the images are resized to, crop_size unless a lower resolution is trained, see --resolution_schedule)
+def config_transforms(opt, size=None):
     trans_list = []
-    trans_list += [transforms.ToPILImage(),
-                   transforms.Grayscale(num_output_channels =1),
-                   transforms.ToTensor()]
+    if not keeps_native_size(opt):
+        trans_list += [transforms.Resize((size or opt.crop_size, size or opt.crop_size))]
+    trans_list += [transforms.PILToTensor()]
     return transforms.Compose(trans_list)
 
 
+# Get uint8 images to [-1,1] (the same as ToTensor followed by Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)))
+def normalize(images):
+    return (images.float() / 255. - 0.5) / 0.5
+
+
+# For data augmentation, we probilisitically flip every image of the batch (Nx3xHxW) horizontally or vertically with a probability of 0.5.
+# The applied flips are returned as codes (bit 0 is set for a horizontal flip and bit 1 for a vertical flip), the coin flips are
+# drawn on the host so that the codes do not have to be read back from the device
+def random_flips(images, generator=None):
+    horizontal = torch.rand(images.size(0), generator=generator) < 0.5
+    vertical = torch.rand(images.size(0), generator=generator) < 0.5
+    flips = horizontal.long() + 2 * vertical.long()
+    horizontal, vertical = horizontal.to(images.device).view(-1, 1, 1, 1), vertical.to(images.device).view(-1, 1, 1, 1)
+    images = torch.where(horizontal, images.flip(3), images)
+    images = torch.where(vertical, images.flip(2), images)
+    return images, flips
+
+
+# Turns a collated batch of uint8 images into the inputs of the model: the images are moved to the device, flipped at random
+# (when augment is set, i.e. for training), normalized and the illumination map of A is computed, all in one pass over the batch
+def prepare_batch(batch, device, augment=False, generator=None):
+    batch = dict(batch)
+    A_img = batch['A'].to(device, non_blocking=True)
+    B_img = batch['B'].to(device, non_blocking=True) if 'B' in batch else A_img  # The test batches only hold A
+    flips = torch.zeros(A_img.size(0), dtype=torch.long)
+    if augment:
+        A_img, flips = random_flips(A_img, generator)
+        B_img, _ = random_flips(B_img, generator)
+    batch['A'] = normalize(A_img)
+    batch['B'] = batch['A'] if B_img is A_img else normalize(B_img)
+    batch['A_gray'] = illumination_map(batch['A'])
+    batch['flip'] = flips
+    return batch
+
+
+
+# Decodes and resizes every image in directory once and writes them into uint8 shards of shape Nx3xSxS
+# (with S = opt.crop_size) which are memory-mapped by ImageStore. The index is written last so that an
+# interrupted run does not leave behind a store that looks complete
+def build_store(opt, directory, store_dir):
+    paths = make_dataset(directory)
+    size = opt.crop_size
+    resize = transforms.Resize((size, size))
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    shards = []
+    for start in range(0, len(paths), opt.shard_size):
+        shard_paths = paths[start:start + opt.shard_size]
+        shard_name = 'shard_%04d.u8' % len(shards)
+        shard = np.memmap(os.path.join(store_dir, shard_name), dtype=np.uint8, mode='w+', shape=(len(shard_paths), 3, size, size))
+        for i, path in enumerate(shard_paths):
+            shard[i] = np.asarray(resize(load_image(path))).transpose(2, 0, 1)
+        shard.flush()
+        del shard
+        shards.append({'file': shard_name, 'count': len(shard_paths)})
+        print('Wrote %s (%d images)' % (os.path.join(store_dir, shard_name), len(shard_paths)))
+
+    index = {'size': size, 'count': len(paths), 'shard_size': opt.shard_size, 'shards': shards,
+             'names': [os.path.basename(path) for path in paths]}
+    with open(os.path.join(store_dir, 'index.json'), 'w') as index_file:
+        json.dump(index, index_file)
+    return index
+
+
+# Read-only view of the shards written by build_store. The shards are only opened on first access so that every
+# DataLoader worker maps them itself (pickling a np.memmap would copy the whole shard)
+class ImageStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'index.json')) as index_file:
+            self.index = json.load(index_file)
+        self.shard_size = self.index['shard_size']
+        self.names = self.index['names']
+        self.shards = None
+
+    def open_shards(self):
+        size = self.index['size']
+        # 'c' (copy-on-write) gives writable arrays so torch.from_numpy does not complain, nothing is ever written back
+        self.shards = [np.memmap(os.path.join(self.store_dir, shard['file']), dtype=np.uint8, mode='c', shape=(shard['count'], 3, size, size))
+                       for shard in self.index['shards']]
+
+    def __getitem__(self, index):
+        if self.shards is None:
+            self.open_shards()
+        return torch.from_numpy(self.shards[index // self.shard_size][index % self.shard_size])  # Zero-copy uint8 tensor of shape 3xSxS
+
+    def __len__(self):
+        return self.index['count']
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+
+def store_directory(opt, folder):
+    return os.path.join(opt.store_dir or os.path.join(opt.data_source, 'store'), folder)
+
+
+# Groups the indices of images with the same size into batches of at most batch_size images, so that every batch can be
+# collated (and passed through the generator) as a whole. The order of the images is kept within every bucket. The sizes
+# belong to the given indices (all the samples by default)
+class BucketBatchSampler(data.Sampler):
+    def __init__(self, sizes, batch_size, indices=None):
+        buckets = OrderedDict()
+        for index, size in zip(range(len(sizes)) if indices is None else indices, sizes):
+            buckets.setdefault(size, []).append(index)
+        self.batches = [bucket[i:i + batch_size] for bucket in buckets.values() for i in range(0, len(bucket), batch_size)]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
 
 class DataLoader:
     def __init__(self, opt):
         self.opt = opt
-        self.dataset = FullDataset(opt)  # Remember that self.dataset needs to have inherited from the built-in Dataset class to be used below... pin_memory apparently has to do with making it faster to load data to the gpu
-        if opt.phase == 'train':
-            self.dataloader = torch.utils.data.DataLoader(self.dataset, batch_size=opt.batch_size, shuffle=True, pin_memory=True, num_workers=6)
-        else:
-            self.dataloader = torch.utils.data.DataLoader(self.dataset, batch_size=opt.batch_size, shuffle=False, pin_memory=True, num_workers=1)
+        self.dataset = FullDataset(opt)  # Remember that self.dataset needs to have inherited from the built-in Dataset class to be used below... pin_memory apparently has to do with making it faster to load data to the gpu (so it is only used with the gpu)
+        # The workers need to persist across epochs, otherwise their image caches would be thrown away at the end of every epoch
+        self.persistent = opt.image_cache_mb > 0 and opt.num_workers > 0
+        self.indices = None  # For testing, only these samples are loaded (e.g. the ones that are not in the result cache, see set_indices)
+        self.sampler = None
+        if opt.phase == 'train' and opt.distributed:
+            # Every process trains on its own shard of the (shuffled) dataset
+            self.sampler = torch.utils.data.distributed.DistributedSampler(self.dataset, num_replicas=opt.world_size, rank=opt.rank, shuffle=True)
+        self.dataloader = self.make_dataloader()
+
+    def make_dataloader(self):
+        opt = self.opt
+        if opt.phase == 'train' and self.sampler is not None:
+            return torch.utils.data.DataLoader(self.dataset, batch_size=opt.batch_size, sampler=self.sampler, pin_memory=opt.device.type == 'cuda', num_workers=opt.num_workers, persistent_workers=self.persistent, drop_last=opt.compile)
+        elif opt.phase == 'train':
+            # With --compile, a smaller last batch would compile all the networks again
+            return torch.utils.data.DataLoader(self.dataset, batch_size=opt.batch_size, shuffle=True, pin_memory=opt.device.type == 'cuda', num_workers=opt.num_workers, persistent_workers=self.persistent, drop_last=opt.compile)
+        # Only images of the same size can be batched together, the sampler sorts them into buckets
+        batch_sampler = BucketBatchSampler(self.dataset.sample_sizes(self.indices), opt.batch_size, self.indices)
+        return torch.utils.data.DataLoader(self.dataset, batch_sampler=batch_sampler, pin_memory=opt.device.type == 'cuda', num_workers=opt.num_workers, persistent_workers=self.persistent)
+
+    # Changes the size of the images (see --resolution_schedule). The workers hold their own copy of the dataset, so persistent
+    # workers have to be restarted (the others get the new copy at the start of the next epoch anyway)
+    def set_size(self, size):
+        if size == self.dataset.size:
+            return
+        self.dataset.set_size(size)
+        if self.persistent:
+            self.dataloader = self.make_dataloader()
+
+    def set_indices(self, indices):
+        self.indices = list(indices)
+        self.dataloader = self.make_dataloader()
 
     def load(self):  # This will return the iterable over the dataset
         return self.dataloader
 
-    # This function is compulsory when creating custom dataloaders!
+    # The shards of the processes are reshuffled every epoch (the seed depends on the epoch)
+    def set_epoch(self, epoch):
+        if self.sampler is not None:
+            self.sampler.set_epoch(epoch)
+
+    # This function is compulsory when creating custom dataloaders! (the number of images seen by this process per epoch)
     def __len__(self):
-        return len(self.dataset)
+        num_images = len(self.sampler) if self.sampler is not None else len(self.dataset) if self.indices is None else len(self.indices)
+        if self.dataloader.drop_last:
+            num_images -= num_images % self.opt.batch_size
+        return num_images
 
 
 class FullDataset(data.Dataset):
@@ -73,39 +365,239 @@ class FullDataset(data.Dataset):
         A_directory = os.path.join(opt.data_source, opt.phase + 'A')
         B_directory = os.path.join(opt.data_source, opt.phase + 'B')
 
-        self.A_imgs = import_dataset(A_directory)
+        # Only the paths are kept here, the images are decoded in __getitem__ (i.e. inside the DataLoader workers)
+        # When use_store is set, the images are instead read from the shards written by preprocess.py
+        if opt.use_store:
+            self.A_source = ImageStore(store_directory(opt, opt.phase + 'A'))
+        else:
+            self.A_source = make_dataset(A_directory)
         if (opt.phase == 'train'):
-            self.B_imgs = import_dataset(B_directory)
+            self.B_source = ImageStore(store_directory(opt, opt.phase + 'B')) if opt.use_store else make_dataset(B_directory)
         else:
-            self.B_imgs = self.A_imgs  # We just need some image so that this portion
+            self.B_source = self.A_source  # We just need some image so that this portion
             # of the code can be reused for training and testing
-        self.A_size = len(self.A_imgs)
-        self.B_size = len(self.B_imgs)
+        for source in ([self.A_source, self.B_source] if opt.use_store else []):  # B is the same store as A for testing
+            if source.index['size'] != opt.crop_size:
+                raise ValueError('The store in %s holds %dx%d images but crop_size is %d, rerun preprocess.py' % (source.store_dir, source.index['size'], source.index['size'], opt.crop_size))
+        self.A_size = len(self.A_source)
+        self.B_size = len(self.B_source)
+        self.size = opt.crop_size
         self.transform = config_transforms(opt)
-        self.gray_transform = gray_transform()
-
-    def __getitem__(self, index):
-        A_img = self.A_imgs[index % self.A_size]  # To avoid going out of bounds
-        B_img = self.B_imgs[index % self.B_size]
+        self.store_resize = None  # The store holds images of crop_size, they are only resized when a lower resolution is trained
+        self.image_cache = LRUCache(opt.image_cache_mb * 1024 * 1024, image_bytes) if opt.image_cache_mb > 0 else None  # Of the decoded images
 
-        width, height = A_img.size
-        A_img = self.transform(A_img)  # This is where we actually perform the transformation. These are now tensors that are normalized
-        B_img = self.transform(B_img)
+    def load(self, source, index):
+        if self.opt.use_store:
+            return source[index] if self.store_resize is None else self.store_resize(source[index])  # Already resized uint8 images
+        if self.image_cache is not None:
+            img = self.image_cache.get(source[index])
+            if img is None:
+                img = load_image(source[index])
+                self.image_cache.put(source[index], img)
+            return self.transform(img)
+        return self.transform(load_image(source[index]))  # This is where we actually perform the transformation. These are now uint8 tensors
 
-        #A_gray = 1 - self.gray_transform(A_img)
+    # Loads (and resizes) the images at the given size from now on (see --resolution_schedule)
+    def set_size(self, size):
+        self.size = size
+        self.transform = config_transforms(self.opt, size)
+        self.store_resize = transforms.Resize((size, size), antialias=True) if size != self.opt.crop_size else None
 
-        r, g, b = A_img[0] + 1, A_img[1] + 1, A_img[2] + 1
-        A_gray = 1. - (0.299 * r + 0.587 * g + 0.114 * b) / 2. # Take the negative of the illumination (grayscale image) as the illumination map that will be fed as input to the generator
-        A_gray = torch.unsqueeze(A_gray, 0)
-        # Size of A_gray is [1,340,340]
-        return {'A': A_img, 'B': B_img, 'A_gray': A_gray}
+    # The samples only hold the raw pixels, see prepare_batch for the rest of the transformations
+    def __getitem__(self, index):
+        A_img = self.load(self.A_source, index % self.A_size)  # To avoid going out of bounds
+        # The index of A identifies the input (together with the flips, e.g. for caching the vgg features of real_A), the name is used to save the result
+        sample = {'A': A_img, 'index': index % self.A_size, 'name': self.name(index % self.A_size)}
+        if self.B_source is not self.A_source:  # There is no B for testing, the model gets A in its place
+            sample['B'] = self.load(self.B_source, index % self.B_size)
+        return sample
 
     def __len__(self):
         return max(self.A_size, self.B_size)
 
+    # The file name of A
+    def name(self, index):
+        if self.opt.use_store:
+            return self.A_source.names[index]
+        return os.path.basename(self.A_source[index])
+
+    # The (width, height) of every sample (or of the given indices) as it is returned by __getitem__ (only the header of the images has to be read for this)
+    def sample_sizes(self, indices=None):
+        indices = range(len(self)) if indices is None else indices
+        if self.opt.use_store or not keeps_native_size(self.opt):
+            return [(self.opt.crop_size, self.opt.crop_size)] * len(indices)
+        return [Image.open(self.A_source[index % self.A_size]).size for index in indices]
+
+    # The undecoded contents of A (the file, or the pixels in the store), e.g. to identify the image in the result cache
+    def raw_bytes(self, index):
+        if self.opt.use_store:
+            return self.A_source[index % self.A_size].numpy().tobytes()
+        with open(self.A_source[index % self.A_size], 'rb') as image_file:
+            return image_file.read()
+
+
+# Take the negative of the illumination (grayscale image) as the illumination map that will be fed as input to the generator
+# (img is a normalized image of shape 3xHxW or a batch of them, the result has a single channel)
+def illumination_map(img):
+    r, g, b = img[..., 0, :, :] + 1, img[..., 1, :, :] + 1, img[..., 2, :, :] + 1
+    A_gray = 1. - (0.299 * r + 0.587 * g + 0.114 * b) / 2.
+    return torch.unsqueeze(A_gray, -3)
+
+
+# Converts the whole batch at once (into a list of uint8 images)
+def TensorToImages(img_tensor):
+    for_disp = img_tensor.detach().cpu().float()
+    for_disp = (for_disp.permute(0, 2, 3, 1) + 1) / 2.0 * 255.0
+    for_disp = torch.clamp(for_disp, 0, 255)
+    return list(for_disp.to(torch.uint8).numpy())
+
 
 def TensorToImage(img_tensor):
     for_disp = img_tensor[0].cpu().float().numpy()
     for_disp = (np.transpose(for_disp, (1, 2, 0)) + 1) / 2.0 * 255.0
     for_disp = np.clip(for_disp, 0, 255)
     return for_disp.astype(np.uint8)
+
+
+# The keyword arguments that PIL needs to save an image in the given format
+def save_options(save_format, compression, quality):
+    if save_format == 'png':
+        return {'format': 'PNG', 'compress_level': compression}  # zlib level, 0 (fastest) to 9 (smallest)
+    if save_format in ('jpg', 'jpeg'):
+        return {'format': 'JPEG', 'quality': quality}
+    if save_format == 'webp':
+        return {'format': 'WEBP', 'quality': quality}
+    raise ValueError('Unsupported image format: %s' % save_format)
+
+
+def write_image(image, path, options):
+    Image.fromarray(image).save(path, **options)
+
+
+# Runs the writes in background threads (or processes), so that the main loop does not wait for them. At most max_queue writes
+# can be pending: submit() blocks when the queue is full. close() waits until every write is done (and re-raises the first error
+# that occured while writing)
+class BackgroundWriter:
+    def __init__(self, num_workers=2, max_queue=16, use_processes=False):
+        self.executor = (ProcessPoolExecutor if use_processes else ThreadPoolExecutor)(max_workers=num_workers)
+        self.slots = threading.BoundedSemaphore(max_queue)
+        self.errors = []
+
+    def submit(self, function, *args):
+        self.slots.acquire()  # Backpressure: wait for a free slot in the queue
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(self.done)
+
+    def done(self, future):
+        self.slots.release()
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Encodes and writes uint8 images (HxWx3 arrays) in the background
+class ImageWriter(BackgroundWriter):
+    def __init__(self, save_format='png', compression=6, quality=95, num_workers=2, max_queue=16, use_processes=False):
+        super(ImageWriter, self).__init__(num_workers, max_queue, use_processes)
+        self.extension = save_format
+        self.options = save_options(save_format, compression, quality)
+
+    def save(self, image, path):
+        self.submit(write_image, image, path, self.options)
+
+
+# On-disk cache of the results of test.py. The key of an image is the sha256 of its contents and the salt (the hash of the
+# generator and of the options that change the results), so an image is only enhanced again when it or the generator changed.
+# Every entry is a directory with the encoded results of an image (e.g. real_A and fake_B), which restore() copies to their
+# destinations without decoding the image or running the generator. The results of the misses are encoded and written in the
+# background. The least recently used entries are evicted when the entries take more than max_bytes (the modification time of
+# the entries keeps the order between runs)
+class ResultCache(BackgroundWriter):
+    def __init__(self, cache_dir, max_bytes, salt, save_format='png', compression=6, quality=95, num_workers=2, max_queue=16):
+        super(ResultCache, self).__init__(num_workers, max_queue)
+        self.cache_dir = cache_dir
+        self.salt = salt.encode()
+        self.extension = save_format
+        self.options = save_options(save_format, compression, quality)
+        self.lock = threading.Lock()  # The entries are updated by the background threads
+        self.entries = LRUCache(max_bytes, int, self.evict)  # key -> bytes of the entry
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.scan()
+
+    def scan(self):
+        entries = []
+        for entry_dir in glob.glob(os.path.join(self.cache_dir, '*', '*')):
+            if entry_dir.endswith('.tmp'):  # Left behind by an interrupted run
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            num_bytes = sum(os.path.getsize(os.path.join(entry_dir, file_name)) for file_name in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), os.path.basename(entry_dir), num_bytes))
+        for _, key, num_bytes in sorted(entries):
+            if not self.entries.put(key, num_bytes):
+                self.evict(key, num_bytes)
+        self.entries.evicted = 0  # Only the evictions of this run are reported
+
+    def evict(self, key, num_bytes):
+        shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+
+    def key(self, contents):
+        return hashlib.sha256(self.salt + contents).hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    # Copies the cached results of the key to their destinations ({label: path}), returns False when the key is not cached
+    def restore(self, key, paths):
+        with self.lock:
+            if self.entries.get(key) is None:
+                return False
+        entry_dir = self.entry_dir(key)
+        os.utime(entry_dir)
+        for label, path in paths.items():
+            shutil.copyfile(os.path.join(entry_dir, '%s.%s' % (label, self.extension)), path)
+        return True
+
+    # Writes the results ({label: (uint8 image (HxWx3), destination path)}) to their destinations and stores them under the key
+    def save(self, key, results):
+        self.submit(self.store, key, results)
+
+    def store(self, key, results):
+        entry_dir = self.entry_dir(key)
+        if not os.path.isdir(os.path.dirname(entry_dir)):
+            os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        temporary_dir = tempfile.mkdtemp(suffix='.tmp', dir=os.path.dirname(entry_dir))  # The entry only appears once it is complete
+        num_bytes = 0
+        for label, (image, path) in results.items():
+            encoded = io.BytesIO()
+            Image.fromarray(image).save(encoded, **self.options)  # Encoded once for the destination and the cache
+            for file_path in [path, os.path.join(temporary_dir, '%s.%s' % (label, self.extension))]:
+                with open(file_path, 'wb') as result_file:
+                    result_file.write(encoded.getvalue())
+            num_bytes += len(encoded.getvalue())
+        with self.lock:
+            if key in self.entries or num_bytes > self.entries.max_bytes:  # E.g. the same image twice in a run
+                shutil.rmtree(temporary_dir)
+                return
+            os.replace(temporary_dir, entry_dir)
+            self.entries.put(key, num_bytes)
+
+    def report(self):
+        entries = self.entries
+        lookups = max(entries.hits + entries.misses, 1)
+        return 'Result cache: %d hits, %d misses (%.1f%% hits), %d evicted, %d entries (%.1f MB) in %s' % (
+            entries.hits, entries.misses, 100.0 * entries.hits / lookups, entries.evicted, len(entries), entries.cur_bytes / 1024.0 / 1024.0, self.cache_dir)
+
+
+def make_writer(opt):
+    return ImageWriter(opt.save_format, opt.save_compression, opt.save_quality, opt.writer_workers, opt.writer_queue, opt.writer_processes)
@@ -0,0 +1,232 @@
+import os
+import sys
+import csv
+import json
+import time
+import resource
+import contextlib
+import torch
+from collections import OrderedDict
+
+# Instrumentation of the training loop: named timers for the phases of a training step, a torch.profiler trace of a window
+# of steps and a structured (JSONL or CSV) metrics log, which can be summarized with: python Monitor.py metrics.jsonl [...]
+
+
+# Times the named phases of every training step and reports the mean time per step (in ms) after every `every` steps.
+# The kernels run asynchronously on the GPU, so the device is synchronized at the end of every phase (otherwise the time
+# would be attributed to whichever phase happens to wait for them). This slows training down a bit, hence the timers are opt-in
+class StepTimer:
+    def __init__(self, every=100, device=torch.device('cpu')):
+        self.every = every
+        self.sync = device.type == 'cuda'
+        self.totals = OrderedDict()
+        self.steps = 0
+        self.annotate = False  # Set while the profiler is recording, so that the phases also show up in the trace
+
+    def phase(self, name):
+        return PhaseTimer(self, name)
+
+    def add(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    # Called at the end of every step, returns the mean time per step of every phase once `every` steps have been timed
+    def step(self):
+        self.steps += 1
+        if self.steps < self.every:
+            return None
+        summary = OrderedDict((name, 1000 * total / self.steps) for name, total in self.totals.items())
+        summary['total'] = sum(summary.values())
+        self.totals = OrderedDict()
+        self.steps = 0
+        return summary
+
+
+class PhaseTimer:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.record = None
+
+    def __enter__(self):
+        if self.timer.annotate:
+            self.record = torch.profiler.record_function(self.name)
+            self.record.__enter__()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        if self.timer.sync:
+            torch.cuda.synchronize()
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        if self.record is not None:
+            self.record.__exit__(*args)
+
+
+# Used when the timers are disabled: the phases are a shared (reusable) null context, so the overhead is a method call
+class NullTimer:
+    annotate = False
+    null_phase = contextlib.nullcontext()
+
+    def phase(self, name):
+        return self.null_phase
+
+    def add(self, name, seconds):
+        pass
+
+    def step(self):
+        return None
+
+
+def make_timer(opt):
+    return StepTimer(opt.time_phases, opt.device) if opt.time_phases > 0 and opt.rank == 0 else NullTimer()  # Only the first process reports
+
+
+# Records a torch.profiler trace of the training steps [start, end) (e.g. '10:15' for --profile_steps) and saves it as a
+# chrome trace (which can be opened in chrome://tracing or https://ui.perfetto.dev) in trace_dir
+class TraceWindow:
+    def __init__(self, steps, trace_dir, timer, device=torch.device('cpu')):
+        start, end = steps.split(':')
+        self.start, self.end = int(start), int(end)
+        self.trace_dir = trace_dir
+        self.timer = timer
+        self.device = device
+        self.profiler = None
+
+    # Called at the start of every step (counted from 0)
+    def step(self, step):
+        if step == self.start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.profiler.__enter__()
+            self.timer.annotate = True
+        elif step == self.end:
+            self.stop()
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        self.profiler.__exit__(None, None, None)
+        self.timer.annotate = False
+        trace_path = os.path.join(self.trace_dir, 'trace_steps%d-%d.json' % (self.start, self.end))
+        self.profiler.export_chrome_trace(trace_path)
+        print('Saved the profiler trace to %s' % trace_path)
+        print(self.profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=15))
+        self.profiler = None
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+# Peak memory of the process (resident set size) and of the device (allocated by the caching allocator) in MB
+def peak_memory(device):
+    process_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # ru_maxrss is in KB on Linux
+    device_mb = torch.cuda.max_memory_allocated(device) / 1024.0 / 1024.0 if device.type == 'cuda' else None
+    return process_mb, device_mb
+
+
+# Throughput of the training loop between two reports: the time spent waiting for the DataLoader and the time of every step.
+# On the GPU, the step times are the time it takes to queue the kernels (the device is only synchronized when the losses are
+# read), but the images/sec over the whole interval are exact
+class ThroughputMeter:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = time.perf_counter()
+        self.data_wait = 0.0
+        self.step_times = []
+        self.images = 0
+
+    def data(self, seconds):
+        self.data_wait += seconds
+
+    def step(self, seconds, images):
+        self.step_times.append(seconds)
+        self.images += images
+
+    def summary(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        step_ms = [1000 * step_time for step_time in self.step_times] or [0.0]
+        summary = OrderedDict([('images_per_sec', self.images / elapsed), ('data_wait_fraction', self.data_wait / elapsed),
+                               ('step_ms_p50', percentile(step_ms, 50)), ('step_ms_p90', percentile(step_ms, 90)), ('step_ms_p99', percentile(step_ms, 99))])
+        self.reset()
+        return summary
+
+
+# Appends records (dictionaries) to a JSONL or CSV file (chosen by the extension of the path). The records are buffered and
+# written every flush_secs seconds (and when the writer is closed). The columns of a CSV file are the keys of its first record
+class MetricsWriter:
+    def __init__(self, path, flush_secs=30):
+        self.path = path
+        self.flush_secs = flush_secs
+        self.is_csv = path.endswith('.csv')
+        self.columns = None
+        if self.is_csv and os.path.isfile(path) and os.path.getsize(path) > 0:
+            with open(path) as metrics_file:
+                self.columns = next(csv.reader(metrics_file))  # Appending to an earlier run
+        self.file = open(path, 'a', newline='')
+        self.buffer = []
+        self.last_flush = time.time()
+
+    def write(self, record):
+        self.buffer.append(record)
+        if time.time() - self.last_flush >= self.flush_secs:
+            self.flush()
+
+    def flush(self):
+        if self.is_csv:
+            if self.columns is None and self.buffer:
+                self.columns = list(self.buffer[0].keys())
+                csv.writer(self.file).writerow(self.columns)
+            writer = csv.DictWriter(self.file, self.columns, extrasaction='ignore')
+            writer.writerows(self.buffer)
+        else:
+            for record in self.buffer:
+                self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self.buffer = []
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_metrics(path):
+    with open(path) as metrics_file:
+        if path.endswith('.csv'):
+            return [OrderedDict((k, float(v) if v not in ('', 'None') else None) for k, v in row.items()) for row in csv.DictReader(metrics_file)]
+        return [json.loads(line) for line in metrics_file if line.strip()]
+
+
+# Summarizes the metrics of a run (the first record is skipped for the throughput, since it includes the warm-up)
+def summarize(path):
+    records = read_metrics(path)
+    if not records:
+        return OrderedDict([('run', path), ('records', 0)])
+    steady = records[1:] or records
+    mean = lambda key: sum(record[key] for record in steady) / len(steady)
+    last = records[-1]
+    summary = OrderedDict([('run', path), ('records', len(records)), ('epochs', last['epoch']),
+                           ('images_per_sec', mean('images_per_sec')), ('data_wait_fraction', mean('data_wait_fraction')),
+                           ('step_ms_p50', percentile([record['step_ms_p50'] for record in steady], 50)), ('step_ms_p99', max(record['step_ms_p99'] for record in steady)),
+                           ('peak_process_mb', max(record['peak_process_mb'] for record in records)),
+                           ('peak_device_mb', max([record['peak_device_mb'] for record in records if record.get('peak_device_mb') is not None] or [None], key=lambda x: x or 0)),
+                           ('lr', last['lr'])])
+    for key in ['Gen', 'G_Disc', 'L_Disc', 'vgg']:  # The final losses
+        if key in last:
+            summary[key] = last[key]
+    return summary
+
+
+# Prints a table with one row per run, e.g. python Monitor.py checkpoints/run1/metrics.jsonl checkpoints/run2/metrics.jsonl
+if __name__ == '__main__':
+    columns = ['records', 'epochs', 'images_per_sec', 'data_wait_fraction', 'step_ms_p50', 'step_ms_p99', 'peak_process_mb', 'peak_device_mb', 'lr', 'Gen', 'vgg']
+    print(' '.join(['%-40s' % 'run'] + ['%14s' % column for column in columns]))
+    for path in sys.argv[1:]:
+        summary = summarize(path)
+        values = [summary.get(column) for column in columns]
+        print(' '.join(['%-40s' % path[-40:]] + ['%14s' % ('-' if v is None else '%.4g' % v if isinstance(v, float) else v) for v in values]))
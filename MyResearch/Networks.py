@@ -1,14 +1,18 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import random
+import math
 from torch.autograd import Variable
-from ManageData import TensorToImage
+from ManageData import LRUCache, TensorToImage, prepare_batch
 import os
 from collections import OrderedDict
 import functools
+import contextlib
 import numpy as np
-import glob
+from Monitor import make_timer, NullTimer
+from Checkpoints import CheckpointWriter, latest_checkpoint, offset_rng_state, rng_state, set_rng_state
 
 # Initializes the weights to have mean= 0, and std = 0.02 as advised by Radford
 def weights_init(model):
@@ -20,50 +24,47 @@ def weights_init(model):
         torch.nn.init.constant_(model.bias.data, 0.0)
 
 # Adds padding to the input image to ensure the input has the correct size to be passed to the network
-# (In particular, the architecture seems quite sensitive to the size of the input image, regardless, 512x512 should be large enough)
-# If the model needs to be able to handle images with size between 512 -> 1024, num_downs should be changed to 10 to accomodate for this change
-def add_padding(input):
+# (In particular, the architecture seems quite sensitive to the size of the input image: every side has to be a multiple of 2^(num_downs),
+# i.e 512 if num_downs = 9, 1024 if num_downs = 10, etc, so we reflect-pad the image up to the next multiple)
+def add_padding(input, multiple: int = 512):
     height, width = input.shape[2], input.shape[3]
 
-    optimal_size = 512 # 2^(num_downs) i.e, will be 1024 if num_downs = 10, etc
+    optimal_height = max(1, -(-height // multiple)) * multiple  # Rounded up to the next multiple
+    optimal_width = max(1, -(-width // multiple)) * multiple
     pad_left = pad_right = pad_top = pad_bottom = 0
-    if width != optimal_size:
-        width_diff = optimal_size - width
-        pad_left = int(np.ceil(width_diff / 2))
+    if width != optimal_width:
+        width_diff = optimal_width - width
+        pad_left = (width_diff + 1) // 2  # i.e. ceil(width_diff / 2)
         pad_right = width_diff - pad_left
-    if height != optimal_size:
-        height_diff = optimal_size - height
-        pad_top = int(np.ceil(height_diff / 2))
+    if height != optimal_height:
+        height_diff = optimal_height - height
+        pad_top = (height_diff + 1) // 2
         pad_bottom = height_diff - pad_top
 
-    padding = nn.ReflectionPad2d((pad_left, pad_right, pad_top, pad_bottom))
-    input = padding(input)
+    # Reflection padding is only possible when the padding is smaller than the image itself
+    mode = 'reflect' if max(pad_left, pad_right) < width and max(pad_top, pad_bottom) < height else 'replicate'
+    input = F.pad(input, (pad_left, pad_right, pad_top, pad_bottom), mode=mode)
     return input, pad_left, pad_right, pad_top, pad_bottom
 
 # Removes the padding once the images have been enhanced
-def remove_padding(input, pad_left, pad_right, pad_top, pad_bottom):
+def remove_padding(input, pad_left: int, pad_right: int, pad_top: int, pad_bottom: int):
     height, width = input.shape[2], input.shape[3]
     return input[:, :, pad_top:height - pad_bottom, pad_left:width - pad_right]
 
-class The_Model:  # This is the grand model that encompasses everything ( the generator, both discriminators and the VGG network)
-    def __init__(self, opt):
-
-        self.opt = opt
-        # I'm assuming that a CUDA GPU is used.
-        self.input_A = torch.cuda.FloatTensor(opt.batch_size, 3, opt.crop_size, opt.crop_size)  # Tensor that will hold the input low-light images
-        self.input_B = torch.cuda.FloatTensor(opt.batch_size, 3, opt.crop_size, opt.crop_size) # Tensor that will hold the normal-light images
-        self.input_A_gray = torch.cuda.FloatTensor(opt.batch_size, 1, opt.crop_size, opt.crop_size) # Tensor that will hold the illumination maps
+# Mixed precision context for the given --amp (fp16 or bf16, it is disabled for none)
+def amp_autocast(device_type, amp):
+    amp_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(amp)
+    return torch.autocast(device_type, dtype=amp_dtype, enabled=amp_dtype is not None)
 
-        self.vgg_loss = PerceptualLoss()
-        self.vgg_loss.cuda()  # --> Shift to the GPU
 
-        self.vgg = load_vgg(self.opt.gpu_ids)  # This is for data parallelism
-        self.vgg.eval()  # We call eval() when some layers within the self.vgg network behave differently during training and testing... This will not be trained (Its frozen!)!
-        # The eval function is often used as a pair with the requires.grad or torch.no grad functions (which makes sense)
-
-        for weights in self.vgg.parameters():
-            weights.requires_grad = False  # The weights of vgg should not be trainable and we should not waste computation attempting to compute gradients for the VGG network
+class The_Model:  # This is the grand model that encompasses everything ( the generator, both discriminators and the VGG network)
+    def __init__(self, opt):
 
+        self.init_state(opt)
+        # Everything lives on opt.device (see setup_device in Setup.py)
+        self.input_A = torch.empty(opt.batch_size, 3, opt.crop_size, opt.crop_size, device=opt.device, memory_format=self.memory_format)  # Tensor that will hold the input low-light images
+        self.input_B = torch.empty(opt.batch_size, 3, opt.crop_size, opt.crop_size, device=opt.device, memory_format=self.memory_format) # Tensor that will hold the normal-light images
+        self.input_A_gray = torch.empty(opt.batch_size, 1, opt.crop_size, opt.crop_size, device=opt.device, memory_format=self.memory_format) # Tensor that will hold the illumination maps
 
         self.Gen = make_G(opt)
         if self.opt.phase == 'test':
@@ -71,16 +72,60 @@ class The_Model:  # This is the grand model that encompasses everything ( the ge
             self.Gen.eval()
 
         if self.opt.phase == 'train':
+            # The vgg network is only needed for the perceptual loss, i.e. during training
+            self.vgg_loss = PerceptualLoss(opt.vgg_cache_mb * 1024 * 1024, opt.fuse_vgg)
+            self.vgg_loss.to(opt.device)  # --> Shift to the device
+
+            self.vgg = load_vgg(self.opt)  # This is for data parallelism
+            self.vgg.eval()  # We call eval() when some layers within the self.vgg network behave differently during training and testing... This will not be trained (Its frozen!)!
+            # The eval function is often used as a pair with the requires.grad or torch.no grad functions (which makes sense)
+
+            for weights in self.vgg.parameters():
+                weights.requires_grad = False  # The weights of vgg should not be trainable and we should not waste computation attempting to compute gradients for the VGG network
+
             self.old_lr = opt.lr
             self.G_Disc = make_Disc(opt, False)
             self.L_Disc = make_Disc(opt, True)
 
             self.model_loss = GANLoss()
+            # With fp16, the losses are scaled to avoid underflowing gradients (a single scaler is shared by the three optimizers).
+            # bf16 has the same range as fp32, so the scaler is disabled for it (and without mixed precision)
+            self.scaler = torch.amp.GradScaler(self.input_A.device.type, enabled=opt.amp == 'fp16')
 
             self.G_optimizer = torch.optim.Adam(self.Gen.parameters(), lr=opt.lr, betas=(opt.beta1, 0.999))
             self.G_Disc_optimizer = torch.optim.Adam(self.G_Disc.parameters(), lr=opt.lr, betas=(opt.beta1, 0.999))
             self.L_Disc_optimizer = torch.optim.Adam(self.L_Disc.parameters(), lr=opt.lr, betas=(opt.beta1, 0.999))
 
+        if opt.compile:
+            self.compile()
+
+    # The state of the model besides the networks and the inputs (benchmark.py assembles the losses without __init__ and also calls this)
+    def init_state(self, opt):
+        self.opt = opt
+        self.memory_format = torch.channels_last if opt.channels_last else torch.contiguous_format
+        # Times the phases of every training step (see --time_phases), the timers do nothing when they are disabled
+        self.timer = make_timer(opt) if opt.phase == 'train' else NullTimer()
+        self.checkpointer = None  # Created by the first save_model
+        self.resolution = opt.crop_size  # The size of the training images (see set_resolution)
+        self.patch_size = opt.patch_size
+        self.accum_step = 0  # The position within the accumulated batches (see perform_update)
+        self.last_step = True
+
+    # --compile: the networks and the losses are compiled in place (the names in their state dicts stay the same). The shapes are
+    # static (dynamic=False), so every shape that a network sees gets its own graph: the training batches all have the same shape
+    # (the DataLoader drops the last, smaller batch), but e.g. the discriminators see both the single and the real+fake batches
+    def compile(self):
+        networks = [self.Gen]
+        if self.opt.phase == 'train':
+            networks += [self.G_Disc, self.L_Disc, self.vgg]
+            self.model_loss.compile(dynamic=False, mode=self.opt.compile_mode)
+            self.vgg_loss.compile(dynamic=False, mode=self.opt.compile_mode)
+        for network in networks:
+            network.module.compile(dynamic=False, mode=self.opt.compile_mode)  # Inside DataParallel/DistributedDataParallel
+
+    # Runs the enclosed forward passes in mixed precision (when opt.amp is fp16 or bf16)
+    def autocast(self):
+        return amp_autocast(self.input_A.device.type, self.opt.amp)
 
     def forward(self):
 
@@ -90,8 +135,18 @@ class The_Model:  # This is the grand model that encompasses everything ( the ge
 
 
         the_input = torch.cat([self.real_A, self.real_A_gray], 1)
-        self.fake_B = self.Gen.forward(the_input)  # We forward prop. a batch at a time, not individual images in the batch!
+        with self.autocast():
+            self.fake_B = self.Gen.forward(the_input)  # We forward prop. a batch at a time, not individual images in the batch!
+
 
+    # Trains at a lower resolution (see --resolution_schedule): the generator skips the levels that do not fit into the images and
+    # the patches of the local discriminator shrink with the images (so they cover the same part of every image), but not below
+    # 16x16 since the vgg loss of the patches pools them four times
+    def set_resolution(self, size):
+        self.resolution = size
+        self.Gen.module.set_resolution(size)
+        scaled = int(round(self.opt.patch_size * size / float(self.opt.crop_size)))
+        self.patch_size = min(max(scaled, min(16, self.opt.patch_size)), size)
 
     def update_learning_rate(self): # Linearly decays the learning rate to 0 over the final 50 epochs
 
@@ -105,31 +160,65 @@ class The_Model:  # This is the grand model that encompasses everything ( the ge
             param_group['lr'] = lr
         for param_group in self.L_Disc_optimizer.param_groups:
             param_group['lr'] = lr
+        return lr
 
     def set_input(self, input):
+        if input['A'].dtype == torch.uint8:  # A batch of the DataLoader, which only holds the raw pixels
+            with self.timer.phase('batch_transform'):
+                input = prepare_batch(input, self.input_A.device, augment=self.opt.phase == 'train')
         input_A = input['A']
         input_B = input['B']
         input_A_gray = input['A_gray']
-
-        # Copy the data to there respective cuda Tensors used for training on the GPU
-        self.input_A.resize_(input_A.size()).copy_(input_A)
-        self.input_B.resize_(input_B.size()).copy_(input_B)
-        self.input_A_gray.resize_(input_A_gray.size()).copy_(input_A_gray)
-
+        # The (index, flip, size) triples identify the real_A images, the vgg features of real_A can be cached using these as the keys
+        self.input_keys = [(index, flip, input_A.size(-1)) for index, flip in zip(input['index'].tolist(), input['flip'].tolist())] if 'index' in input else None
+
+        # Copy the data to there respective Tensors on the device used for training. Batches that are already on the device (e.g.
+        # staged by the Prefetcher, or transformed above) are used as they are
+        with self.timer.phase('set_input'):
+            if input_A.device == self.input_A.device:
+                self.input_A = input_A.contiguous(memory_format=self.memory_format)
+                self.input_B = input_B.contiguous(memory_format=self.memory_format)
+                self.input_A_gray = input_A_gray.contiguous(memory_format=self.memory_format)
+                return
+            self.input_A.resize_(input_A.size(), memory_format=self.memory_format).copy_(input_A)
+            self.input_B.resize_(input_B.size(), memory_format=self.memory_format).copy_(input_B)
+            self.input_A_gray.resize_(input_A_gray.size(), memory_format=self.memory_format).copy_(input_A_gray)
+
+    # With --accum_steps, the gradients of accum_steps consecutive batches are accumulated (the losses are divided by accum_steps)
+    # and the optimizers only step after the last one, so the effective batch size is accum_steps * batch_size. With --distributed,
+    # the gradients are only synchronized on that last batch: DistributedDataParallel decides this during the forward pass, so the
+    # forward of the generator is enclosed in no_sync together with its backward
     def perform_update(self):  # Do the forward,backprop and update the weights
-        # This is for optimizing the generator.
-        self.forward()  # This produces the fake samples and sets up some of the variables that we need ie. we initialize the fake patch and the list of patches.
-        self.G_optimizer.zero_grad()
-        self.Gen_Backprop()
-        self.G_optimizer.step() # Perform the necessary optimization pertaining to the generator
-
-        # Now onto updating the discriminator!
-        self.G_Disc_optimizer.zero_grad()
-        self.Global_Disc_Backprop()
-        self.L_Disc_optimizer.zero_grad()
-        self.Local_Disc_Backprop()
-        self.G_Disc_optimizer.step()
-        self.L_Disc_optimizer.step()
+        first_step = self.accum_step == 0
+        self.last_step = self.accum_step == self.opt.accum_steps - 1
+        self.accum_step = (self.accum_step + 1) % self.opt.accum_steps
+
+        with self.no_sync(*([] if self.last_step else [self.Gen])):
+            # This is for optimizing the generator.
+            with self.timer.phase('forward'):
+                self.forward()  # This produces the fake samples and sets up some of the variables that we need ie. we initialize the fake patch and the list of patches.
+            if first_step:
+                self.G_optimizer.zero_grad()
+                self.G_Disc_optimizer.zero_grad()
+                self.L_Disc_optimizer.zero_grad()
+            if self.opt.fused_disc:
+                with self.timer.phase('Fused_Backprop'):
+                    self.Fused_Backprop()
+            else:
+                with self.timer.phase('Gen_Backprop'):
+                    self.Gen_Backprop()
+
+                # Now onto updating the discriminator! (the fake samples are detached, so the generator can also step afterwards)
+                with self.timer.phase('Global_Disc_Backprop'):
+                    self.Global_Disc_Backprop()
+                with self.timer.phase('Local_Disc_Backprop'):
+                    self.Local_Disc_Backprop()
+        if self.last_step:
+            with self.timer.phase('optimizers'):
+                self.scaler.step(self.G_optimizer) # Perform the necessary optimization pertaining to the generator (the scaler unscales the gradients first)
+                self.scaler.step(self.G_Disc_optimizer)
+                self.scaler.step(self.L_Disc_optimizer)
+                self.scaler.update()  # Only once per iteration, after all the optimizers have stepped
 
     def predict(self):
         self.real_A = Variable(self.input_A)
@@ -137,62 +226,81 @@ class The_Model:  # This is the grand model that encompasses everything ( the ge
         self.real_A_gray = Variable(self.input_A_gray)
         self.real_A_gray.requires_grad = False
         the_input = torch.cat([self.real_A, self.input_A_gray], 1)
-        self.fake_B = self.Gen.forward(the_input)
+        with torch.no_grad(), self.autocast():  # There is no need to keep track of the graph (and all the activations) during inference
+            self.fake_B = self.Gen.forward(the_input)
 
+    # The generator loss only updates the generator, so no gradients are computed for the weights of the discriminators
+    # (with DistributedDataParallel they are also not synchronized, which allows the discriminators to be called twice before the backward)
     def Gen_Backprop(self):
+        set_requires_grad([self.G_Disc, self.L_Disc], False)
+        with self.no_sync(self.G_Disc, self.L_Disc):  # The generator is in no_sync (if needed) since its forward, see perform_update
+            with self.autocast():
+                self.compute_Gen_loss()
+            self.scaler.scale(self.Gen_loss / self.opt.accum_steps).backward()  # Compute the gradients of the generator using the sum of the adv loss and the vgg loss.
+        set_requires_grad([self.G_Disc, self.L_Disc], True)
+
+    # With DistributedDataParallel, the gradients of the networks are not synchronized between the processes within this context
+    # (i.e. until the last of the accumulated batches)
+    def no_sync(self, *networks):
+        stack = contextlib.ExitStack()
+        if self.opt.distributed:
+            for network in networks:
+                stack.enter_context(network.no_sync())
+        return stack
+
+    def compute_Gen_loss(self):
         # First let the discriminator make a prediction on the fake samples
         # This is the part recommended by Radford where we test real and fake samples in stages
-        pred_fake = self.G_Disc.forward(self.fake_B)
-        pred_real = self.G_Disc.forward(self.real_B)
-
-        self.Gen_adv_loss = (self.model_loss(pred_real - torch.mean(pred_fake), False) + self.model_loss(pred_fake - torch.mean(pred_real), True)) / 2
-        # In a seperate variable, we start accumulating the loss from the different aspects (which include the loss on the patches and the vgg loss)
-
-        w = self.real_A.size(3)
-        h = self.real_B.size(2)
-
-        self.fake_patch_list = []
-        self.real_patch_list = []
-        self.input_patch_list = []
+        # (the predictions are compared in fp32, also when the discriminator runs in mixed precision)
+        pred_fake = self.G_Disc.forward(self.fake_B).float()
+        pred_real = self.G_Disc.forward(self.real_B).float()
 
-        # Prepare the cropped images for the local discriminator so that we can just read from the appropriate data container when required
-        for i in range(self.opt.num_patches):
-            w_offset = random.randint(0, max(0, w - self.opt.patch_size - 1))
-            h_offset = random.randint(0, max(0, h - self.opt.patch_size - 1))
+        # The patches are stacked along the batch dimension so that the local discriminator and the vgg network are only called once
+        self.fake_patches, self.real_patches, self.input_patches = self.crop_patches()
 
-            self.fake_patch_list.append(self.fake_B[:, :, h_offset:h_offset + self.opt.patch_size, w_offset:w_offset + self.opt.patch_size])
-            self.real_patch_list.append(self.real_B[:, :, h_offset:h_offset + self.opt.patch_size, w_offset:w_offset + self.opt.patch_size])
-            self.input_patch_list.append(self.real_A[:, :, h_offset:h_offset + self.opt.patch_size, w_offset:w_offset + self.opt.patch_size])
+        # Each patch is still normalized seperately by the local discriminator, so the (mean) loss over the stacked patches is
+        # the same as averaging the losses of the individual patches
+        pred_fake_patches = self.L_Disc.forward(self.fake_patches, self.real_A.size(0)).float()
+        self.set_Gen_loss(pred_real, pred_fake, pred_fake_patches)
 
-        accum_gen_loss = 0
-        pred_fake_patch_list = 0
-        # Perform the predictions on the list of patches
-        for i in range(self.opt.num_patches):
-            w_offset = random.randint(0, max(0, w - self.opt.patch_size - 1))
-            h_offset = random.randint(0, max(0, h - self.opt.patch_size - 1))
+    def set_Gen_loss(self, pred_real, pred_fake, pred_fake_patches):
+        self.Gen_adv_loss = (self.model_loss(pred_real - torch.mean(pred_fake), False) + self.model_loss(pred_fake - torch.mean(pred_real), True)) / 2
+        # In a seperate variable, we start accumulating the loss from the different aspects (which include the loss on the patches and the vgg loss)
+        self.Gen_adv_loss += self.model_loss(pred_fake_patches, True)
 
-            pred_fake_patch_list = self.L_Disc.forward(self.fake_patch_list[i])
+        self.total_vgg_loss = self.vgg_loss.compute_vgg_loss(self.vgg, self.fake_B, self.real_A, self.input_keys) * 1.0  # This the vgg loss for the entire images!
+        self.total_vgg_loss += self.vgg_loss.compute_vgg_loss(self.vgg, self.fake_patches, self.input_patches) * 1.0  # The mean over all the patches
 
-            accum_gen_loss += self.model_loss(pred_fake_patch_list, True)
-        self.Gen_adv_loss += accum_gen_loss / float(self.opt.num_patches)
+        self.Gen_loss = self.Gen_adv_loss + self.total_vgg_loss
 
-        self.total_vgg_loss = self.vgg_loss.compute_vgg_loss(self.vgg, self.fake_B, self.real_A) * 1.0  # This the vgg loss for the entire images!
+    # Crops opt.num_patches random patches from fake_B, real_B and real_A (at the same locations for all three).
+    # The patches are stacked patch-major, i.e. [patch 0 of every image, patch 1 of every image, ...]
+    def crop_patches(self):
+        w = self.real_A.size(3)
+        h = self.real_B.size(2)
 
-        patch_loss_vgg = 0
+        fake_patch_list = []
+        real_patch_list = []
+        input_patch_list = []
         for i in range(self.opt.num_patches):
-            patch_loss_vgg += self.vgg_loss.compute_vgg_loss(self.vgg, self.fake_patch_list[i], self.input_patch_list[i]) * 1.0
+            w_offset = random.randint(0, max(0, w - self.patch_size - 1))
+            h_offset = random.randint(0, max(0, h - self.patch_size - 1))
 
-        self.total_vgg_loss += patch_loss_vgg / float(self.opt.num_patches)
-
-        self.Gen_loss = self.Gen_adv_loss + self.total_vgg_loss
-        self.Gen_loss.backward()  # Compute the gradients of the generator using the sum of the adv loss and the vgg loss.
+            fake_patch_list.append(self.fake_B[:, :, h_offset:h_offset + self.patch_size, w_offset:w_offset + self.patch_size])
+            real_patch_list.append(self.real_B[:, :, h_offset:h_offset + self.patch_size, w_offset:w_offset + self.patch_size])
+            input_patch_list.append(self.real_A[:, :, h_offset:h_offset + self.patch_size, w_offset:w_offset + self.patch_size])
+        return torch.cat(fake_patch_list, 0), torch.cat(real_patch_list, 0), torch.cat(input_patch_list, 0)
 
     # This is invoked when we update both the global and local discriminator
+    # The real and fake samples are passed through the discriminator as one batch, but the batch normalization statistics are
+    # still computed for every group of group_size samples seperately (so the result is the same as calling it once per group)
     def Shared_Disc_Backprop(self, network, real, fake, is_global):
-        pred_real = network.forward(real)
-        pred_fake = network.forward(
-            fake.detach())
+        with self.autocast():
+            pred = network.forward(torch.cat([real, fake.detach()], 0), self.real_A.size(0)).float()
+        pred_real, pred_fake = torch.chunk(pred, 2, 0)
+        return self.Disc_loss(pred_real, pred_fake, is_global)
 
+    def Disc_loss(self, pred_real, pred_fake, is_global):
         if (is_global):
             Disc_loss = (self.model_loss(pred_real - torch.mean(pred_fake), True) +
                          self.model_loss(pred_fake - torch.mean(pred_real), False)) / 2
@@ -202,19 +310,38 @@ class The_Model:  # This is the grand model that encompasses everything ( the ge
             Disc_loss = (loss_D_real + loss_D_fake) * 0.5
         return Disc_loss
 
+    # With --fused_disc, every discriminator is only called once per update, on the real and fake samples as one batch: the weights
+    # do not change between the generator and discriminator losses, so the same predictions serve both (the seperate path calls the
+    # global discriminator twice on real_B and both discriminators on the fake samples for each loss). Which weights every loss
+    # updates is decided by the inputs of its backward pass, instead of requires_grad and detach()
+    def Fused_Backprop(self):
+        with self.no_sync(*([] if self.last_step else [self.G_Disc, self.L_Disc])):  # And the generator, see perform_update
+            with self.autocast():
+                self.fake_patches, self.real_patches, self.input_patches = self.crop_patches()
+                pred = self.G_Disc.forward(torch.cat([self.real_B, self.fake_B], 0), self.real_A.size(0)).float()
+                pred_real, pred_fake = torch.chunk(pred, 2, 0)
+                pred_patches = self.L_Disc.forward(torch.cat([self.real_patches, self.fake_patches], 0), self.real_A.size(0)).float()
+                pred_real_patches, pred_fake_patches = torch.chunk(pred_patches, 2, 0)
+
+                self.set_Gen_loss(pred_real, pred_fake, pred_fake_patches)
+                self.G_Disc_loss = self.Disc_loss(pred_real, pred_fake, True)
+                self.L_Disc_loss = self.Disc_loss(pred_real_patches, pred_fake_patches, False)
+
+            self.scaler.scale(self.Gen_loss / self.opt.accum_steps).backward(inputs=list(self.Gen.parameters()), retain_graph=True)
+            self.scaler.scale(self.G_Disc_loss / self.opt.accum_steps).backward(inputs=list(self.G_Disc.parameters()))
+            self.scaler.scale(self.L_Disc_loss / self.opt.accum_steps).backward(inputs=list(self.L_Disc.parameters()))
+
     # Global discriminator backprop
     def Global_Disc_Backprop(self):
-        self.G_Disc_loss = self.Shared_Disc_Backprop(self.G_Disc, self.real_B, self.fake_B, True)
-        self.G_Disc_loss.backward()
+        with self.no_sync(*([] if self.last_step else [self.G_Disc])):
+            self.G_Disc_loss = self.Shared_Disc_Backprop(self.G_Disc, self.real_B, self.fake_B, True)
+            self.scaler.scale(self.G_Disc_loss / self.opt.accum_steps).backward()
 
-    # Local discriminator backprop
+    # Local discriminator backprop (the loss over all the stacked patches is equal to the mean of the losses per patch)
     def Local_Disc_Backprop(self):
-        L_Disc_loss = 0
-
-        for i in range(self.opt.num_patches):
-            L_Disc_loss += self.Shared_Disc_Backprop(self.L_Disc, self.real_patch_list[i], self.fake_patch_list[i], False)
-        self.L_Disc_loss = L_Disc_loss / float(self.opt.num_patches)
-        self.L_Disc_loss.backward()
+        with self.no_sync(*([] if self.last_step else [self.L_Disc])):
+            self.L_Disc_loss = self.Shared_Disc_Backprop(self.L_Disc, self.real_patches, self.fake_patches, False)
+            self.scaler.scale(self.L_Disc_loss / self.opt.accum_steps).backward()
 
     def get_model_errors(self, epoch):
         Gen = self.Gen_loss.item()
@@ -230,52 +357,189 @@ class The_Model:  # This is the grand model that encompasses everything ( the ge
         return OrderedDict([('real_A', real_A), (
             'fake_B', fake_B)])  # , , ('latent_real_A', latent_real_A),('latent_show', latent_show), ('real_patch', real_patch),('fake_patch', fake_patch),('self_attention', self_attention)])
 
-    # Save the network periodically
-    def save_network(self, network, label, epoch):
-        save_name = '%s_net_%s.pth' % (epoch, label)
-        save_path = os.path.join(self.opt.save_dir, save_name)
-        torch.save(network.cpu().state_dict(), save_path)
-        network.cuda(device=self.opt.gpu_ids[0])
-
-    def save_model(self, label):
-        self.save_network(self.Gen, 'Gener', label)
-        self.save_network(self.G_Disc, 'Global_Disc', label)
-        self.save_network(self.L_Disc, 'Local_Disc', label)
+    # Save the networks and the training state periodically (progress holds the position in the training loop, e.g. the epoch).
+    # The state dicts are copied to the host and written in the background (see Checkpoints.py), the networks stay on the device.
+    # With --distributed, only the first process saves, so the random number generators of the other processes are not saved (see resume)
+    def save_model(self, label, progress=None):
+        if self.checkpointer is None:
+            self.checkpointer = CheckpointWriter(self.opt.save_dir)
+        networks = OrderedDict([('Gener', self.Gen.state_dict()), ('Global_Disc', self.G_Disc.state_dict()), ('Local_Disc', self.L_Disc.state_dict())])
+        training_state = {'progress': progress or {}, 'old_lr': self.old_lr, 'scaler': self.scaler.state_dict(), 'rng': rng_state(),
+                          'optimizers': {'Gener': self.G_optimizer.state_dict(), 'Global_Disc': self.G_Disc_optimizer.state_dict(), 'Local_Disc': self.L_Disc_optimizer.state_dict()}}
+        self.checkpointer.save(label, networks, training_state)
+
+    # Restores the networks and the training state of the latest checkpoint and returns its progress (see --resume).
+    # The gradients that were still being accumulated are not saved, so the resumed run starts a new accumulation (see --accum_steps)
+    def resume(self):
+        self.load_model(self.Gen, 'Gener')
+        self.load_model(self.G_Disc, 'Global_Disc')
+        self.load_model(self.L_Disc, 'Local_Disc')
+        state = torch.load(latest_checkpoint(self.opt.save_dir, 'training_state'), map_location='cpu', weights_only=False)  # The optimizers move their state to the device
+        self.G_optimizer.load_state_dict(state['optimizers']['Gener'])
+        self.G_Disc_optimizer.load_state_dict(state['optimizers']['Global_Disc'])
+        self.L_Disc_optimizer.load_state_dict(state['optimizers']['Local_Disc'])
+        self.scaler.load_state_dict(state['scaler'])
+        self.old_lr = state['old_lr']
+        self.accum_step = 0
+        set_rng_state(state['rng'])
+        if self.opt.rank > 0:  # The other processes continue from the state of the first one, offset so that they draw different flips and patches
+            offset_rng_state(self.opt.rank)
+        return state['progress']
+
+    # Waits until the last checkpoint has been written
+    def close(self):
+        if self.checkpointer is not None:
+            self.checkpointer.close()
 
     # Function that finds the latest model to load when we are training
     def load_model(self, network, network_name):
-        list_of_files = glob.glob(str(self.opt.save_dir) + "/*")  # * means all if need specific format then *.csv
-        res = list(filter(lambda x: network_name in x, list_of_files))
-        latest_file = max(res, key=os.path.getctime)
-        loaded_file_path = os.path.join(self.opt.save_dir, latest_file)
-        network.load_state_dict(torch.load(loaded_file_path))
+        loaded_file_path = latest_checkpoint(self.opt.save_dir, network_name)
+        network.load_state_dict(torch.load(loaded_file_path, map_location=self.opt.device))  # Checkpoints can be loaded on any device
+
+
+# Folds every BatchNorm2d that directly follows a Conv2d (within an nn.Sequential) into the convolution, which is only valid in eval()
+# mode (the running statistics are used). The other batch normalization layers (e.g. after the upsampling of the innermost U-net level) are kept
+def fold_batchnorm(network):
+    network.eval()
+    sequentials = [module for module in network.modules() if isinstance(module, nn.Sequential)]
+    for sequential in sequentials:
+        for i in range(1, len(sequential)):
+            if isinstance(sequential[i], nn.BatchNorm2d) and isinstance(sequential[i - 1], nn.Conv2d):
+                sequential[i - 1] = torch.nn.utils.fusion.fuse_conv_bn_eval(sequential[i - 1], sequential[i])
+                sequential[i] = nn.Identity()
+    return network
+
+
+# Keeps the network under .module (just like DataParallel), so that the checkpoints are the same on every device
+class SingleDevice(nn.Module):
+    def __init__(self, module):
+        super(SingleDevice, self).__init__()
+        self.module = module
+
+    def forward(self, *inputs, **kwargs):
+        return self.module(*inputs, **kwargs)
+
+
+def set_requires_grad(networks, requires_grad):
+    for network in networks:
+        for weights in network.parameters():
+            weights.requires_grad = requires_grad
+
+
+# Moves the network to opt.device and wraps it: on the GPU, DataParallel splits the input across all the GPU's (if applicable).
+# With --distributed, the trained networks are wrapped in DistributedDataParallel instead (distribute=False for the frozen vgg network,
+# which has no gradients to synchronize). The weights have to be initialized before, since DDP broadcasts the weights of the first process.
+# split=False keeps the network on the first GPU: DataParallel would split the stacked groups of the discriminators (see GroupedBatchNorm2d)
+def wrap_network(network, opt, distribute=True, split=True):
+    if opt.distributed and distribute and opt.sync_bn:
+        network = sync_batchnorm(network)
+    network.to(opt.device, memory_format=torch.channels_last if opt.channels_last else torch.contiguous_format)
+    if opt.distributed and distribute:
+        # The levels of the generator that are skipped at lower resolutions do not get gradients (see --resolution_schedule)
+        return torch.nn.parallel.DistributedDataParallel(network, device_ids=[opt.device.index] if opt.device.type == 'cuda' else None, find_unused_parameters=bool(getattr(opt, 'resolution_schedule', '')))
+    if opt.device.type == 'cuda':
+        return torch.nn.DataParallel(network, opt.gpu_ids if split else opt.gpu_ids[:1])  # We only need this when we have more than one GPU
+    return SingleDevice(network)
 
 
 def make_G(opt):
     generator = UnetGenerator(opt)
-    generator.cuda(device=opt.gpu_ids[0])  # Transfer the generator to the GPU
-    generator = torch.nn.DataParallel(generator, opt.gpu_ids)  # We only need this when we have more than one GPU
     generator.apply(weights_init)  # The weight initialization
-    return generator
+    return wrap_network(generator, opt)  # Transfer the generator to the device
 
 
 def make_Disc(opt, patch):
     discriminator = PatchGAN(opt, patch)
-    discriminator.cuda(device=opt.gpu_ids[0])  #Load the model into the GPU
-    discriminator = torch.nn.DataParallel(discriminator, opt.gpu_ids)  # Split the input across all the GPU's (if applicable)
     discriminator.apply(weights_init)
-    return discriminator
+    return wrap_network(discriminator, opt, split=False)  #Load the model into the device (use --distributed to spread them over several GPU's)
+
+
+# Replaces the batch normalization layers by GroupedBatchNorm2d layers that compute their statistics over the batches of all the
+# processes (nn.SyncBatchNorm only runs on the GPU, and it would mix the groups of the discriminators). The state_dict is unchanged
+def sync_batchnorm(network):
+    for name, module in list(network.named_modules()):
+        if type(module) is nn.BatchNorm2d:
+            synced = GroupedBatchNorm2d(module.num_features, module.eps, module.momentum, module.affine, module.track_running_stats)
+            synced.load_state_dict(module.state_dict())
+            parent, child = name.rsplit('.', 1)
+            setattr(network.get_submodule(parent), child, synced)
+    for module in network.modules():
+        if isinstance(module, GroupedBatchNorm2d):
+            module.sync = True
+    return network
 
 
 class GANLoss(nn.Module): # We are using LSGAN loss which builds upon MSELoss
     def __init__(self):
         super(GANLoss, self).__init__()
-        self.Tensor = torch.cuda.FloatTensor
         self.loss = nn.MSELoss()
 
-    def __call__(self, input, target_is_real):
-        target_tensor = self.Tensor(input.size()).detach().fill_(float(target_is_real))
-        return self.loss(input, target_tensor)  # We then perform MSE on this!
+    def forward(self, input, target_is_real: bool):
+        target_tensor = torch.full(input.size(), float(target_is_real), device=input.device)
+        return self.loss(input.float(), target_tensor)  # We then perform MSE on this! (always in fp32, also with mixed precision)
+
+
+# Batch normalization that can normalize a batch which consists of several stacked groups of group_size samples (e.g. the real
+# and the fake samples, or all the patches) with seperate statistics for every group. The result (including the running
+# statistics) is the same as calling the layer on every group one after the other, but only needs a single call
+class GroupedBatchNorm2d(nn.BatchNorm2d):
+    sync = False  # Set by sync_batchnorm(), the statistics of every group are then computed over all the processes
+
+    def forward(self, input, group_size=None):
+        synced = self.sync and self.training and torch.distributed.is_initialized()
+        if not synced and (not self.training or group_size is None or group_size == input.size(0)):
+            return super(GroupedBatchNorm2d, self).forward(input)
+
+        n, c, h, w = input.shape
+        group_size = group_size or n
+        if n % group_size != 0:
+            raise ValueError('The batch of %d samples can not be split into groups of %d samples' % (n, group_size))
+        num_groups = n // group_size
+        grouped = input.reshape(num_groups, group_size, c, h, w).float()  # The statistics are always computed in fp32
+        count = group_size * h * w
+        if synced:
+            var, mean, count = self.synced_var_mean(grouped, count)
+        else:
+            var, mean = torch.var_mean(grouped, dim=(1, 3, 4), unbiased=False, keepdim=True)
+        output = (grouped - mean) * torch.rsqrt(var + self.eps)
+        if self.affine:
+            output = output * self.weight.view(1, 1, c, 1, 1) + self.bias.view(1, 1, c, 1, 1)
+        output = output.to(input.dtype)
+
+        if self.track_running_stats:
+            # Like the native batch norm, the running statistics are updated through .data so that their version counter is not bumped
+            # (the native batch norm saves them for the backward pass of earlier calls). A compiled graph (--compile) does not support
+            # .data, but it keeps track of the updates of the buffers itself
+            if torch.compiler.is_compiling():
+                running_mean, running_var, num_batches_tracked = self.running_mean, self.running_var, self.num_batches_tracked
+            else:
+                running_mean, running_var, num_batches_tracked = self.running_mean.data, self.running_var.data, self.num_batches_tracked.data
+            mean = mean.detach().view(num_groups, c)
+            var = var.detach().view(num_groups, c) * count / max(count - 1, 1)  # The running variance is unbiased
+            if self.momentum is None:  # Cumulative moving average
+                for i in range(num_groups):
+                    num_batches_tracked.add_(1)
+                    factor = 1.0 / float(num_batches_tracked)
+                    running_mean.mul_(1 - factor).add_(mean[i] * factor)
+                    running_var.mul_(1 - factor).add_(var[i] * factor)
+            else:  # Closed form of num_groups consecutive exponential moving average updates
+                num_batches_tracked.add_(num_groups)
+                decay = (1 - self.momentum) ** torch.arange(num_groups - 1, -1, -1, dtype=mean.dtype, device=mean.device)
+                weights = (self.momentum * decay).view(num_groups, 1)
+                running_mean.mul_((1 - self.momentum) ** num_groups).add_((weights * mean).sum(0))
+                running_var.mul_((1 - self.momentum) ** num_groups).add_((weights * var).sum(0))
+        return output.reshape(n, c, h, w)
+
+    # The sums of every group are summed over all the processes (the gradient flows back through the all_reduce). Every process
+    # is assumed to have the same batch size, which the DistributedSampler ensures
+    def synced_var_mean(self, grouped, count):
+        num_groups, c = grouped.size(0), grouped.size(2)
+        sums = torch.cat([grouped.sum(dim=(1, 3, 4)), (grouped * grouped).sum(dim=(1, 3, 4))], 1)
+        sums = torch.distributed.nn.functional.all_reduce(sums)
+        count = count * torch.distributed.get_world_size()
+        mean = sums[:, :c] / count
+        var = (sums[:, c:] / count - mean * mean).clamp(min=0)
+        return var.view(num_groups, 1, c, 1, 1), mean.view(num_groups, 1, c, 1, 1), count
 
 
 def get_norm_layer(norm_type='instance'):
@@ -294,11 +558,16 @@ class MinimalUnet(nn.Module):
         self.sub = submodule
         self.up = nn.Sequential(*up)
         self.withoutskip = withoutskip
-        self.is_sub = not submodule == None  # Will be false only for the innermost
-
-    def forward(self, x, mask=None):
-        if self.is_sub:  # Almost recursive in a way
-            x_up, _ = self.sub(self.down(x), mask)
+        self.checkpoint = False  # Set by UnetGenerator for the outermost opt.checkpoint_levels levels
+        self.skip = False  # Set by UnetGenerator for the levels that do not fit into the images of a lower resolution
+
+    def forward(self, x):
+        if self.skip:  # The level (and the ones below it) contributes nothing, as if its output was all zeros
+            return torch.cat([x, torch.zeros_like(x)], 1)
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            return self.checkpointed_forward(x)
+        if self.sub is not None:  # Almost recursive in a way
+            x_up = self.sub(self.down(x))
         else:  # If it is the inner-most (this would be the base case of the recursion)
             x_up = self.down(x)
 
@@ -307,10 +576,46 @@ class MinimalUnet(nn.Module):
         if self.withoutskip:  # No skip connections are used for the outer layer
             x_out = result
         else:
-            x_out = (torch.cat([x, result], 1), mask)
+            x_out = torch.cat([x, result], 1)
 
         return x_out
 
+    # The same as forward, but the activations within down and up are not stored: they are recomputed during the backward pass
+    # (the submodule is not recomputed, its levels can be checkpointed themselves)
+    @torch.jit.unused
+    def checkpointed_forward(self, x):
+        x_up = checkpoint_sequential(self.down, x)
+        if self.sub is not None:
+            x_up = self.sub(x_up)
+        result = checkpoint_sequential(self.up, x_up)
+        if self.withoutskip:
+            return result
+        return torch.cat([x, result], 1)
+
+
+# Runs the layers with torch.utils.checkpoint. A leading in-place activation is applied outside of the checkpoint, since it
+# modifies the input which the recomputation starts from (and the skip connection uses the modified input as well)
+def checkpoint_sequential(layers, x):
+    if getattr(layers[0], 'inplace', False):
+        x = layers[0](x)
+        layers = layers[1:]
+    return torch.utils.checkpoint.checkpoint(layers, x, use_reentrant=False, context_fn=lambda: (contextlib.nullcontext(), keep_running_stats(layers)))
+
+
+# The batch normalization layers would update their running statistics a second time during the recomputation, so they are
+# restored afterwards (through .data, the version counters are not bumped)
+@contextlib.contextmanager
+def keep_running_stats(layers):
+    norms = [layer for layer in layers.modules() if isinstance(layer, nn.modules.batchnorm._BatchNorm) and layer.track_running_stats]
+    saved = [(norm.running_mean.clone(), norm.running_var.clone(), norm.num_batches_tracked.clone()) for norm in norms]
+    try:
+        yield
+    finally:
+        for norm, (mean, var, num_batches) in zip(norms, saved):
+            norm.running_mean.data.copy_(mean)
+            norm.running_var.data.copy_(var)
+            norm.num_batches_tracked.data.copy_(num_batches)
+
 
 # Defines the Unet generator.
 # |num_downs|: number of downsamplings in UNet. For example,
@@ -331,10 +636,33 @@ class UnetGenerator(nn.Module):
         unet_block = UnetSkipConnectionBlock(ngf, ngf * 2, submodule=unet_block, norm_layer=norm_type)
         unet_block = UnetSkipConnectionBlock(3, ngf, submodule=unet_block, position='outermost', norm_layer=norm_type)  # This is the outermost
         self.model = unet_block
+        self.num_downs = opt.num_downs
+        self.multiple = 2 ** opt.num_downs  # Every side of the input has to be a multiple of this
+
+        # Activation checkpointing of the outermost levels (which have the largest activations), trading memory for a recomputation
+        level = self.model.model
+        for i in range(opt.checkpoint_levels):
+            level.checkpoint = True
+            if level.sub is None:
+                break
+            level = level.sub.model
+
+    # For training at a lower resolution (see --resolution_schedule): images smaller than 2^num_downs would have to be padded up to
+    # 2^num_downs, so instead the deepest levels are skipped and the images are only padded to a multiple of 2^(the remaining levels).
+    # The last of the remaining levels (like the innermost one at full resolution) is left with 2x2 features
+    def set_resolution(self, size):
+        levels = self.num_downs if size >= 2 ** self.num_downs else max(1, int(math.log2(size)) - 1)
+        self.multiple = 2 ** levels
+        level = self.model.model
+        for i in range(self.num_downs):
+            level.skip = i >= levels
+            if level.sub is None:
+                break
+            level = level.sub.model
 
     def forward(self, input):
-        input, pad_left, pad_right, pad_top, pad_bottom = add_padding(input)
-        latent = self.model(input[:, 0:3, :, :], input[:, 3:4, :, :])  # Extraction is correct!
+        input, pad_left, pad_right, pad_top, pad_bottom = add_padding(input, self.multiple)
+        latent = self.model(input[:, 0:3, :, :])  # Extraction is correct! (the illumination map in the fourth channel is not used by the U-net)
         latent = remove_padding(latent, pad_left, pad_right, pad_top, pad_bottom)
         input = remove_padding(input, pad_left, pad_right, pad_top, pad_bottom)
         return input[:, 0:3, :, :] + latent
@@ -382,8 +710,8 @@ class UnetSkipConnectionBlock(nn.Module):
 
         self.model = model
 
-    def forward(self, x, mask=None):
-        return self.model(x, mask)
+    def forward(self, x):
+        return self.model(x)
 
 
 class PatchGAN(nn.Module): # We include batch normalization in the discriminator in an attempt to improve stability and performance
@@ -407,37 +735,85 @@ class PatchGAN(nn.Module): # We include batch normalization in the discriminator
             nf_mult_prev = nf_mult
             nf_mult = min(2 ** n, 8)
             sequence += [nn.Conv2d(ndf * nf_mult_prev, ndf * nf_mult, kernel_size=4, stride=2, padding=2),
-                         nn.BatchNorm2d(ndf * nf_mult),
+                         GroupedBatchNorm2d(ndf * nf_mult),
                          nn.LeakyReLU(0.2, True)]
 
         nf_mult_prev = nf_mult
         nf_mult = min(2 ** no_layers, 8)
         sequence += [nn.Conv2d(ndf * nf_mult_prev, ndf * nf_mult, kernel_size=4, stride=1, padding=2),
-                     nn.BatchNorm2d(ndf * nf_mult),
+                     GroupedBatchNorm2d(ndf * nf_mult),
                      nn.LeakyReLU(0.2, True)]
 
         sequence += [nn.Conv2d(ndf * nf_mult, 1, kernel_size=4, stride=1, padding=2)]
 
         self.model = nn.Sequential(*sequence)
 
-    def forward(self, input):
-        return self.model(input)  # <-- pass through the discriminator itself which is represented by self.model
+    # group_size is passed on to the batch normalization layers (see GroupedBatchNorm2d)
+    def forward(self, input, group_size=None):
+        for layer in self.model:  # <-- pass through the discriminator itself which is represented by self.model
+            if isinstance(layer, GroupedBatchNorm2d):
+                input = layer(input, group_size)
+            else:
+                input = layer(input)
+        return input
+
+
+def tensor_bytes(tensor):
+    return tensor.numel() * tensor.element_size()
 
 
 class PerceptualLoss(nn.Module):
-    def __init__(self):
+    # cache_bytes > 0 enables the cache of the target features (only used when compute_vgg_loss is given the keys of the targets)
+    # fuse passes the image and the target (or the targets that are not cached) through the vgg network as a single batch
+    def __init__(self, cache_bytes=0, fuse=False):
         super(PerceptualLoss, self).__init__()
         self.instance_norm = nn.InstanceNorm2d(512, affine=False)  # This is to stabilize training
         # 512 is the number of features
+        # LRU cache (in host memory) of the vgg features of the target images (the vgg network is frozen, so they never change)
+        self.feature_cache = LRUCache(cache_bytes, tensor_bytes) if cache_bytes > 0 else None
+        self.fuse = fuse
 
-    def compute_vgg_loss(self, vgg_network, image, target): # This is where we calculate the perceptual loss
+    def compute_vgg_loss(self, vgg_network, image, target, target_keys=None): # This is where we calculate the perceptual loss
         image_vgg = vgg_preprocess(image)
-        target_vgg = vgg_preprocess(target)
-        # The is precisely where we are calling forward on the vgg network
-        img_feature_map = vgg_network(image_vgg)  # Get the feature map of the input image
-        target_feature_map = vgg_network(target_vgg)  # Get the feature of the target image
-
-        return torch.mean((self.instance_norm(img_feature_map) - self.instance_norm(target_feature_map)) ** 2)  # The actual Perceptual Loss calculation
+        if self.feature_cache is not None and target_keys is not None:
+            img_feature_map, target_feature_map = self.cached_feature_maps(vgg_network, image_vgg, target, target_keys)
+        elif self.fuse:
+            feature_maps = vgg_network(torch.cat([image_vgg, vgg_preprocess(target)], 0))  # The vgg network has no batch dependent layers
+            img_feature_map, target_feature_map = torch.chunk(feature_maps, 2, 0)
+        else:
+            target_vgg = vgg_preprocess(target)
+            # The is precisely where we are calling forward on the vgg network
+            img_feature_map = vgg_network(image_vgg)  # Get the feature map of the input image
+            target_feature_map = vgg_network(target_vgg)  # Get the feature of the target image
+
+        return self(img_feature_map, target_feature_map)
+
+    # The loss between the vgg features (the part that is compiled with --compile, the cache lookups are not)
+    def forward(self, img_feature_map, target_feature_map):
+        # The instance normalization (and the loss) is computed in fp32, the vgg features might have been computed in mixed precision
+        with torch.autocast(img_feature_map.device.type, enabled=False):
+            img_feature_map, target_feature_map = img_feature_map.float(), target_feature_map.float()
+            return torch.mean((self.instance_norm(img_feature_map) - self.instance_norm(target_feature_map)) ** 2)  # The actual Perceptual Loss calculation
+
+    # Looks up the features of the targets in the cache, and only passes the targets that are missing through the vgg network
+    def cached_feature_maps(self, vgg_network, image_vgg, target, target_keys):
+        target_features = [self.feature_cache.get(key) for key in target_keys]
+        missing = [i for i, feature in enumerate(target_features) if feature is None]
+        if missing:
+            missing_vgg = vgg_preprocess(target[missing])
+            if self.fuse:
+                feature_maps = vgg_network(torch.cat([image_vgg, missing_vgg], 0))
+                img_feature_map, missing_features = feature_maps[:image_vgg.size(0)], feature_maps[image_vgg.size(0):]
+            else:
+                img_feature_map = vgg_network(image_vgg)
+                missing_features = vgg_network(missing_vgg)
+            for i, feature in zip(missing, missing_features.detach()):
+                target_features[i] = feature
+                self.feature_cache.put(target_keys[i], feature.to('cpu', copy=True))  # A copy, so that the cache does not hold on to the whole batch
+        else:
+            img_feature_map = vgg_network(image_vgg)
+        target_feature_map = torch.stack([feature.to(img_feature_map.device, non_blocking=True) for feature in target_features])
+        return img_feature_map, target_feature_map
 
 class Vgg(nn.Module):
 
@@ -493,9 +869,11 @@ def vgg_preprocess(batch):
     return batch
 
 
-def load_vgg(gpu_ids):
+def load_vgg(opt):
     vgg = Vgg()
-    vgg.cuda(device=gpu_ids[0])
-    vgg.load_state_dict(torch.load('vgg16.weight'))  # Adding the weights to the model
-    vgg = torch.nn.DataParallel(vgg, gpu_ids)
+    if opt.vgg_weights:
+        vgg.load_state_dict(torch.load(opt.vgg_weights, map_location='cpu'))  # Adding the weights to the model
+    else:
+        print('No vgg weights given, the perceptual loss uses a randomly initialized vgg network')
+    vgg = wrap_network(vgg, opt, distribute=False)
     return vgg
@@ -14,41 +14,174 @@ def DefaultSetup():
     parser.add_argument('--crop_size', type=int, default=512, help='This will be the the size of the input to our network (the size is reduced by RandomCropping)')
     parser.add_argument('--patch_size', type=int, default=32, help='Size of patch')
     parser.add_argument('--gpu_ids', type=str, default='0', help="Used to specify the id's of the GPU's (more specifically, '0' for 1 GPU, '0,1' for 2 GPU's,etc)")
+    parser.add_argument('--device', type=str, default='auto', help='cuda, cpu or auto (cuda when it is available)')
+    parser.add_argument('--num_threads', type=int, default=0, help='number of intra-op threads used on the CPU (0 keeps the default)')
+    parser.add_argument('--num_interop_threads', type=int, default=0, help='number of inter-op threads used on the CPU (0 keeps the default)')
+    parser.add_argument('--distributed', action='store_true', help='train with DistributedDataParallel, one process per device (launch with torchrun, e.g. torchrun --nproc_per_node 2 train.py --distributed); batch_size is per process')
+    parser.add_argument('--dist_backend', type=str, default='', help='nccl or gloo (defaults to nccl on the GPU and gloo on the CPU)')
+    parser.add_argument('--sync_bn', action='store_true', help='with --distributed, compute the batch normalization statistics over the batches of all the processes')
+    parser.add_argument('--channels_last', action='store_true', help='use the channels_last memory format for the networks and their inputs')
     parser.add_argument('--checkpoints_dir', type=str, default='/content/drive/My Drive/Low-light_Image_Enh/', help='models are saved here')
     parser.add_argument('--norm_type', type=str, default='batch', help='instance or batch normalization in the generator')
     parser.add_argument('--num_downs', type=int, default=9, help=' How many U-net modules are created in the generator')
+    parser.add_argument('--checkpoint_levels', type=int, default=0, help='recompute the activations of the outermost this many U-net levels during the backward pass (saves memory at the cost of some extra computation)')
     parser.add_argument('--num_disc_layers', type=int, default=7, help='number of layers in global discriminator')
     parser.add_argument('--num_patch_disc_layers', type=int, default=6, help='number of layers in local discriminator')
     parser.add_argument('--num_patches', type=int, default=7, help='Number of patches to crop for the local discriminator')
+    parser.add_argument('--compile', action='store_true', help='compile the networks and the losses with torch.compile (inductor, also on the CPU). The shapes are static, so every new input size compiles again')
+    parser.add_argument('--compile_mode', type=str, default='default', choices=['default', 'reduce-overhead', 'max-autotune'], help='mode of torch.compile: default, reduce-overhead (CUDA graphs) or max-autotune')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'fp16', 'bf16'], help='mixed precision: none, fp16 or bf16 (fp16 uses loss scaling)')
+    parser.add_argument('--use_store', action='store_true', help='read the images from the memory-mapped store written by preprocess.py instead of decoding them')
+    parser.add_argument('--store_dir', type=str, default='', help='where preprocess.py writes the store (defaults to data_source/store)')
+    parser.add_argument('--vgg_weights', type=str, default='vgg16.weight', help='path to the pretrained vgg16 weights (an empty string uses random weights, e.g. for benchmarking)')
+    parser.add_argument('--vgg_cache_mb', type=int, default=0, help='Size (in MB) of the host-memory cache of the vgg features of real_A (0 disables the cache)')
+    parser.add_argument('--fuse_vgg', action='store_true', help='pass the generated image and the target through the vgg network as a single batch')
+    parser.add_argument('--save_format', type=str, default='png', help='format of the saved images (png, jpg or webp)')
+    parser.add_argument('--save_compression', type=int, default=6, help='png compression level (0 is the fastest, 9 the smallest)')
+    parser.add_argument('--save_quality', type=int, default=95, help='jpg/webp quality')
+    parser.add_argument('--writer_workers', type=int, default=2, help='number of background workers that encode and write the images')
+    parser.add_argument('--writer_queue', type=int, default=16, help='maximum number of images waiting to be written (saving blocks when the queue is full)')
+    parser.add_argument('--writer_processes', action='store_true', help='encode the images in background processes instead of threads')
+    parser.add_argument('--image_cache_mb', type=int, default=0, help='Size (in MB) of the decoded-image cache kept by each DataLoader worker (0 disables the cache)')
     return parser
 
 
 def TrainingSetup(the_args):
     the_args.add_argument('--batch_size', type=int, default=8, help='input batch size (One of the aspects that can be used to control GPU requirements)')
     the_args.add_argument('--phase', type=str, default='train', help='train or test')
+    the_args.add_argument('--num_workers', type=int, default=6, help='number of DataLoader workers')
     the_args.add_argument('--niter', type=int, default=100, help='# of iter at starting learning rate')
     the_args.add_argument('--niter_decay', type=int, default=50, help='# of epochs to decay the learning rate')
+    the_args.add_argument('--resume', action='store_true', help='continue the training from the latest checkpoint (networks, optimizers, learning rate, epoch and random number generators)')
+    the_args.add_argument('--resolution_schedule', type=str, default='', help="train at lower resolutions first, e.g. '128:10,256:20,512' trains 10 epochs at 128x128, then 20 at 256x256 and the rest at 512x512 (the epochs after the listed stages are trained at crop_size)")
+    the_args.add_argument('--fused_disc', action='store_true', help='call every discriminator once per update on the real and fake samples, and use its predictions for both the generator and the discriminator loss')
+    the_args.add_argument('--prefetch', action='store_true', help='stage the next batch on the device (and transform it) while the model trains on the current one, and report the time spent waiting for the data after every epoch')
+    the_args.add_argument('--accum_steps', type=int, default=1, help='accumulate the gradients of this many batches before the weights are updated (the effective batch size is accum_steps * batch_size)')
     the_args.add_argument('--beta1', type=float, default=0.5, help='momentum term of Adam')
     the_args.add_argument('--lr', type=float, default=0.0001, help='initial learning rate for Adam')
     the_args.add_argument('--display_freq', type=int, default=30, help='frequency of showing training results on screen')
     the_args.add_argument('--print_freq', type=int, default=100, help='frequency of showing training results on console')
     the_args.add_argument('--save_epoch_freq', type=int, default=5, help='frequency of saving checkpoints at the end of epochs')
+    the_args.add_argument('--metrics_format', type=str, default='jsonl', choices=['jsonl', 'csv'], help='the metrics (losses, throughput, memory and learning rate) are logged to metrics.<format> in the checkpoint directory every print_freq steps')
+    the_args.add_argument('--metrics_flush_secs', type=int, default=30, help='the metrics are buffered and written to the file every this many seconds')
+    the_args.add_argument('--time_phases', type=int, default=0, help='time the phases of every training step (data wait, batch_transform (unless --prefetch), set_input, forward, backprops (or the fused backprop), optimizers) and report the mean every this many steps (0 disables the timers)')
+    the_args.add_argument('--profile_steps', type=str, default='', help='record a torch.profiler trace of the steps start:end (e.g. 10:15) and save it in the checkpoint directory')
     return the_args
 
 
 def TestingSetup(the_args):
     the_args.add_argument('--batch_size', type=int, default=1, help='input batch size (One of the aspects that can be used to control GPU requirements)')
     the_args.add_argument('--phase', type=str, default='test', help='train, val, test, etc')
+    the_args.add_argument('--num_workers', type=int, default=1, help='number of DataLoader workers')
+    the_args.add_argument('--keep_size', action='store_true', help='enhance the images at their native resolution, images of the same size are batched together (up to batch_size)')
+    the_args.add_argument('--tile_size', type=int, default=0, help='enhance the images at their native resolution in overlapping tiles of this size (0 resizes the images to crop_size instead)')
+    the_args.add_argument('--tile_overlap', type=int, default=64, help='overlap between neighbouring tiles (the seams are blended over this region)')
+    the_args.add_argument('--tile_memory_mb', type=int, default=2048, help='approximate memory budget for the tiles that are processed as one batch')
+    the_args.add_argument('--result_cache_mb', type=int, default=0, help='size (in MB) of the on-disk cache of the results: images that were already enhanced by the same generator (with the same options) are copied from the cache (0 disables the cache)')
+    the_args.add_argument('--result_cache_dir', type=str, default='', help='where the result cache is kept (defaults to checkpoints_dir/result_cache, which the experiments share)')
     return the_args
 
 
-def process(the_args):
-    opt = the_args.parse_args()
+def ExportSetup(the_args):
+    the_args.add_argument('--phase', type=str, default='test', help='train, val, test, etc')
+    the_args.add_argument('--batch_size', type=int, default=1, help='batch size of the example input that is used for the export (and the latency comparison)')
+    the_args.add_argument('--export_dir', type=str, default='', help='where the exported models are written (defaults to checkpoints_dir/name)')
+    the_args.add_argument('--onnx_opset', type=int, default=18, help='ONNX opset version')
+    the_args.add_argument('--export_tolerance', type=float, default=1e-4, help='maximum absolute difference between the outputs of the eager and exported models')
+    the_args.add_argument('--repeats', type=int, default=10, help='number of runs used to measure the latency')
+    return the_args
+
+
+def QuantizeSetup(the_args):
+    the_args.add_argument('--quant_mode', type=str, default='static', choices=['static', 'dynamic'], help='static: int8 weights and activations (calibrated on testA) | dynamic: int8 weights, the activations stay in floating point (there are no dynamically quantized convolutions in PyTorch)')
+    the_args.add_argument('--quant_backend', type=str, default='x86', help='x86 | fbgemm | qnnpack (ARM)')
+    the_args.add_argument('--keep_fp32', type=str, default='', help='comma separated names of the layers that are not quantized, e.g. model.model.down.0 (the names are listed in the manifest)')
+    the_args.add_argument('--calibration_images', type=int, default=32, help='number of testA images used to calibrate the activation ranges')
+    the_args.add_argument('--eval_images', type=int, default=16, help='number of testA images (after the calibration images) used to compare the int8 and fp32 generators')
+    the_args.add_argument('--min_psnr', type=float, default=30.0, help='fail if the PSNR of the int8 output (with respect to the fp32 output) is below this')
+    the_args.add_argument('--min_ssim', type=float, default=0.95, help='fail if the SSIM of the int8 output (with respect to the fp32 output) is below this')
+    the_args.add_argument('--export_dir', type=str, default='', help='where the quantized model and its manifest are written (defaults to checkpoints_dir/name)')
+    the_args.add_argument('--repeats', type=int, default=10, help='number of runs used to measure the latency')
+    return the_args
+
+
+def ServeSetup(the_args):
+    the_args.set_defaults(batch_size=8)  # The largest micro-batch
+    the_args.add_argument('--host', type=str, default='127.0.0.1', help='address the server listens on')
+    the_args.add_argument('--port', type=int, default=8000, help='port the server listens on')
+    the_args.add_argument('--max_wait_ms', type=float, default=5.0, help='a micro-batch is run once its first image has waited this long, even if it holds less than batch_size images')
+    the_args.add_argument('--max_queue', type=int, default=64, help='maximum number of images waiting for a micro-batch (the server answers 503 when the queue is full)')
+    the_args.add_argument('--stats_window', type=int, default=1000, help='number of the latest requests the latency percentiles of /stats are computed over')
+    return the_args
+
+
+def StreamSetup(the_args):
+    the_args.set_defaults(batch_size=4)  # The number of frames held at a time
+    the_args.add_argument('--input', type=str, required=True, help='a video file (needs opencv-python) or a directory of frames (sorted by name)')
+    the_args.add_argument('--output', type=str, required=True, help='a video file (e.g. .mp4, needs opencv-python) or a directory the enhanced frames are written to')
+    the_args.add_argument('--fps', type=float, default=0, help='frame rate of the output video (defaults to the frame rate of the input video, or 25 for a directory of frames)')
+    the_args.add_argument('--reuse_threshold', type=float, default=0.0, help='frames that differ from the last enhanced frame by less than this (mean absolute difference, pixels in [0,1]) reuse its enhancement (0 enhances every frame)')
+    the_args.add_argument('--reuse', type=str, default='residual', choices=['residual', 'output'], help='residual: add the difference between the output and the input of the last enhanced frame | output: repeat its output')
+    the_args.add_argument('--max_reuse', type=int, default=30, help='maximum number of frames in a row that reuse the same enhanced frame')
+    the_args.add_argument('--print_every', type=int, default=100, help='report the frames/sec and the skip ratio every this many frames')
+    return the_args
+
+
+def PreprocessSetup(the_args):
+    the_args.add_argument('--phase', type=str, default='train', help='train or test (which A/B sets to preprocess)')
+    the_args.add_argument('--shard_size', type=int, default=1024, help='number of images stored in every shard')
+    return the_args
+
+
+# Parses --resolution_schedule into the (size, last epoch) of every stage
+def parse_resolution_schedule(schedule, crop_size):
+    stages = []
+    last_epoch = 0
+    for stage in filter(None, schedule.split(',')):
+        size, _, epochs = stage.partition(':')
+        if not 0 < int(size) <= crop_size:
+            raise ValueError('The sizes of the resolution schedule have to be between 1 and crop_size (%d), got %s' % (crop_size, size))
+        last_epoch = last_epoch + int(epochs) if epochs else float('inf')  # A stage without a number of epochs lasts until the end
+        stages.append((int(size), last_epoch))
+    return stages
+
+
+def resolution_at(stages, epoch, crop_size):
+    for size, last_epoch in stages:
+        if epoch <= last_epoch:
+            return size
+    return crop_size
 
+
+# Decides on which device everything runs (opt.device) and configures the number of CPU threads
+def setup_device(opt):
     opt.gpu_ids = list(map(int, opt.gpu_ids.split(',')))
+    if opt.device == 'auto':
+        opt.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    opt.rank, opt.world_size = 0, 1
+    if opt.distributed:  # torchrun sets RANK, WORLD_SIZE and LOCAL_RANK (and where to find the other processes) for every process
+        opt.rank = int(os.environ['RANK'])
+        opt.world_size = int(os.environ['WORLD_SIZE'])
+        if opt.device == 'cuda':
+            opt.gpu_ids = [int(os.environ.get('LOCAL_RANK', 0))]  # Every process uses one GPU
+        torch.distributed.init_process_group(opt.dist_backend or ('nccl' if opt.device == 'cuda' else 'gloo'))
+    if opt.device == 'cuda':
+        opt.device = torch.device('cuda', opt.gpu_ids[0])
+        torch.cuda.set_device(opt.device)
+    else:
+        opt.device = torch.device(opt.device)
+
+    if opt.num_threads > 0:
+        torch.set_num_threads(opt.num_threads)
+    if opt.num_interop_threads > 0:
+        torch.set_num_interop_threads(opt.num_interop_threads)  # Has to happen before any inter-op parallel work is started
+    return opt
+
 
-    if len(opt.gpu_ids) > 0:
-        torch.cuda.set_device(opt.gpu_ids[0])
+def process(the_args):
+    opt = setup_device(the_args.parse_args())
+    if opt.rank != 0:  # Only the first process writes the configuration, the logs, the images and the checkpoints
+        return set_paths(opt)
     # below creates the necessary directories (for storing the results)
     args = vars(opt)
     if not os.path.isdir(opt.checkpoints_dir):
@@ -68,17 +201,23 @@ def process(the_args):
 
         opt_file.write('-------------- End ----------------\n')
         print('-------------- End ----------------')
-    if opt.phase == 'train':
-        opt.img_dir = os.path.join(opt.checkpoints_dir, opt.name, 'Training_IO')
-    else:
-        opt.img_dir = os.path.join(opt.checkpoints_dir, opt.name, 'Testing_IO')
+    set_paths(opt)
     print(opt.img_dir)
     if not os.path.isdir(opt.img_dir):
         os.mkdir(opt.img_dir)
-    opt.log_name = os.path.join(opt.checkpoints_dir, opt.name, 'loss_log.txt')
     with open(opt.log_name, "a") as log_file:
         now = time.strftime("%c")
         log_file.write('================ Training Loss (%s) ================\n' % now)
+    return opt
+
+
+# Where the images, the log and the models of the experiment are stored
+def set_paths(opt):
+    if opt.phase == 'train':
+        opt.img_dir = os.path.join(opt.checkpoints_dir, opt.name, 'Training_IO')
+    else:
+        opt.img_dir = os.path.join(opt.checkpoints_dir, opt.name, 'Testing_IO')
+    opt.log_name = os.path.join(opt.checkpoints_dir, opt.name, 'loss_log.txt')
     # Where models are stored
     opt.save_dir = os.path.join(opt.checkpoints_dir, opt.name)
     return opt
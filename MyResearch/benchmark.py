@@ -0,0 +1,1195 @@
+import argparse
+import json
+import multiprocessing
+import platform
+import sys
+import os
+import resource
+import shutil
+import tempfile
+import time
+import math
+import random
+import numpy as np
+from PIL import Image
+from collections import OrderedDict
+from Setup import DefaultSetup, TrainingSetup, setup_device
+
+# Benchmarks for the individual components of the pipeline. These only rely on synthetic data (and random weights),
+# so they can be run without the dataset or vgg16.weight, e.g. python benchmark.py loading --num_images 200
+# The suite times every component at several batch sizes and resolutions and can compare the results against a baseline:
+#   python benchmark.py suite --output baseline.json
+#   python benchmark.py suite --output current.json --baseline baseline.json   (or: python benchmark.py compare baseline.json current.json)
+
+
+# Parse the default training options (without creating the checkpoint directories like process() does)
+def make_opt(args=()):
+    return setup_device(TrainingSetup(DefaultSetup()).parse_args(list(args)))
+
+
+# Writes num_images random images into trainA and trainB of a temporary data_source
+def make_synthetic_dataset(num_images, image_size):
+    data_source = tempfile.mkdtemp(prefix='synthetic_')
+    rng = np.random.RandomState(0)
+    for folder in ['trainA', 'trainB']:
+        os.mkdir(os.path.join(data_source, folder))
+        for i in range(num_images):
+            pixels = rng.randint(0, 256, (image_size, image_size, 3), dtype=np.uint8)
+            Image.fromarray(pixels).save(os.path.join(data_source, folder, '%05d.png' % i))
+    return data_source
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # ru_maxrss is in KB on Linux
+
+
+# Runs in a fresh process so that the peak memory of the two loaders do not influence each other
+def time_loader(mode, data_source, image_cache_mb):
+    import ManageData
+    opt = make_opt(['--data_source', data_source, '--image_cache_mb', str(image_cache_mb)])
+    base_rss = peak_rss_mb()
+    start = time.time()
+    if mode == 'eager':
+        images = ManageData.import_dataset(os.path.join(data_source, 'trainA')) + ManageData.import_dataset(os.path.join(data_source, 'trainB'))
+        return time.time() - start, peak_rss_mb() - base_rss, 0.0
+
+    dataset = ManageData.FullDataset(opt)
+    startup = time.time() - start
+    start = time.time()
+    for i in range(len(dataset)):  # The lazy loader pays for the decoding here instead (spread over the workers)
+        dataset[i]
+    per_sample = (time.time() - start) / len(dataset)
+    return startup, peak_rss_mb() - base_rss, per_sample
+
+
+def bench_loading(args):
+    data_source = make_synthetic_dataset(args.num_images, args.image_size)
+    try:
+        context = multiprocessing.get_context('spawn')
+        print('%-8s %12s %16s %16s' % ('loader', 'startup (s)', 'memory (MB)', 'getitem (ms)'))
+        for mode in ['eager', 'lazy']:
+            with context.Pool(1) as pool:
+                startup, memory, per_sample = pool.apply(time_loader, (mode, data_source, args.image_cache_mb))
+            print('%-8s %12.3f %16.1f %16.2f' % (mode, startup, memory, per_sample * 1000))
+    finally:
+        shutil.rmtree(data_source)
+
+
+# The mean time of a run (after a warm-up run), also used by export.py and quantize.py
+def time_call(function, repeats):
+    import torch
+    function()  # Warm up
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for i in range(repeats):
+        function()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+# Assembles the parts of The_Model that are needed for the generator and discriminator losses, with random weights
+# (and a randomly initialized vgg network) so that vgg16.weight is not required
+def make_loss_model(opt, device):
+    import torch
+    import Networks
+    model = Networks.The_Model.__new__(Networks.The_Model)
+    model.init_state(opt)
+    model.vgg_loss = Networks.PerceptualLoss().to(device)
+    model.vgg = Networks.Vgg().to(device).eval()
+    for weights in model.vgg.parameters():
+        weights.requires_grad = False
+    model.G_Disc = Networks.PatchGAN(opt, False).to(device)
+    model.L_Disc = Networks.PatchGAN(opt, True).to(device)
+    model.G_Disc.apply(Networks.weights_init)
+    model.L_Disc.apply(Networks.weights_init)
+    model.model_loss = Networks.GANLoss()
+    model.input_A = torch.empty(0, device=device)
+    return model
+
+
+# The generator loss on the patches and the local discriminator loss as they were computed before the patches were batched
+# (one call of the local discriminator and the vgg network per patch)
+def looped_patch_losses(model):
+    opt = model.opt
+    w = model.real_A.size(3)
+    h = model.real_B.size(2)
+    fake_patch_list, real_patch_list, input_patch_list = [], [], []
+    for i in range(opt.num_patches):
+        w_offset = random.randint(0, max(0, w - opt.patch_size - 1))
+        h_offset = random.randint(0, max(0, h - opt.patch_size - 1))
+        fake_patch_list.append(model.fake_B[:, :, h_offset:h_offset + opt.patch_size, w_offset:w_offset + opt.patch_size])
+        real_patch_list.append(model.real_B[:, :, h_offset:h_offset + opt.patch_size, w_offset:w_offset + opt.patch_size])
+        input_patch_list.append(model.real_A[:, :, h_offset:h_offset + opt.patch_size, w_offset:w_offset + opt.patch_size])
+
+    gen_loss = 0
+    disc_loss = 0
+    for i in range(opt.num_patches):
+        gen_loss += model.model_loss(model.L_Disc(fake_patch_list[i]), True) / float(opt.num_patches)
+        gen_loss += model.vgg_loss.compute_vgg_loss(model.vgg, fake_patch_list[i], input_patch_list[i]) / float(opt.num_patches)
+        pred_real = model.L_Disc(real_patch_list[i])
+        pred_fake = model.L_Disc(fake_patch_list[i].detach())
+        disc_loss += (model.model_loss(pred_real, True) + model.model_loss(pred_fake, False)) * 0.5 / float(opt.num_patches)
+    return gen_loss, disc_loss
+
+
+# The same losses computed by The_Model on the stacked patches
+def batched_patch_losses(model):
+    model.fake_patches, model.real_patches, model.input_patches = model.crop_patches()
+    gen_loss = model.model_loss(model.L_Disc(model.fake_patches, model.real_A.size(0)), True)
+    gen_loss += model.vgg_loss.compute_vgg_loss(model.vgg, model.fake_patches, model.input_patches)
+    disc_loss = model.Shared_Disc_Backprop(model.L_Disc, model.real_patches, model.fake_patches, False)
+    return gen_loss, disc_loss
+
+
+def bench_patches(args):
+    import torch
+    device = make_opt().device
+    print('%-12s %14s %14s %10s %12s %12s' % ('num_patches', 'looped (ms)', 'batched (ms)', 'speedup', 'loss diff', 'grad diff'))
+    for num_patches in args.num_patches:
+        opt = make_opt(['--batch_size', str(args.batch_size), '--patch_size', str(args.patch_size), '--num_patches', str(num_patches)])
+        model = make_loss_model(opt, device)
+        model.real_A = torch.rand(args.batch_size, 3, args.image_size, args.image_size, device=device) * 2 - 1
+        model.real_B = torch.rand(args.batch_size, 3, args.image_size, args.image_size, device=device) * 2 - 1
+        model.fake_B = (torch.rand(args.batch_size, 3, args.image_size, args.image_size, device=device) * 2 - 1).requires_grad_()
+
+        results = {}
+        for name, losses in [('looped', looped_patch_losses), ('batched', batched_patch_losses)]:
+            random.seed(0)  # The same patches are cropped in both cases
+            gen_loss, disc_loss = losses(model)
+            model.fake_B.grad = None
+            model.L_Disc.zero_grad()
+            (gen_loss + disc_loss).backward()
+            results[name] = (torch.stack([gen_loss, disc_loss]).detach(), model.fake_B.grad.clone())
+
+            def step():
+                gen_loss, disc_loss = losses(model)
+                (gen_loss + disc_loss).backward()
+            results[name] += (time_call(step, args.repeats),)
+
+        loss_diff = (results['looped'][0] - results['batched'][0]).abs().max().item()
+        grad_diff = (results['looped'][1] - results['batched'][1]).abs().max().item()
+        print('%-12d %14.2f %14.2f %9.2fx %12.2e %12.2e' % (num_patches, results['looped'][2] * 1000, results['batched'][2] * 1000,
+                                                        results['looped'][2] / results['batched'][2], loss_diff, grad_diff))
+
+
+# Time compute_vgg_loss on the full images with the seperate, fused and cached (after the first epoch) vgg forwards
+def bench_vgg(args):
+    import torch
+    import Networks
+    device = make_opt().device
+    vgg = Networks.Vgg().to(device).eval()
+    for weights in vgg.parameters():
+        weights.requires_grad = False
+    targets = [torch.rand(args.batch_size, 3, args.image_size, args.image_size, device=device) * 2 - 1 for i in range(args.num_batches)]
+    images = [(target + 0.1 * torch.randn_like(target)).requires_grad_() for target in targets]
+    keys = [[(i * args.batch_size + j, 0) for j in range(args.batch_size)] for i in range(args.num_batches)]
+
+    modes = [('seperate', Networks.PerceptualLoss()), ('fused', Networks.PerceptualLoss(fuse=True)),
+             ('cached', Networks.PerceptualLoss(args.vgg_cache_mb * 1024 * 1024)), ('cached+fused', Networks.PerceptualLoss(args.vgg_cache_mb * 1024 * 1024, True))]
+    print('%-14s %14s %12s' % ('mode', 'per call (ms)', 'loss diff'))
+    reference = None
+    for name, vgg_loss in modes:
+        vgg_loss.to(device)
+        use_keys = vgg_loss.feature_cache is not None
+
+        def epoch():
+            losses = []
+            for image, target, key in zip(images, targets, keys):
+                loss = vgg_loss.compute_vgg_loss(vgg, image, target, key if use_keys else None)
+                loss.backward()
+                losses.append(loss.detach())
+            return torch.stack(losses)
+
+        losses = epoch()  # For the cached modes, this fills the cache (i.e. the first epoch)
+        if reference is None:
+            reference = losses
+        per_call = time_call(epoch, args.repeats) / args.num_batches
+        print('%-14s %14.2f %12.2e' % (name, per_call * 1000, (losses - reference).abs().max().item()))
+        if use_keys:
+            print('    cache: %d hits, %d misses, %.1f MB' % (vgg_loss.feature_cache.hits, vgg_loss.feature_cache.misses, vgg_loss.feature_cache.cur_bytes / 1024.0 / 1024.0))
+
+
+# A smooth, dark synthetic image with some texture (normalized to [-1,1])
+def make_large_image(height, width):
+    import torch
+    y = torch.linspace(0, 1, height).view(-1, 1)
+    x = torch.linspace(0, 1, width).view(1, -1)
+    channels = [0.3 * x * y, 0.2 * (1 - x) * y + 0.05 * torch.sin(40 * x), 0.25 * x * (1 - y) + 0.05 * torch.cos(30 * y)]
+    image = torch.stack([channel.expand(height, width) for channel in channels])
+    image = image + 0.02 * torch.randn(3, height, width, generator=torch.Generator().manual_seed(0))
+    return image.clamp(0, 1) * 2 - 1
+
+
+# Mean absolute horizontal/vertical gradient on the rows and columns where the tiles meet, relative to the mean gradient
+# of the whole image (a visible seam shows up as a ratio well above 1)
+def seam_ratio(image, tile_size, overlap):
+    from Inference import tile_starts
+    dx = (image[:, :, 1:] - image[:, :, :-1]).abs()
+    dy = (image[:, 1:, :] - image[:, :-1, :]).abs()
+    columns = sorted(set(start + offset for start in tile_starts(image.shape[2], tile_size, overlap)[1:] for offset in range(-1, overlap + 1) if 0 <= start + offset < dx.shape[2]))
+    rows = sorted(set(start + offset for start in tile_starts(image.shape[1], tile_size, overlap)[1:] for offset in range(-1, overlap + 1) if 0 <= start + offset < dy.shape[1]))
+    seams = []
+    if columns:
+        seams.append(dx[:, :, columns].mean() / dx.mean())
+    if rows:
+        seams.append(dy[:, rows, :].mean() / dy.mean())
+    return max(seams).item() if seams else 1.0
+
+
+# Throughput and seam quality of the tiled inference on a synthetic large image, compared with enhancing the whole
+# image at once (the peak memory of the latter grows with the size of the image)
+def bench_tiling(args):
+    import torch
+    import Networks
+    from Inference import TiledInference
+    device = make_opt().device
+    opt = make_opt(['--phase', 'test'])
+    generator = Networks.UnetGenerator(opt).to(device).eval()
+    generator.apply(Networks.weights_init)
+    image = make_large_image(args.height, args.width).unsqueeze(0)
+    megapixels = args.height * args.width / 1e6
+
+    full = TiledInference(generator, max(args.height, args.width), 0)
+    full_time = time_call(lambda: full(image), args.repeats)
+    reference = full(image)[0]
+    print('%-22s %12s %12s %14s %12s' % ('mode', 'time (s)', 'MP/s', 'diff to full', 'seam ratio'))
+    print('%-22s %12.2f %12.3f %14s %12.3f' % ('full image', full_time, megapixels / full_time, '-', seam_ratio(reference, args.tile_size, args.overlap)))
+    for overlap in sorted(set([0, args.overlap])):
+        tiler = TiledInference(generator, args.tile_size, overlap, args.tile_memory_mb)
+        tiled_time = time_call(lambda: tiler(image), args.repeats)
+        tiled = tiler(image)[0]
+        print('%-22s %12.2f %12.3f %14.2e %12.3f' % ('tiled (overlap %d)' % overlap, tiled_time, megapixels / tiled_time,
+                                                    (tiled - reference).abs().mean().item(), seam_ratio(tiled, args.tile_size, overlap)))
+    print('%d tiles per batch' % tiler.tile_batch)
+
+
+# Compares the generator output and the losses computed in mixed precision with the fp32 ones (same weights, inputs and patches)
+def bench_amp(args):
+    import torch
+    import Networks
+    device = make_opt().device
+    print('%-6s %12s %14s %14s %14s %14s' % ('amp', 'step (ms)', 'fake_B diff', 'Gen_loss diff', 'G_Disc diff', 'L_Disc diff'))
+    reference = None
+    for amp in ['none', args.amp]:
+        opt = make_opt(['--batch_size', str(args.batch_size), '--amp', amp])
+        torch.manual_seed(0)
+        model = make_loss_model(opt, device)
+        model.Gen = Networks.UnetGenerator(opt).to(device)
+        model.Gen.apply(Networks.weights_init)
+        model.input_A = torch.rand(args.batch_size, 3, args.image_size, args.image_size, device=device) * 2 - 1
+        model.input_B = torch.rand(args.batch_size, 3, args.image_size, args.image_size, device=device) * 2 - 1
+        model.input_A_gray = torch.rand(args.batch_size, 1, args.image_size, args.image_size, device=device)
+        model.input_keys = None
+
+        def step():
+            random.seed(0)
+            model.forward()
+            with model.autocast():
+                model.compute_Gen_loss()
+            model.Gen_loss.backward()
+            model.G_Disc_loss = model.Shared_Disc_Backprop(model.G_Disc, model.real_B, model.fake_B, True)
+            model.L_Disc_loss = model.Shared_Disc_Backprop(model.L_Disc, model.real_patches, model.fake_patches, False)
+            (model.G_Disc_loss + model.L_Disc_loss).backward()
+            return model.fake_B.detach().float(), torch.stack([model.Gen_loss.detach(), model.G_Disc_loss.detach(), model.L_Disc_loss.detach()])
+
+        outputs = step()
+        step_time = time_call(step, args.repeats)
+        if reference is None:
+            reference = outputs
+        loss_diff = ((outputs[1] - reference[1]).abs() / reference[1].abs()).tolist()  # Relative differences
+        print('%-6s %12.1f %14.2e %13.2f%% %13.2f%% %13.2f%%' % (amp, step_time * 1000, (outputs[0] - reference[0]).abs().max().item(),
+                                                              loss_diff[0] * 100, loss_diff[1] * 100, loss_diff[2] * 100))
+
+
+# Inference throughput of the generator on the CPU for different numbers of threads, memory formats and batch sizes
+def bench_cpu(args):
+    import torch
+    import Networks
+    print('%-8s %-16s %6s %14s' % ('threads', 'memory format', 'batch', 'images/sec'))
+    for num_threads in args.num_threads:
+        torch.set_num_threads(num_threads)
+        for channels_last in [False, True]:
+            opt = make_opt(['--device', 'cpu', '--phase', 'test', '--num_downs', str(args.num_downs)] + (['--channels_last'] if channels_last else []))
+            generator = Networks.make_G(opt).eval()
+            for batch_size in args.batch_size:
+                the_input = torch.rand(batch_size, 4, args.image_size, args.image_size) * 2 - 1
+                if channels_last:
+                    the_input = the_input.contiguous(memory_format=torch.channels_last)
+                with torch.no_grad():
+                    per_batch = time_call(lambda: generator(the_input), args.repeats)
+                print('%-8d %-16s %6d %14.2f' % (num_threads, 'channels_last' if channels_last else 'contiguous', batch_size, batch_size / per_batch))
+
+
+# One process of bench_ddp: the generator and the global discriminator are trained on this process' shard of a fixed batch
+def ddp_worker(rank, world_size, port, args, queue):
+    import torch
+    import Networks
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), RANK=str(rank), WORLD_SIZE=str(world_size))
+    per_process = args.batch_size // world_size
+    options = ['--device', 'cpu', '--batch_size', str(per_process), '--crop_size', str(args.image_size), '--num_downs', str(args.num_downs),
+               '--num_threads', str(max(1, args.num_threads // world_size))]
+    opt = make_opt(options + (['--distributed'] + (['--sync_bn'] if args.sync_bn else []) if world_size > 1 else []))
+    torch.manual_seed(0)
+    generator = Networks.make_G(opt)
+    discriminator = Networks.make_Disc(opt, False)
+    data = torch.Generator().manual_seed(1)
+    images = torch.rand(args.batch_size, 4, args.image_size, args.image_size, generator=data) * 2 - 1
+    real = torch.rand(args.batch_size, 3, args.image_size, args.image_size, generator=data) * 2 - 1
+    shard = slice(rank * per_process, (rank + 1) * per_process)
+
+    def step():
+        generator.zero_grad()
+        discriminator.zero_grad()
+        fake = generator(images[shard])
+        pred = discriminator(torch.cat([real[shard], fake], 0), per_process)  # Real and fake are normalized seperately
+        pred.float().pow(2).mean().backward()
+
+    step()
+    grads = torch.cat([p.grad.flatten() for p in list(generator.parameters()) + list(discriminator.parameters())])
+    step_time = time_call(step, args.repeats)
+    if rank == 0:
+        queue.put((grads, step_time))
+    if world_size > 1:
+        torch.distributed.destroy_process_group()
+
+
+# Gradients and step time of DistributedDataParallel (on local gloo processes) against a single process on the whole batch.
+# With --sync_bn, the gradients should be the same (without it, the batch normalization statistics only cover the shards)
+def bench_ddp(args):
+    import torch.multiprocessing as mp
+    context = mp.get_context('spawn')
+    print('%-10s %12s %14s %14s' % ('processes', 'step (ms)', 'images/sec', 'grad diff'))
+    reference = None
+    for world_size in [1] + args.world_sizes:
+        queue = context.SimpleQueue()
+        port = random.randint(20000, 40000)
+        processes = [context.Process(target=ddp_worker, args=(rank, world_size, port, args, queue)) for rank in range(world_size)]
+        for process in processes:
+            process.start()
+        grads, step_time = queue.get()
+        for process in processes:
+            process.join()
+        if reference is None:
+            reference = grads
+        diff = ((grads - reference).abs().max() / reference.abs().max()).item()  # Relative to the largest gradient
+        print('%-10d %12.1f %14.2f %14.2e' % (world_size, step_time * 1000, args.batch_size / step_time, diff))
+
+
+# One process of bench_accum: counts the all-reduce calls (of the gradient buckets) of every network in every training step
+def accum_worker(rank, world_size, port, args, queue):
+    import torch
+    import Networks
+    from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), RANK=str(rank), WORLD_SIZE=str(world_size))
+    opt = make_opt(['--device', 'cpu', '--distributed', '--batch_size', str(args.batch_size), '--crop_size', str(args.image_size), '--num_downs', str(args.num_downs),
+                    '--patch_size', str(args.image_size // 2), '--accum_steps', str(args.accum_steps), '--vgg_weights', '', '--num_threads', '1']
+                   + (['--fused_disc'] if args.fused_disc else []))
+    torch.manual_seed(0)
+    model = Networks.The_Model(opt)
+    counts = {}
+    for name in ['Gen', 'G_Disc', 'L_Disc']:
+        def hook(state, bucket, name=name):
+            counts[name] += 1
+            return default_hooks.allreduce_hook(state, bucket)
+        getattr(model, name).register_comm_hook(None, hook)
+
+    steps = []
+    for step in range(2 * args.accum_steps):
+        counts.update(Gen=0, G_Disc=0, L_Disc=0)
+        model.set_input({'A': torch.rand(args.batch_size, 3, args.image_size, args.image_size) * 2 - 1, 'B': torch.rand(args.batch_size, 3, args.image_size, args.image_size) * 2 - 1,
+                         'A_gray': torch.rand(args.batch_size, 1, args.image_size, args.image_size)})
+        model.perform_update()
+        steps.append((model.last_step, dict(counts)))
+    if rank == 0:
+        queue.put(steps)
+    torch.distributed.destroy_process_group()
+
+
+# Checks that with --distributed and --accum_steps, the gradients of the networks are only all-reduced on the last of the accumulated
+# batches (DistributedDataParallel decides this in the forward pass, so the forward has to be within no_sync as well)
+def bench_accum(args):
+    import torch.multiprocessing as mp
+    context = mp.get_context('spawn')
+    queue = context.SimpleQueue()
+    port = random.randint(20000, 40000)
+    processes = [context.Process(target=accum_worker, args=(rank, args.world_size, port, args, queue)) for rank in range(args.world_size)]
+    for process in processes:
+        process.start()
+    steps = queue.get()
+    for process in processes:
+        process.join()
+    failures = 0
+    print('%-6s %-10s %8s %8s %8s' % ('step', 'last', 'Gen', 'G_Disc', 'L_Disc'))
+    for step, (last_step, counts) in enumerate(steps):
+        # Without synchronization there are no all-reduces at all, on the last batch every network is all-reduced
+        ok = all(count > 0 for count in counts.values()) if last_step else not any(counts.values())
+        failures += not ok
+        print('%-6d %-10s %8d %8d %8d %s' % (step, last_step, counts['Gen'], counts['G_Disc'], counts['L_Disc'], '' if ok else 'FAIL'))
+    if failures > 0:
+        sys.exit(1)
+
+
+# One run of bench_checkpoint (in a fresh process). The memory of the activations is the size of the tensors that are saved for
+# the backward pass of the generator loss (the largest part of the peak memory, without the weights), on the GPU the peak allocated
+# memory of a whole training step is measured as well
+def checkpoint_worker(args, levels):
+    import torch
+    import Networks
+    opt = make_opt(['--device', args.device, '--batch_size', str(args.batch_size), '--crop_size', str(args.image_size), '--num_downs', str(args.num_downs),
+                    '--checkpoint_levels', str(levels), '--vgg_weights', ''])
+    torch.manual_seed(0)
+    model = Networks.The_Model(opt)
+    data = {'A': torch.rand(args.batch_size, 3, args.image_size, args.image_size) * 2 - 1, 'B': torch.rand(args.batch_size, 3, args.image_size, args.image_size) * 2 - 1,
+            'A_gray': torch.rand(args.batch_size, 1, args.image_size, args.image_size)}
+    model.set_input(data)
+
+    weights = set(p.untyped_storage().data_ptr() for network in [model.Gen, model.G_Disc, model.L_Disc, model.vgg] for p in network.parameters())
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in weights:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    random.seed(0)
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        model.forward()
+        with model.autocast():
+            model.compute_Gen_loss()
+    activations = sum(saved.values()) / 1024.0 / 1024.0
+    model.Gen_loss.backward()
+    grads = torch.stack([weights.grad.norm() for weights in model.Gen.parameters()])
+
+    peak = None
+    if opt.device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(opt.device)
+        model.perform_update()
+        peak = torch.cuda.max_memory_allocated(opt.device) / 1024.0 / 1024.0
+    step_time = time_call(model.perform_update, args.repeats)
+    return activations, peak, step_time, grads
+
+
+# Memory against step time of a training step (perform_update) for every number of checkpointed U-net levels
+def bench_checkpoint(args):
+    context = multiprocessing.get_context('spawn')
+    print('%-8s %16s %14s %12s %12s' % ('levels', 'activations (MB)', 'peak (MB)', 'step (ms)', 'grad diff'))
+    reference = None
+    for levels in args.levels:
+        with context.Pool(1) as pool:
+            activations, peak, step_time, grads = pool.apply(checkpoint_worker, (args, levels))
+        if reference is None:
+            reference = grads
+        print('%-8d %16.1f %14s %12.1f %12.2e' % (levels, activations, '-' if peak is None else '%.1f' % peak, step_time * 1000, (grads - reference).abs().max().item()))
+
+
+# The transformations as they used to be done per sample in the DataLoader workers (normalization, flips and illumination map), for comparison
+class PerSampleTransforms:
+    def __init__(self, dataset, augment):
+        self.dataset = dataset
+        self.augment = augment
+
+    def __getitem__(self, index):
+        import ManageData
+        sample = self.dataset[index]
+        flips = 0
+        for name in ['A', 'B']:
+            image = ManageData.normalize(sample[name])
+            if self.augment:
+                image, flip = ManageData.random_flips(image.unsqueeze(0))
+                image, flip = image[0], flip.item()
+                flips = flip if name == 'A' else flips
+            sample[name] = image
+        sample['A_gray'] = ManageData.illumination_map(sample['A'])
+        sample['flip'] = flips
+        return sample
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def batch_bytes(batch):
+    return sum(value.numel() * value.element_size() for value in batch.values() if hasattr(value, 'numel'))
+
+
+# Time per epoch (and the bytes of every batch that the workers send to the main process) of the transformations per sample in
+# the workers against the batch transformations (on the device) after collation. Without flips both give the same inputs
+def bench_transforms(args):
+    import torch
+    import ManageData
+    data_source = make_synthetic_dataset(args.num_images, args.image_size)
+    try:
+        opt = make_opt(['--data_source', data_source, '--crop_size', str(args.image_size), '--batch_size', str(args.batch_size), '--device', args.device])
+        dataset = ManageData.FullDataset(opt)
+        loader = lambda the_dataset: torch.utils.data.DataLoader(the_dataset, batch_size=args.batch_size, num_workers=args.num_workers, pin_memory=opt.device.type == 'cuda')
+        modes = [('per sample', loader(PerSampleTransforms(dataset, True)), lambda batch: {name: value.to(opt.device) if torch.is_tensor(value) else value for name, value in batch.items()}),
+                 ('per batch', loader(dataset), lambda batch: ManageData.prepare_batch(batch, opt.device, augment=True))]
+
+        print('%-12s %14s %16s' % ('transforms', 'epoch (ms)', 'batch (KB)'))
+        for name, the_loader, transform in modes:
+            def epoch():
+                for batch in the_loader:
+                    transform(batch)
+            print('%-12s %14.1f %16.1f' % (name, 1000 * time_call(epoch, args.repeats), batch_bytes(next(iter(the_loader))) / 1024.0))
+
+        reference = torch.utils.data.default_collate([PerSampleTransforms(dataset, False)[i] for i in range(args.batch_size)])
+        batch = ManageData.prepare_batch(torch.utils.data.default_collate([dataset[i] for i in range(args.batch_size)]), opt.device)
+        print('max abs diff (without flips): %.2e' % max((batch[name].cpu() - reference[name]).abs().max().item() for name in ['A', 'B', 'A_gray']))
+    finally:
+        shutil.rmtree(data_source)
+
+
+# Losses and gradients of one update with the fused discriminator forwards (--fused_disc) against the seperate generator and
+# discriminator backprops (both start from the same weights and use the same patches), and the time of an update with both
+def bench_fused(args):
+    import torch
+    import Networks
+    options = ['--device', args.device, '--batch_size', str(args.batch_size), '--crop_size', str(args.image_size), '--num_downs', str(args.num_downs),
+               '--patch_size', str(args.patch_size), '--vgg_weights', '']
+    data = synthetic_batch(make_opt(options))
+    models = OrderedDict()
+    for name, fused in [('seperate', []), ('fused', ['--fused_disc'])]:
+        torch.manual_seed(0)
+        models[name] = Networks.The_Model(make_opt(options + fused))
+        models[name].set_input(data)
+
+    results = OrderedDict()
+    for name, model in models.items():
+        random.seed(0)
+        model.perform_update()
+        losses = torch.tensor(list(model.get_model_errors(0).values()))
+        grads = [torch.cat([p.grad.flatten() for p in network.parameters() if p.grad is not None]) for network in [model.Gen, model.G_Disc, model.L_Disc]]
+        results[name] = (losses, grads)
+
+    (losses, grads), (fused_losses, fused_grads) = results.values()
+    print('%-12s %s' % ('losses', ' '.join('%10s' % key for key in models['seperate'].get_model_errors(0))))
+    for name, (model_losses, _) in results.items():
+        print('%-12s %s' % (name, ' '.join('%10.6f' % loss for loss in model_losses)))
+    print('max loss diff: %.2e' % (losses - fused_losses).abs().max().item())
+    for network, grad, fused_grad in zip(['Gen', 'G_Disc', 'L_Disc'], grads, fused_grads):
+        print('%-8s grad diff: %.2e (relative to the largest gradient)' % (network, ((grad - fused_grad).abs().max() / grad.abs().max()).item()))
+
+    print('%-12s %14s' % ('update', 'time (ms)'))
+    for name, model in models.items():
+        print('%-12s %14.1f' % (name, 1000 * time_call(model.perform_update, args.repeats)))
+
+
+# One run of bench_compile (in a fresh process): the time of the first training step (which includes the compilation), the
+# time of the following steps and of the inference, and the losses of the first step
+def compile_worker(args, compiled):
+    import torch
+    import Networks
+    opt = make_opt(['--device', args.device, '--batch_size', str(args.batch_size), '--crop_size', str(args.image_size), '--num_downs', str(args.num_downs),
+                    '--patch_size', str(args.patch_size), '--vgg_weights', ''] + (['--compile'] if compiled else []))
+    torch.manual_seed(0)
+    model = Networks.The_Model(opt)
+    model.set_input(synthetic_batch(opt))
+    random.seed(0)
+    start = time.perf_counter()
+    model.perform_update()
+    first_step = time.perf_counter() - start
+    losses = torch.tensor(list(model.get_model_errors(0).values()))
+    step_time = time_call(model.perform_update, args.repeats)
+
+    model.Gen.eval()
+    start = time.perf_counter()
+    model.predict()
+    first_predict = time.perf_counter() - start
+    predict_time = time_call(model.predict, args.repeats)
+    return first_step, step_time, first_predict, predict_time, losses
+
+
+# Compile time of --compile and the number of training steps (and inferences) after which it pays off, against eager
+def bench_compile(args):
+    context = multiprocessing.get_context('spawn')
+    results = OrderedDict()
+    for name, compiled in [('eager', False), ('compiled', True)]:
+        with context.Pool(1) as pool:
+            results[name] = pool.apply(compile_worker, (args, compiled))
+
+    print('%-10s %16s %12s %18s %14s' % ('mode', 'first step (s)', 'step (ms)', 'first predict (s)', 'predict (ms)'))
+    for name, (first_step, step_time, first_predict, predict_time, losses) in results.items():
+        print('%-10s %16.1f %12.1f %18.1f %14.1f' % (name, first_step, 1000 * step_time, first_predict, 1000 * predict_time))
+    eager, compiled = results['eager'], results['compiled']
+    print('max loss diff of the first step: %.2e' % (eager[4] - compiled[4]).abs().max().item())
+
+    # The compilation costs the extra time of the first call, which is paid back by the time saved on every following call
+    for label, first, steady in [('training steps', 0, 1), ('inferences', 2, 3)]:
+        compile_time = (compiled[first] - compiled[steady]) - (eager[first] - eager[steady])
+        saved = eager[steady] - compiled[steady]
+        if saved > 0:
+            print('%s: compiled in %.1f s, %.1fx faster, pays off after %d %s' % (label, compile_time, eager[steady] / compiled[steady], int(math.ceil(compile_time / saved)), label))
+        else:
+            print('%s: compiled in %.1f s, but not faster (%.2fx), it never pays off' % (label, compile_time, eager[steady] / compiled[steady]))
+
+
+# Writes num_images pairs of smooth images into trainA (dark) and trainB (bright), so that there is something to learn
+def make_paired_dataset(num_images, image_size):
+    data_source = tempfile.mkdtemp(prefix='paired_')
+    rng = np.random.RandomState(0)
+    for folder in ['trainA', 'trainB']:
+        os.mkdir(os.path.join(data_source, folder))
+    for i in range(num_images):
+        coarse = Image.fromarray(rng.randint(0, 256, (6, 6, 3), dtype=np.uint8))
+        bright = np.asarray(coarse.resize((image_size, image_size), Image.BICUBIC)).astype(np.float32) / 255.
+        dark = 0.5 * bright ** 2.2
+        Image.fromarray((bright * 255).astype(np.uint8)).save(os.path.join(data_source, 'trainB', '%05d.png' % i))
+        Image.fromarray((dark * 255).astype(np.uint8)).save(os.path.join(data_source, 'trainA', '%05d.png' % i))
+    return data_source
+
+
+# Trains from scratch with the given resolution schedule and returns the (epoch, size, training time, loss) after every epoch.
+# The loss is the L1 distance between the enhanced images and their bright counterparts, always at the full resolution
+def train_with_schedule(args, data_source, schedule):
+    import torch
+    import ManageData
+    import Networks
+    from Setup import parse_resolution_schedule, resolution_at
+    opt = make_opt(['--data_source', data_source, '--crop_size', str(args.image_size), '--num_downs', str(args.num_downs), '--patch_size', str(args.patch_size),
+                    '--batch_size', str(args.batch_size), '--num_workers', '0', '--vgg_weights', '', '--device', args.device, '--resolution_schedule', schedule])
+    torch.manual_seed(0)
+    random.seed(0)
+    data_loader = ManageData.DataLoader(opt)
+    model = Networks.The_Model(opt)
+    eval_set = ManageData.FullDataset(opt)
+    eval_batch = ManageData.prepare_batch(torch.utils.data.default_collate([eval_set[i] for i in range(min(args.eval_images, len(eval_set)))]), opt.device)
+    stages = parse_resolution_schedule(schedule, opt.crop_size)
+
+    def evaluate():
+        generator = model.Gen.module
+        generator.set_resolution(opt.crop_size)
+        generator.eval()
+        with torch.no_grad():
+            loss = (generator(torch.cat([eval_batch['A'], eval_batch['A_gray']], 1)) - eval_batch['B']).abs().mean().item()
+        generator.set_resolution(model.resolution)
+        generator.train()
+        return loss
+
+    curve = []
+    elapsed = 0.0
+    for epoch in range(1, args.epochs + 1):
+        size = resolution_at(stages, epoch, opt.crop_size)
+        if size != model.resolution:
+            data_loader.set_size(size)
+            model.set_resolution(size)
+        start = time.perf_counter()
+        for data in data_loader.load():
+            model.set_input(data)
+            model.perform_update()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        elapsed += time.perf_counter() - start
+        curve.append((epoch, size, elapsed, evaluate()))
+    return curve
+
+
+def time_to_target(curve, target):
+    return next((elapsed for epoch, size, elapsed, loss in curve if loss <= target), None)
+
+
+# Wall-clock training time until the loss at full resolution reaches the targets, with a fixed resolution against the schedules
+# (by default, the targets are the losses of the fixed resolution after half, three quarters and all of the epochs, plus the tolerance)
+def bench_progressive(args):
+    data_source = make_paired_dataset(args.num_images, args.image_size)
+    try:
+        context = multiprocessing.get_context('spawn')
+        curves = OrderedDict()
+        for schedule in [''] + args.schedules:  # Every run starts in a fresh process
+            with context.Pool(1) as pool:
+                curves[schedule or 'fixed'] = pool.apply(train_with_schedule, (args, data_source, schedule))
+    finally:
+        shutil.rmtree(data_source)
+
+    fixed = curves['fixed']
+    targets = args.target_loss or [fixed[epochs - 1][3] * (1 + args.tolerance) for epochs in sorted(set([len(fixed) // 2 or 1, 3 * len(fixed) // 4 or 1, len(fixed)]))]
+    print('%-24s %8s %8s %12s %10s' % ('schedule', 'epoch', 'size', 'time (s)', 'loss'))
+    for name, curve in curves.items():
+        for epoch, size, elapsed, loss in curve:
+            print('%-24s %8d %8d %12.1f %10.4f' % (name, epoch, size, elapsed, loss))
+    for target in targets:
+        print('\nTime to reach a loss of %.4f:' % target)
+        reference = time_to_target(fixed, target)
+        for name, curve in curves.items():
+            reached = time_to_target(curve, target)
+            if reached is None:
+                print('%-24s not reached in %d epochs (%.1f s)' % (name, args.epochs, curve[-1][2]))
+            else:
+                print('%-24s %8.1f s %8.2fx' % (name, reached, reference / reached if reference else float('nan')))
+
+
+# Time per epoch of the training loop with and without the Prefetcher (--prefetch), and the time the loop spent waiting for the
+# data (without the prefetcher, this includes the batch transformations). The first epoch is a warm-up
+def bench_prefetch(args):
+    import torch
+    import Networks
+    import ManageData
+    data_source = make_synthetic_dataset(args.num_images, args.image_size)
+    try:
+        opt = make_opt(['--data_source', data_source, '--device', args.device, '--batch_size', str(args.batch_size), '--crop_size', str(args.image_size),
+                        '--num_downs', str(args.num_downs), '--patch_size', str(args.patch_size), '--num_workers', str(args.num_workers), '--vgg_weights', ''])
+        the_model = Networks.The_Model(opt)
+        loader = ManageData.DataLoader(opt).load()
+
+        print('%-12s %14s %14s %14s' % ('loader', 'epoch (s)', 'data wait (s)', 'images/sec'))
+        for name, prefetch in [('plain', False), ('prefetch', True)]:
+            for epoch in range(args.epochs + 1):
+                batches = ManageData.Prefetcher(loader, opt.device, augment=True) if prefetch else loader
+                stall_time = 0.0
+                start = data_start = time.perf_counter()
+                for data in batches:
+                    if not prefetch:
+                        data = ManageData.prepare_batch(data, opt.device, augment=True)
+                        stall_time += time.perf_counter() - data_start
+                    the_model.set_input(data)
+                    the_model.perform_update()
+                    data_start = time.perf_counter()
+                if opt.device.type == 'cuda':
+                    torch.cuda.synchronize()
+                elapsed = time.perf_counter() - start
+                if prefetch:
+                    stall_time = batches.stall_time
+            print('%-12s %14.2f %14.2f %14.1f' % (name, elapsed, stall_time, args.num_images / elapsed))
+    finally:
+        shutil.rmtree(data_source)
+
+
+# A synthetic surveillance clip: a noisy static scene (a new one every scene_length frames) with a small square moving across it
+def make_clip(num_frames, height, width, scene_length):
+    import torch
+    generator = torch.Generator().manual_seed(0)
+    scenes = [torch.randint(0, 120, (3, height, width), generator=generator) for _ in range(0, num_frames, scene_length)]
+    for i in range(num_frames):
+        frame = scenes[i // scene_length].clone()
+        left = (2 * i) % (width - height // 6)
+        frame[:, height // 2:height // 2 + height // 6, left:left + height // 6] = 200
+        frame = frame + torch.randint(-2, 3, frame.shape, generator=generator)  # Sensor noise
+        yield 'frame%06d' % i, frame.clamp(0, 255).to(torch.uint8)
+
+
+# Frames/sec, skip ratio and PSNR (with respect to enhancing every frame) of the streaming enhancement (see stream.py) for
+# several reuse thresholds, on a synthetic clip
+def bench_stream(args):
+    import torch
+    import Networks
+    from ManageData import illumination_map
+    from Inference import TemporalReuse
+    opt = make_opt(['--phase', 'test', '--device', args.device, '--num_downs', str(args.num_downs)])
+    generator = Networks.UnetGenerator(opt).to(opt.device).eval()
+    generator.apply(Networks.weights_init)
+
+    def enhance(images):
+        with torch.no_grad():
+            images = images.to(opt.device)
+            return generator(torch.cat([images, illumination_map(images)], 1)).float().cpu()
+
+    clip = lambda: make_clip(args.num_frames, args.height, args.width, args.scene_length)
+    reference = None
+    print('%-10s %-10s %12s %12s %12s' % ('threshold', 'reuse', 'frames/sec', 'skip ratio', 'PSNR (dB)'))
+    for threshold in [0.0] + [threshold for threshold in args.thresholds if threshold > 0]:
+        for mode in (['residual', 'output'] if threshold > 0 else ['-']):
+            reuse = TemporalReuse(enhance, args.batch_size, threshold, mode if threshold > 0 else 'residual', args.max_reuse)
+            start = time.perf_counter()
+            outputs = [enhanced for _, enhanced, _ in reuse(clip())]
+            elapsed = time.perf_counter() - start
+            if reference is None:
+                reference = outputs
+            mse = sum(((output - ref) / 2).pow(2).mean().item() for output, ref in zip(outputs, reference)) / len(outputs)  # The frames are in [-1,1]
+            print('%-10g %-10s %12.2f %12.2f %12s' % (threshold, mode, len(outputs) / elapsed, reuse.skip_ratio, 'inf' if mse == 0 else '%.2f' % (10 * math.log10(1 / mse))))
+
+
+# One client of the load test: posts the image num_requests times over a kept-alive connection and returns the latencies
+# (the requests that failed are counted as None)
+def serve_client(url, body, num_requests):
+    import http.client
+    from urllib.parse import urlparse
+    address = urlparse(url)
+    connection = http.client.HTTPConnection(address.hostname, address.port or 80, timeout=300)
+    latencies = []
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        try:
+            connection.request('POST', '/enhance', body, {'Content-Type': 'application/octet-stream'})
+            response = connection.getresponse()
+            response.read()
+            latencies.append(time.perf_counter() - start if response.status == 200 else None)
+        except (OSError, http.client.HTTPException):
+            latencies.append(None)
+            connection.close()  # Reconnects with the next request
+    connection.close()
+    return latencies
+
+
+def server_stats(url):
+    import urllib.request
+    with urllib.request.urlopen(url.rstrip('/') + '/stats') as response:
+        return json.loads(response.read())
+
+
+# Load test of a running server (see serve.py): for every number of concurrent clients, the throughput and the latency
+# percentiles measured by the clients, and the mean micro-batch size and queue wait reported by the server
+def bench_serve(args):
+    import io
+    from concurrent.futures import ThreadPoolExecutor
+    from Monitor import percentile
+    if args.image:
+        with open(args.image, 'rb') as image_file:
+            body = image_file.read()
+    else:
+        encoded = io.BytesIO()
+        Image.fromarray(np.random.RandomState(0).randint(0, 256, (args.image_size, args.image_size, 3), dtype=np.uint8)).save(encoded, format='PNG')
+        body = encoded.getvalue()
+    serve_client(args.url, body, 1)  # Warm-up
+
+    print('%8s %10s %12s %10s %10s %10s %12s %10s' % ('clients', 'requests', 'requests/s', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'batch size', 'errors'))
+    for clients in args.clients:
+        per_client = max(1, args.requests // clients)
+        before = server_stats(args.url)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(clients) as executor:
+            results = list(executor.map(lambda _: serve_client(args.url, body, per_client), range(clients)))
+        elapsed = time.perf_counter() - start
+        after = server_stats(args.url)
+        batch_size = (after['served'] - before['served']) / float(max(after['batches'] - before['batches'], 1))
+        latencies = [1000 * latency for result in results for latency in result if latency is not None] or [float('nan')]
+        errors = sum(latency is None for result in results for latency in result)
+        print('%8d %10d %12.1f %10.1f %10.1f %10.1f %12.2f %10d' % (clients, clients * per_client, (clients * per_client - errors) / elapsed, percentile(latencies, 50),
+                                                                   percentile(latencies, 90), percentile(latencies, 99), batch_size, errors))
+
+
+# The time of every run (after a warm-up run)
+def time_runs(function, repeats):
+    import torch
+    function()
+    times = []
+    for i in range(repeats):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        function()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def synthetic_batch(opt):
+    import torch
+    size = (opt.batch_size, 3, opt.crop_size, opt.crop_size)
+    input_A = torch.rand(size) * 2 - 1
+    return {'A': input_A, 'B': torch.rand(size) * 2 - 1, 'A_gray': torch.rand(opt.batch_size, 1, opt.crop_size, opt.crop_size),
+            'index': torch.arange(opt.batch_size), 'flip': torch.zeros(opt.batch_size, dtype=torch.long)}
+
+
+# Every component returns a function that runs it once (a forward and backward pass for the trainable parts)
+def component_getitem(opt):
+    import torch
+    import ManageData
+    dataset = ManageData.FullDataset(opt)
+    return lambda: torch.utils.data.default_collate([dataset[i % len(dataset)] for i in range(opt.batch_size)])
+
+
+def component_batch_transform(opt):
+    import torch
+    import ManageData
+    dataset = ManageData.FullDataset(opt)
+    batch = torch.utils.data.default_collate([dataset[i % len(dataset)] for i in range(opt.batch_size)])
+    return lambda: ManageData.prepare_batch(batch, opt.device, augment=True)
+
+
+def component_generator(opt):
+    import torch
+    import Networks
+    generator = Networks.make_G(opt)
+    the_input = torch.rand(opt.batch_size, 4, opt.crop_size, opt.crop_size, device=opt.device) * 2 - 1
+    return lambda: generator(the_input).mean().backward()
+
+
+# The discriminators see the real and fake samples as one batch, like in Shared_Disc_Backprop
+def component_global_disc(opt):
+    import torch
+    import Networks
+    discriminator = Networks.make_Disc(opt, False)
+    the_input = torch.rand(2 * opt.batch_size, 3, opt.crop_size, opt.crop_size, device=opt.device) * 2 - 1
+    return lambda: discriminator(the_input, opt.batch_size).mean().backward()
+
+
+def component_local_disc(opt):
+    import torch
+    import Networks
+    discriminator = Networks.make_Disc(opt, True)
+    the_input = torch.rand(2 * opt.batch_size * opt.num_patches, 3, opt.patch_size, opt.patch_size, device=opt.device) * 2 - 1
+    return lambda: discriminator(the_input, opt.batch_size).mean().backward()
+
+
+def component_vgg_loss(opt):
+    import torch
+    import Networks
+    vgg = Networks.load_vgg(opt).eval()
+    for weights in vgg.parameters():
+        weights.requires_grad = False
+    vgg_loss = Networks.PerceptualLoss().to(opt.device)
+    target = torch.rand(opt.batch_size, 3, opt.crop_size, opt.crop_size, device=opt.device) * 2 - 1
+    image = (target + 0.1 * torch.randn_like(target)).requires_grad_()
+    return lambda: vgg_loss.compute_vgg_loss(vgg, image, target).backward()
+
+
+def component_update(opt):
+    import Networks
+    model = Networks.The_Model(opt)
+    model.set_input(synthetic_batch(opt))
+    return model.perform_update
+
+
+def component_predict(opt):
+    import Networks
+    model = Networks.The_Model(opt)
+    model.Gen.eval()
+    model.set_input(synthetic_batch(opt))
+    return model.predict
+
+
+COMPONENTS = OrderedDict([('getitem', component_getitem), ('batch_transform', component_batch_transform), ('generator', component_generator), ('global_disc', component_global_disc),
+                          ('local_disc', component_local_disc), ('vgg_loss', component_vgg_loss), ('update', component_update), ('predict', component_predict)])
+
+
+def bench_suite(args):
+    import torch
+    results = []
+    print('%-12s %6s %6s %14s %14s' % ('component', 'batch', 'size', 'median (ms)', 'min (ms)'))
+    for image_size in args.image_sizes:
+        data_source = make_synthetic_dataset(args.num_images, image_size)
+        try:
+            for batch_size in args.batch_sizes:
+                opt = make_opt(['--device', args.device, '--data_source', data_source, '--batch_size', str(batch_size), '--crop_size', str(image_size),
+                                '--num_downs', str(args.num_downs), '--patch_size', str(args.patch_size), '--num_patches', str(args.num_patches), '--vgg_weights', ''])
+                for name in args.components:
+                    torch.manual_seed(0)
+                    random.seed(0)
+                    times = sorted(time_runs(COMPONENTS[name](opt), args.repeats))
+                    result = OrderedDict([('component', name), ('batch_size', batch_size), ('image_size', image_size),
+                                          ('median_ms', 1000 * times[len(times) // 2]), ('min_ms', 1000 * times[0]), ('runs', len(times))])
+                    results.append(result)
+                    print('%-12s %6d %6d %14.2f %14.2f' % (name, batch_size, image_size, result['median_ms'], result['min_ms']))
+        finally:
+            shutil.rmtree(data_source)
+
+    report = OrderedDict([('torch', torch.__version__), ('device', str(make_opt(['--device', args.device]).device)), ('num_threads', torch.get_num_threads()),
+                          ('platform', platform.platform()), ('date', time.strftime('%Y-%m-%d %H:%M:%S')), ('num_downs', args.num_downs), ('results', results)])
+    with open(args.output, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    print('Saved %s' % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare_reports(baseline, report, args.threshold) > 0:
+            sys.exit(1)
+
+
+# Prints the relative change of every component that is in both reports, and returns the number of regressions (i.e. the
+# median became more than threshold slower)
+def compare_reports(baseline, current, threshold):
+    key = lambda result: (result['component'], result['batch_size'], result['image_size'])
+    baseline_results = {key(result): result for result in baseline['results']}
+    if baseline.get('device') != current.get('device') or baseline.get('torch') != current.get('torch'):
+        print('Warning: the baseline was measured with torch %s on %s' % (baseline.get('torch'), baseline.get('device')))
+    regressions = 0
+    print('%-12s %6s %6s %14s %14s %9s' % ('component', 'batch', 'size', 'baseline (ms)', 'current (ms)', 'change'))
+    for result in current['results']:
+        reference = baseline_results.get(key(result))
+        if reference is None:
+            continue
+        change = result['median_ms'] / reference['median_ms'] - 1
+        flag = ''
+        if change > threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif change < -threshold:
+            flag = 'faster'
+        print('%-12s %6d %6d %14.2f %14.2f %+8.1f%% %s' % (result['component'], result['batch_size'], result['image_size'],
+                                                         reference['median_ms'], result['median_ms'], change * 100, flag))
+    print('%d regression(s) (threshold %.0f%%)' % (regressions, threshold * 100))
+    return regressions
+
+
+def bench_compare(args):
+    with open(args.baseline) as baseline_file, open(args.current) as current_file:
+        if compare_reports(json.load(baseline_file), json.load(current_file), args.threshold) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    loading = subparsers.add_parser('loading', help='startup time and memory of the eager loader vs the lazy FullDataset')
+    loading.add_argument('--num_images', type=int, default=100)
+    loading.add_argument('--image_size', type=int, default=1024)
+    loading.add_argument('--image_cache_mb', type=int, default=0)
+    loading.set_defaults(run=bench_loading)
+
+    patches = subparsers.add_parser('patches', help='time (and check the equivalence of) the looped vs batched patch losses')
+    patches.add_argument('--num_patches', type=int, nargs='+', default=[1, 3, 7, 14])
+    patches.add_argument('--batch_size', type=int, default=2)
+    patches.add_argument('--image_size', type=int, default=256)
+    patches.add_argument('--patch_size', type=int, default=32)
+    patches.add_argument('--repeats', type=int, default=5)
+    patches.set_defaults(run=bench_patches)
+
+    vgg = subparsers.add_parser('vgg', help='time the perceptual loss with the seperate, fused and cached vgg forwards')
+    vgg.add_argument('--batch_size', type=int, default=2)
+    vgg.add_argument('--image_size', type=int, default=256)
+    vgg.add_argument('--num_batches', type=int, default=4)
+    vgg.add_argument('--vgg_cache_mb', type=int, default=1024)
+    vgg.add_argument('--repeats', type=int, default=2)
+    vgg.set_defaults(run=bench_vgg)
+
+    tiling = subparsers.add_parser('tiling', help='throughput and seam quality of the tiled inference on a synthetic large image')
+    tiling.add_argument('--height', type=int, default=1024)
+    tiling.add_argument('--width', type=int, default=1536)
+    tiling.add_argument('--tile_size', type=int, default=512)
+    tiling.add_argument('--overlap', type=int, default=64)
+    tiling.add_argument('--tile_memory_mb', type=int, default=2048)
+    tiling.add_argument('--repeats', type=int, default=1)
+    tiling.set_defaults(run=bench_tiling)
+
+    amp = subparsers.add_parser('amp', help='parity (and step time) of mixed precision against fp32')
+    amp.add_argument('--amp', type=str, default='bf16')
+    amp.add_argument('--batch_size', type=int, default=2)
+    amp.add_argument('--image_size', type=int, default=256)
+    amp.add_argument('--repeats', type=int, default=2)
+    amp.set_defaults(run=bench_amp)
+
+    cpu = subparsers.add_parser('cpu', help='inference throughput of the generator on the CPU')
+    cpu.add_argument('--num_threads', type=int, nargs='+', default=[1, os.cpu_count()])
+    cpu.add_argument('--batch_size', type=int, nargs='+', default=[1, 4])
+    cpu.add_argument('--image_size', type=int, default=512)
+    cpu.add_argument('--num_downs', type=int, default=9)
+    cpu.add_argument('--repeats', type=int, default=3)
+    cpu.set_defaults(run=bench_cpu)
+
+    ddp = subparsers.add_parser('ddp', help='gradient parity and step time of DistributedDataParallel (local gloo processes) against a single process')
+    ddp.add_argument('--world_sizes', type=int, nargs='+', default=[2])
+    ddp.add_argument('--batch_size', type=int, default=4, help='the total batch size, which is split over the processes')
+    ddp.add_argument('--image_size', type=int, default=128)
+    ddp.add_argument('--num_downs', type=int, default=7)
+    ddp.add_argument('--num_threads', type=int, default=os.cpu_count(), help='the threads are split over the processes')
+    ddp.add_argument('--sync_bn', action='store_true')
+    ddp.add_argument('--repeats', type=int, default=3)
+    ddp.set_defaults(run=bench_ddp)
+
+    accum = subparsers.add_parser('accum', help='check that with --distributed, the accumulated gradients are only all-reduced on the last batch (local gloo processes)')
+    accum.add_argument('--world_size', type=int, default=2)
+    accum.add_argument('--accum_steps', type=int, default=3)
+    accum.add_argument('--batch_size', type=int, default=2, help='the batch size per process')
+    accum.add_argument('--image_size', type=int, default=64)
+    accum.add_argument('--num_downs', type=int, default=5)
+    accum.add_argument('--fused_disc', action='store_true')
+    accum.set_defaults(run=bench_accum)
+
+    checkpoint = subparsers.add_parser('checkpoint', help='peak memory against step time of a training step for every number of checkpointed U-net levels')
+    checkpoint.add_argument('--levels', type=int, nargs='+', default=[0, 1, 2, 3, 5])
+    checkpoint.add_argument('--batch_size', type=int, default=2)
+    checkpoint.add_argument('--image_size', type=int, default=256)
+    checkpoint.add_argument('--num_downs', type=int, default=8)
+    checkpoint.add_argument('--device', type=str, default='auto')
+    checkpoint.add_argument('--repeats', type=int, default=2)
+    checkpoint.set_defaults(run=bench_checkpoint)
+
+    transforms = subparsers.add_parser('transforms', help='epoch time and batch size of the transformations per sample (in the workers) vs per batch (on the device)')
+    transforms.add_argument('--num_images', type=int, default=64)
+    transforms.add_argument('--image_size', type=int, default=256)
+    transforms.add_argument('--batch_size', type=int, default=8)
+    transforms.add_argument('--num_workers', type=int, default=2)
+    transforms.add_argument('--device', type=str, default='auto')
+    transforms.add_argument('--repeats', type=int, default=2)
+    transforms.set_defaults(run=bench_transforms)
+
+    fused = subparsers.add_parser('fused', help='check that the fused discriminator forwards give the same losses and gradients, and time both')
+    fused.add_argument('--batch_size', type=int, default=2)
+    fused.add_argument('--image_size', type=int, default=128)
+    fused.add_argument('--num_downs', type=int, default=7)
+    fused.add_argument('--patch_size', type=int, default=32)
+    fused.add_argument('--device', type=str, default='auto')
+    fused.add_argument('--repeats', type=int, default=3)
+    fused.set_defaults(run=bench_fused)
+
+    compiled = subparsers.add_parser('compile', help='compile time of --compile and after how many training steps (and inferences) it pays off, against eager')
+    compiled.add_argument('--batch_size', type=int, default=2)
+    compiled.add_argument('--image_size', type=int, default=128)
+    compiled.add_argument('--num_downs', type=int, default=7)
+    compiled.add_argument('--patch_size', type=int, default=32)
+    compiled.add_argument('--device', type=str, default='auto')
+    compiled.add_argument('--repeats', type=int, default=5)
+    compiled.set_defaults(run=bench_compile)
+
+    progressive = subparsers.add_parser('progressive', help='training time to reach a target loss with a fixed resolution against resolution schedules')
+    progressive.add_argument('--schedules', type=str, nargs='+', default=['16:4,32:4'], help='see --resolution_schedule')
+    progressive.add_argument('--epochs', type=int, default=12)
+    progressive.add_argument('--num_images', type=int, default=16)
+    progressive.add_argument('--eval_images', type=int, default=4)
+    progressive.add_argument('--image_size', type=int, default=64)
+    progressive.add_argument('--num_downs', type=int, default=6)
+    progressive.add_argument('--patch_size', type=int, default=16)
+    progressive.add_argument('--batch_size', type=int, default=4)
+    progressive.add_argument('--target_loss', type=float, nargs='*', default=[], help='by default, the losses of the fixed resolution after 1/2, 3/4 and all of the epochs (plus the tolerance)')
+    progressive.add_argument('--tolerance', type=float, default=0.05)
+    progressive.add_argument('--device', type=str, default='auto')
+    progressive.set_defaults(run=bench_progressive)
+
+    prefetch = subparsers.add_parser('prefetch', help='epoch time and data wait of the training loop with and without the prefetcher')
+    prefetch.add_argument('--num_images', type=int, default=32)
+    prefetch.add_argument('--image_size', type=int, default=128)
+    prefetch.add_argument('--num_downs', type=int, default=7)
+    prefetch.add_argument('--patch_size', type=int, default=32)
+    prefetch.add_argument('--batch_size', type=int, default=4)
+    prefetch.add_argument('--num_workers', type=int, default=0)
+    prefetch.add_argument('--epochs', type=int, default=1)
+    prefetch.add_argument('--device', type=str, default='auto')
+    prefetch.set_defaults(run=bench_prefetch)
+
+    stream = subparsers.add_parser('stream', help='frames/sec, skip ratio and PSNR of the streaming enhancement for several reuse thresholds')
+    stream.add_argument('--thresholds', type=float, nargs='+', default=[0.01, 0.03], help='the sensor noise of the clip alone gives a difference of about 0.006')
+    stream.add_argument('--max_reuse', type=int, default=30)
+    stream.add_argument('--num_frames', type=int, default=60)
+    stream.add_argument('--scene_length', type=int, default=30)
+    stream.add_argument('--height', type=int, default=240)
+    stream.add_argument('--width', type=int, default=320)
+    stream.add_argument('--num_downs', type=int, default=7)
+    stream.add_argument('--batch_size', type=int, default=4)
+    stream.add_argument('--device', type=str, default='auto')
+    stream.set_defaults(run=bench_stream)
+
+    serve = subparsers.add_parser('serve', help='load test of a running server (serve.py): throughput and latency for several numbers of concurrent clients')
+    serve.add_argument('--url', type=str, default='http://127.0.0.1:8000')
+    serve.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16])
+    serve.add_argument('--requests', type=int, default=64, help='per number of clients')
+    serve.add_argument('--image', type=str, default='', help='the image that is posted (by default a random image of image_size)')
+    serve.add_argument('--image_size', type=int, default=256)
+    serve.set_defaults(run=bench_serve)
+
+    suite = subparsers.add_parser('suite', help='time every component at several batch sizes and resolutions and write the results to a JSON file')
+    suite.add_argument('--components', type=str, nargs='+', default=list(COMPONENTS), choices=list(COMPONENTS))
+    suite.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4])
+    suite.add_argument('--image_sizes', type=int, nargs='+', default=[128, 256])
+    suite.add_argument('--num_downs', type=int, default=7, help='the images are padded to a multiple of 2^num_downs')
+    suite.add_argument('--patch_size', type=int, default=32)
+    suite.add_argument('--num_patches', type=int, default=7)
+    suite.add_argument('--num_images', type=int, default=8, help='size of the synthetic dataset for getitem')
+    suite.add_argument('--device', type=str, default='auto')
+    suite.add_argument('--repeats', type=int, default=5)
+    suite.add_argument('--output', type=str, default='benchmark.json')
+    suite.add_argument('--baseline', type=str, default='', help='compare the results against this earlier report (exits with 1 on a regression)')
+    suite.add_argument('--threshold', type=float, default=0.1, help='a component regressed if its median time grew by more than this fraction')
+    suite.set_defaults(run=bench_suite)
+
+    compare = subparsers.add_parser('compare', help='compare two reports of the suite (exits with 1 on a regression)')
+    compare.add_argument('baseline', type=str)
+    compare.add_argument('current', type=str)
+    compare.add_argument('--threshold', type=float, default=0.1)
+    compare.set_defaults(run=bench_compare)
+
+    args = parser.parse_args()
+    args.run(args)
@@ -0,0 +1,78 @@
+from Setup import *
+from ManageData import illumination_map
+import Networks
+from benchmark import time_call
+from collections import OrderedDict
+import copy
+import sys
+
+# Exports the latest generator for deployment: the batch normalization layers are folded into the convolutions and the result
+# is saved as TorchScript (and as ONNX, if the onnx package is installed). Both are checked against the eager generator.
+# e.g. python export.py --name MyExperiment --crop_size 512 --num_downs 9
+# (the ONNX graph has a fixed input size of batch_size x 4 x crop_size x crop_size, since the padding is traced for that size)
+
+
+def export_onnx(model, the_input, path, opset):
+    try:
+        import onnx  # Only needed for the export
+    except ImportError:
+        print('onnx is not installed, skipping the ONNX export')
+        return False
+    with torch.no_grad():
+        torch.onnx.export(model, (the_input,), path, input_names=['input'], output_names=['output'], opset_version=opset)
+    onnx.checker.check_model(onnx.load(path))
+    return True
+
+
+def run_onnx(path, the_input):
+    try:
+        import onnxruntime
+    except ImportError:
+        print('onnxruntime is not installed, the ONNX model is not checked')
+        return None
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    the_input = the_input.cpu().numpy()
+    return lambda _: torch.from_numpy(session.run(None, {'input': the_input})[0])
+
+
+opt = setup_device(ExportSetup(DefaultSetup()).parse_args())  # Nothing is written to the experiment apart from the exported models
+opt.save_dir = os.path.join(opt.checkpoints_dir, opt.name)
+export_dir = opt.export_dir or opt.save_dir
+os.makedirs(export_dir, exist_ok=True)
+
+checkpoint = Networks.latest_checkpoint(opt.save_dir, 'Gener')
+generator = Networks.make_G(opt)
+generator.load_state_dict(torch.load(checkpoint, map_location=opt.device))
+eager = generator.module.eval()  # Strip DataParallel/SingleDevice, the exported model is a plain UnetGenerator
+folded = Networks.fold_batchnorm(copy.deepcopy(eager))
+print('Loaded %s' % checkpoint)
+
+image = torch.rand(opt.batch_size, 3, opt.crop_size, opt.crop_size, device=opt.device) * 2 - 1
+example = torch.cat([image, illumination_map(image)], 1)  # The generator expects the image and its illumination map
+with torch.no_grad():
+    reference = eager(example)
+
+models = OrderedDict([('eager', eager), ('folded', folded)])
+script_path = os.path.join(export_dir, 'Gener.pt')
+torch.jit.script(folded).save(script_path)
+models['torchscript'] = torch.jit.load(script_path, map_location=opt.device)
+print('Saved %s' % script_path)
+
+onnx_path = os.path.join(export_dir, 'Gener.onnx')
+if export_onnx(folded, example, onnx_path, opt.onnx_opset):
+    print('Saved %s' % onnx_path)
+    onnx_model = run_onnx(onnx_path, example)
+    if onnx_model is not None:
+        models['onnxruntime'] = onnx_model
+
+failed = False
+print('%-12s %14s %14s' % ('model', 'max abs diff', 'latency (ms)'))
+for label, model in models.items():
+    with torch.no_grad():
+        diff = (model(example).to(opt.device) - reference).abs().max().item()
+        latency = time_call(lambda: model(example), opt.repeats)  # The first run of a scripted model also optimizes it (time_call warms up)
+    failed = failed or diff > opt.export_tolerance
+    print('%-12s %14.2e %14.2f' % (label, diff, 1000 * latency))
+
+if failed:
+    sys.exit('The exported models differ from the eager generator by more than %g' % opt.export_tolerance)
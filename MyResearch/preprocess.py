@@ -0,0 +1,12 @@
+from Setup import *
+from ManageData import build_store, store_directory
+
+# Decodes and resizes the images of a phase once and stores them as memory-mapped uint8 shards (see ManageData.build_store)
+# Afterwards, pass --use_store to train.py/test.py so that only the flips and the normalization are performed every epoch
+
+opt = PreprocessSetup(DefaultSetup()).parse_args()
+folders = [opt.phase + 'A', opt.phase + 'B'] if opt.phase == 'train' else [opt.phase + 'A']
+for folder in folders:
+    start = time.time()
+    index = build_store(opt, os.path.join(opt.data_source, folder), store_directory(opt, folder))
+    print('%s: %d images stored in %d shards (%.1f sec)' % (folder, index['count'], len(index['shards']), time.time() - start))
@@ -0,0 +1,164 @@
+from Setup import *
+from ManageData import FullDataset, illumination_map, normalize
+from torch.ao.quantization import quantize_fx
+import torch.nn.functional as F
+import torch.nn as nn
+from collections import OrderedDict
+import Networks
+from benchmark import time_call
+import copy
+import json
+import math
+import sys
+
+# Post-training int8 quantization of the latest generator for CPU serving. The quantized generator is saved as TorchScript
+# (Gener_int8.pt) together with a manifest of the per-layer choices, and it is compared with the fp32 generator on a few
+# testA images: the script fails if the PSNR or SSIM of the int8 output (with respect to the fp32 output) is too low.
+# e.g. python quantize.py --name MyExperiment --crop_size 512 --num_downs 9 --keep_fp32 model.model.down.0,model.model.up.3
+
+
+# The convolutions keep float inputs and outputs, only their weights are stored as (per-channel) int8 and dequantized on the fly
+class WeightOnlyConv2d(nn.Module):
+    def __init__(self, conv):
+        super(WeightOnlyConv2d, self).__init__()
+        scale = conv.weight.detach().abs().amax(dim=(1, 2, 3)).clamp(min=1e-8) / 127
+        self.register_buffer('qweight', torch.round(conv.weight.detach() / scale.view(-1, 1, 1, 1)).to(torch.int8))
+        self.register_buffer('scale', scale)
+        self.bias = None if conv.bias is None else nn.Parameter(conv.bias.detach().clone())
+        self.stride, self.padding, self.dilation, self.groups = conv.stride, conv.padding, conv.dilation, conv.groups
+
+    def forward(self, x):
+        weight = self.qweight.float() * self.scale.view(-1, 1, 1, 1)
+        return F.conv2d(x, weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
+
+
+def quantize_dynamic(generator, keep_fp32):
+    for name, module in list(generator.named_modules()):
+        if isinstance(module, nn.Conv2d) and name not in keep_fp32:
+            parent, child = name.rsplit('.', 1)
+            setattr(generator.get_submodule(parent), child, WeightOnlyConv2d(module))
+    return generator
+
+
+# Only the U-net itself is quantized (the padding depends on the size of the input, so it cannot be traced)
+def quantize_static(generator, keep_fp32, calibration, backend):
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = torch.ao.quantization.get_default_qconfig_mapping(backend)
+    for name in keep_fp32:
+        qconfig_mapping.set_module_name(name[len('model.'):], None)  # The names are relative to the U-net
+    example = calibration[0][:, 0:3]
+    prepared = quantize_fx.prepare_fx(generator.model, qconfig_mapping, (example,))
+    with torch.no_grad():
+        for images in calibration:  # The observers record the range of every activation
+            prepared(Networks.add_padding(images, generator.multiple)[0][:, 0:3])
+    generator.model = quantize_fx.convert_fx(prepared)
+    return generator
+
+
+def describe_layers(fp32_generator, int8_generator, keep_fp32):
+    int8_modules = dict(int8_generator.named_modules())
+    layers = []
+    for name, module in fp32_generator.named_modules():
+        if not isinstance(module, nn.Conv2d):
+            continue
+        layer = {'layer': name, 'in_channels': module.in_channels, 'out_channels': module.out_channels}
+        quantized = int8_modules.get(name)
+        if name in keep_fp32 or quantized is None or isinstance(quantized, nn.Conv2d):
+            layer['mode'] = 'fp32'
+        elif isinstance(quantized, WeightOnlyConv2d):
+            layer.update(mode='dynamic', weight_dtype='int8', weight_qscheme='per_channel_symmetric')
+        else:
+            layer.update(mode='static', weight_dtype='int8', weight_qscheme=str(quantized.weight().qscheme()),
+                         activation_dtype='uint8', activation_scale=float(quantized.scale), activation_zero_point=int(quantized.zero_point))
+        layers.append(layer)
+    return layers
+
+
+def psnr(output, reference):
+    mse = ((output - reference) / 2).pow(2).mean().item()  # The images are in [-1,1]
+    return float('inf') if mse == 0 else 10 * math.log10(1 / mse)
+
+
+# SSIM with a gaussian window (11x11, sigma 1.5), averaged over the channels
+def ssim(output, reference):
+    output, reference = (output + 1) / 2, (reference + 1) / 2
+    coords = torch.arange(11, dtype=torch.float32) - 5
+    gauss = torch.exp(-coords ** 2 / (2 * 1.5 ** 2))
+    gauss = gauss / gauss.sum()
+    window = (gauss.view(-1, 1) * gauss.view(1, -1)).expand(output.size(1), 1, 11, 11)
+    blur = lambda x: F.conv2d(x, window, groups=output.size(1))
+    mu_x, mu_y = blur(output), blur(reference)
+    var_x = blur(output * output) - mu_x ** 2
+    var_y = blur(reference * reference) - mu_y ** 2
+    cov = blur(output * reference) - mu_x * mu_y
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (var_x + var_y + c2))
+    return ssim_map.mean().item()
+
+
+def batches(dataset, indices, batch_size):
+    for i in range(0, len(indices), batch_size):
+        images = normalize(torch.stack([dataset[j]['A'] for j in indices[i:i + batch_size]]))
+        yield torch.cat([images, illumination_map(images)], 1)  # The generator expects the image and its illumination map
+
+
+opt = setup_device(QuantizeSetup(TestingSetup(DefaultSetup())).parse_args())  # Nothing is written to the experiment apart from the quantized model
+opt.device = torch.device('cpu')  # The quantized kernels only run on the CPU
+opt.save_dir = os.path.join(opt.checkpoints_dir, opt.name)
+export_dir = opt.export_dir or opt.save_dir
+os.makedirs(export_dir, exist_ok=True)
+keep_fp32 = [name for name in opt.keep_fp32.split(',') if name]
+
+checkpoint = Networks.latest_checkpoint(opt.save_dir, 'Gener')
+generator = Networks.make_G(opt)
+generator.load_state_dict(torch.load(checkpoint, map_location=opt.device))
+fp32_generator = Networks.fold_batchnorm(generator.module.eval())
+print('Loaded %s' % checkpoint)
+
+dataset = FullDataset(opt)
+num_calibration = min(opt.calibration_images, len(dataset))
+calibration_indices = list(range(num_calibration))
+eval_indices = list(range(num_calibration, min(num_calibration + opt.eval_images, len(dataset))))
+if not eval_indices:  # Not enough images to keep them seperate, the calibration images are also used for the evaluation
+    eval_indices = calibration_indices
+
+start_time = time.time()
+if opt.quant_mode == 'static':
+    calibration = list(batches(dataset, calibration_indices, opt.batch_size))
+    int8_generator = quantize_static(copy.deepcopy(fp32_generator), keep_fp32, calibration, opt.quant_backend)
+else:
+    int8_generator = quantize_dynamic(copy.deepcopy(fp32_generator), keep_fp32)
+print('Quantized the generator (%s) in %.1f sec' % (opt.quant_mode, time.time() - start_time))
+
+scripted = torch.jit.script(int8_generator)
+script_path = os.path.join(export_dir, 'Gener_int8.pt')
+scripted.save(script_path)
+print('Saved %s' % script_path)
+
+psnrs, ssims = [], []
+with torch.no_grad():
+    for the_input in batches(dataset, eval_indices, opt.batch_size):
+        reference, output = fp32_generator(the_input), scripted(the_input)
+        for out, ref in zip(output, reference):
+            psnrs.append(psnr(out.unsqueeze(0), ref.unsqueeze(0)))
+            ssims.append(ssim(out.unsqueeze(0), ref.unsqueeze(0)))
+the_input = next(batches(dataset, eval_indices, opt.batch_size))
+with torch.no_grad():
+    fp32_latency = time_call(lambda: fp32_generator(the_input), opt.repeats)
+    int8_latency = time_call(lambda: scripted(the_input), opt.repeats)
+
+metrics = OrderedDict([('psnr', min(psnrs)), ('ssim', min(ssims)), ('mean_psnr', sum(psnrs) / len(psnrs)), ('mean_ssim', sum(ssims) / len(ssims)),
+                       ('fp32_latency_ms', 1000 * fp32_latency), ('int8_latency_ms', 1000 * int8_latency), ('speedup', fp32_latency / int8_latency)])
+passed = metrics['psnr'] >= opt.min_psnr and metrics['ssim'] >= opt.min_ssim
+manifest = OrderedDict([('checkpoint', checkpoint), ('mode', opt.quant_mode), ('backend', opt.quant_backend), ('calibration_images', len(calibration_indices) if opt.quant_mode == 'static' else 0),
+                        ('eval_images', len(eval_indices)), ('input_size', list(the_input.shape)), ('metrics', metrics), ('passed', passed),
+                        ('layers', describe_layers(fp32_generator, int8_generator, keep_fp32))])
+manifest_path = os.path.join(export_dir, 'Gener_int8.json')
+with open(manifest_path, 'w') as manifest_file:
+    json.dump(manifest, manifest_file, indent=2)
+print('Saved %s' % manifest_path)
+
+print('PSNR: %.2f dB (mean %.2f)   SSIM: %.4f (mean %.4f)   (worst image of %d, with respect to the fp32 generator)' % (metrics['psnr'], metrics['mean_psnr'], metrics['ssim'], metrics['mean_ssim'], len(eval_indices)))
+print('Latency: fp32 %.1f ms   int8 %.1f ms   speedup %.2fx' % (metrics['fp32_latency_ms'], metrics['int8_latency_ms'], metrics['speedup']))
+if not passed:
+    sys.exit('The quality of the int8 generator is below the threshold (PSNR >= %g dB, SSIM >= %g)' % (opt.min_psnr, opt.min_ssim))
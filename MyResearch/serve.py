@@ -0,0 +1,88 @@
+from Setup import *
+from ManageData import TensorToImages, config_transforms, normalize, save_options
+from Inference import MicroBatcher, enhance, load_generator
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image
+import queue
+import json
+import sys
+import io
+
+# A resident enhancement service: the latest generator is loaded once (without the discriminators and vgg) and the images that
+# the clients post are enhanced in micro-batches (see MicroBatcher), so concurrent requests share the forward passes.
+# e.g. python serve.py --name MyExperiment --crop_size 512 --num_downs 9 --batch_size 8 --max_wait_ms 5
+#   curl --data-binary @image.png http://127.0.0.1:8000/enhance > enhanced.png   (any format PIL can read, the result is save_format)
+#   curl http://127.0.0.1:8000/stats   (queue depth, batch sizes and latency percentiles of the latest stats_window requests)
+# The load test of benchmark.py runs against a running server: python benchmark.py serve --url http://127.0.0.1:8000 --clients 16
+
+CONTENT_TYPES = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+
+# Enhances a batch of uint8 images (Nx3xHxW) and returns them as uint8 arrays (HxWx3)
+def enhance_images(images):
+    return TensorToImages(enhance(generator, normalize(images.to(opt.device, non_blocking=True)), opt))  # Transferred as uint8
+
+
+class EnhanceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keeps the connections of the clients alive between requests
+
+    def do_POST(self):
+        if self.path != '/enhance':
+            return self.reply(404, {'error': 'unknown path %s' % self.path})
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            image = transform(Image.open(io.BytesIO(body)).convert('RGB'))
+        except Exception as error:
+            return self.reply(400, {'error': 'could not decode the image: %s' % error})
+        try:
+            result = batcher.submit(image)
+        except queue.Full:
+            return self.reply(503, {'error': 'the queue is full'})
+        try:
+            enhanced = result.result()
+        except Exception as error:
+            return self.reply(500, {'error': str(error)})
+        encoded = io.BytesIO()
+        Image.fromarray(enhanced).save(encoded, **options)  # Encoded in the thread of the request, in parallel to the next batch
+        self.reply(200, encoded.getvalue(), CONTENT_TYPES[opt.save_format])
+
+    def do_GET(self):
+        if self.path == '/stats':
+            return self.reply(200, batcher.stats())
+        if self.path == '/health':
+            return self.reply(200, {'status': 'ok'})
+        self.reply(404, {'error': 'unknown path %s' % self.path})
+
+    def reply(self, code, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # A line per request would slow the server down, see /stats instead
+
+
+opt = setup_device(ServeSetup(TestingSetup(DefaultSetup())).parse_args())  # Nothing is written to the experiment
+opt.save_dir = os.path.join(opt.checkpoints_dir, opt.name)
+if opt.tile_size > 0:
+    sys.exit('--tile_size is not supported by the server, use --keep_size to enhance the images at their native resolution')
+generator = load_generator(opt)
+transform = config_transforms(opt)
+options = save_options(opt.save_format, opt.save_compression, opt.save_quality)
+if not opt.keep_size:  # Warm-up (and with --compile, the compilation) before the first request
+    enhance_images(torch.zeros(1, 3, opt.crop_size, opt.crop_size, dtype=torch.uint8))
+
+batcher = MicroBatcher(enhance_images, opt.batch_size, opt.max_wait_ms / 1000.0, opt.max_queue, opt.stats_window)
+server = ThreadingHTTPServer((opt.host, opt.port), EnhanceHandler)
+server.daemon_threads = True
+print('Serving on http://%s:%d (POST /enhance, GET /stats)' % (opt.host, opt.port))
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+server.server_close()
+batcher.close()  # Finish the images that are still queued
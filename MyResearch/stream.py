@@ -0,0 +1,118 @@
+from Setup import *
+from ManageData import TensorToImages, config_transforms, make_dataset, make_writer
+from Inference import TemporalReuse, TiledInference, enhance, load_generator
+from PIL import Image
+import sys
+
+# Enhances a video (or a directory of frames) as a stream: the frames are read one at a time, enhanced in small batches and
+# written out right away, so the memory does not depend on the length of the video. Nearly static frames can reuse the
+# enhancement of the previous enhanced frame (see TemporalReuse and --reuse_threshold).
+# e.g. python stream.py --name MyExperiment --crop_size 512 --num_downs 9 --keep_size --input night.mp4 --output night_enhanced.mp4 --reuse_threshold 0.01
+# (without --keep_size or --tile_size the frames are resized to crop_size x crop_size, like test.py does)
+
+VIDEO_CODECS = {'.mp4': 'mp4v', '.mov': 'mp4v', '.avi': 'XVID', '.mkv': 'XVID', '.webm': 'VP80'}
+
+
+def import_cv2():
+    try:
+        import cv2  # Only needed for video files
+    except ImportError:
+        sys.exit('opencv-python is needed to read and write video files (pip install opencv-python), a directory of frames works without it')
+    return cv2
+
+
+def is_video(path):
+    return os.path.splitext(path)[1].lower() in VIDEO_CODECS
+
+
+# Yields the (name, frame) pairs of the input (the frames are uint8 tensors of shape 3xHxW), reading one frame at a time
+def read_frames(source, transform):
+    if os.path.isdir(source):
+        for path in make_dataset(source):
+            yield os.path.basename(path), transform(Image.open(path).convert('RGB'))
+        return
+    cv2 = import_cv2()
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        sys.exit('Could not open %s' % source)
+    try:
+        index = 0
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield 'frame%06d' % index, transform(Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+            index += 1
+    finally:
+        capture.release()
+
+
+def frame_rate(source):
+    if opt.fps > 0:
+        return opt.fps
+    if os.path.isdir(source):
+        return 25.0
+    cv2 = import_cv2()
+    capture = cv2.VideoCapture(source)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+    return fps or 25.0
+
+
+# Writes the frames (HxWx3 uint8 arrays) to a video file, which gets the size of the first frame
+class VideoWriter:
+    def __init__(self, path, fps):
+        self.cv2 = import_cv2()
+        self.path = path
+        self.fps = fps
+        self.writer = None
+
+    def save(self, image, name):
+        if self.writer is None:
+            fourcc = self.cv2.VideoWriter_fourcc(*VIDEO_CODECS[os.path.splitext(self.path)[1].lower()])
+            self.writer = self.cv2.VideoWriter(self.path, fourcc, self.fps, (image.shape[1], image.shape[0]))
+        self.writer.write(self.cv2.cvtColor(image, self.cv2.COLOR_RGB2BGR))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+
+
+# Writes the frames to a directory, under the name of their input frame (encoded in the background by the ImageWriter)
+class FrameWriter:
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.writer = make_writer(opt)
+
+    def save(self, image, name):
+        self.writer.save(image, os.path.join(self.directory, '%s.%s' % (os.path.splitext(name)[0], self.writer.extension)))
+
+    def close(self):
+        self.writer.close()
+
+
+# Enhances a batch of normalized frames (on the host) and returns the enhanced frames (also on the host)
+def enhance_frames(images):
+    if tiler is not None:
+        return tiler(images)
+    return enhance(generator, images, opt).float().cpu()
+
+
+opt = setup_device(StreamSetup(TestingSetup(DefaultSetup())).parse_args())  # Nothing is written to the experiment
+opt.save_dir = os.path.join(opt.checkpoints_dir, opt.name)
+generator = load_generator(opt)
+tiler = TiledInference(generator, opt.tile_size, opt.tile_overlap, opt.tile_memory_mb, opt.amp) if opt.tile_size > 0 else None
+writer = VideoWriter(opt.output, frame_rate(opt.input)) if is_video(opt.output) else FrameWriter(opt.output)
+reuse = TemporalReuse(enhance_frames, opt.batch_size, opt.reuse_threshold, opt.reuse, opt.max_reuse)
+
+start_time = time.time()
+for name, enhanced, reused in reuse(read_frames(opt.input, config_transforms(opt))):
+    writer.save(TensorToImages(enhanced.unsqueeze(0))[0], name)
+    if reuse.frames % opt.print_every == 0:
+        print('%d frames, %.2f frames/sec, skip ratio %.2f' % (reuse.frames, reuse.frames / max(time.time() - start_time, 1e-9), reuse.skip_ratio))
+writer.close()  # Wait until all the frames have been written
+
+elapsed = time.time() - start_time
+print('Enhanced %d frames in %.1f sec (%.2f frames/sec), %d frames reused the previous enhancement (skip ratio %.2f)'
+      % (reuse.frames, elapsed, reuse.frames / max(elapsed, 1e-9), reuse.reused, reuse.skip_ratio))
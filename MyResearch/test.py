@@ -1,27 +1,74 @@
 from Setup import *
-from ManageData import DataLoader
+from ManageData import DataLoader, ResultCache, TensorToImages, make_writer, normalize
+from Checkpoints import state_dict_hash
+from Inference import TiledInference
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import Networks
-import glob
-import PIL
-from PIL import Image
+import json
 
+LABELS = ['real_A', 'fake_B']
 
-def save_images(images,title,phase='train'):
-    the_title= title.split('.')
+
+def image_path(title, label):
+    return os.path.join(opt.img_dir, '%s_%s-Enh.%s' % (os.path.splitext(title)[0], label, opt.save_format))
+
+
+# The images are encoded and written in the background by the writer (or by the result cache, which also keeps them)
+def save_images(images,title,phase='train',key=None):
+    if key is not None:
+        cache.save(key, OrderedDict((label, (image, image_path(title, label))) for label, image in images.items()))
+        return
     for label,image in images.items():# .items() extracts the "packages" from the dictionary
-        img_path=os.path.join(opt.img_dir,'%s_%s-Enh.png'%(the_title[0],label)) #
-        image_pil=Image.fromarray(image)
-        image_pil.save(img_path)
+        writer.save(image,image_path(title,label))
+
+
+# The result cache knows the images that were enhanced by the same generator (with the same options) in an earlier run. Their
+# results are copied from the cache and only the other images are loaded and enhanced
+def make_cache():
+    settings = OrderedDict((name, getattr(opt, name)) for name in ['crop_size', 'keep_size', 'tile_size', 'tile_overlap', 'amp', 'save_format', 'save_compression', 'save_quality'])
+    salt = state_dict_hash(model.Gen.state_dict()) + json.dumps(settings)
+    return ResultCache(opt.result_cache_dir or os.path.join(opt.checkpoints_dir, 'result_cache'), opt.result_cache_mb * 1024 * 1024, salt,
+                       opt.save_format, opt.save_compression, opt.save_quality, opt.writer_workers, opt.writer_queue)
 
 
 opt = process(TestingSetup(DefaultSetup())) # Parse the testing options that will be used
 data_loader=DataLoader(opt) # Load the testing dataloader (this is different to the training dataloader since we no longer perform data-augmentation)
-dataset=data_loader.load()
+dataset=data_loader.load() # The images are batched in buckets of images with the same size
 model=Networks.The_Model(opt)
-file_names = [os.path.basename(x) for x in glob.glob(str(opt.data_source)+"/testA/*")]
-print(len(dataset))
+tiler = TiledInference(model.Gen, opt.tile_size, opt.tile_overlap, opt.tile_memory_mb, opt.amp) if opt.tile_size > 0 else None  # For images at their native resolution
+writer=make_writer(opt)
+cache = make_cache() if opt.result_cache_mb > 0 else None
+keys = None
+start_time = time.time()
+if cache is not None:
+    images = data_loader.dataset
+    with ThreadPoolExecutor(8) as executor:  # Reading (and hashing) the files is mostly I/O
+        keys = list(executor.map(lambda index: cache.key(images.raw_bytes(index)), range(len(images))))
+    misses = [index for index, key in enumerate(keys) if not cache.restore(key, OrderedDict((label, image_path(images.name(index), label)) for label in LABELS))]
+    data_loader.set_indices(misses)
+    dataset = data_loader.load()
+print(len(data_loader))
+
+num_images = 0
 for i,data in enumerate(dataset):
-    model.set_input(data) # Put the loaded data into the correct data containers
-    model.predict()
-    print("Processing: "+str(file_names[i]))
-    save_images(model.for_displaying_images(),file_names[i],phase='test')
+    if tiler is not None:
+        real_A = normalize(data['A'])
+        fake_B = tiler(real_A)  # The (possibly very large) image stays on the host, only the tiles are moved to the GPU
+    else:
+        model.set_input(data) # Put the loaded data into the correct data containers
+        model.predict()
+        real_A, fake_B = model.real_A, model.fake_B
+    # Every sample carries its own file name, so the results are always saved under the name of their input
+    for index, name, real, fake in zip(data['index'].tolist(), data['name'], TensorToImages(real_A), TensorToImages(fake_B)):
+        print("Processing: "+str(name))
+        save_images(OrderedDict([('real_A', real), ('fake_B', fake)]),name,phase='test',key=None if keys is None else keys[index])
+    num_images += len(data['name'])
+writer.close()  # Wait until all the images have been written
+if cache is not None:
+    cache.close()
+
+elapsed = time.time() - start_time
+print('Enhanced %d images in %.1f sec (%.2f images/sec)' % (num_images, elapsed, num_images / max(elapsed, 1e-9)))
+if cache is not None:
+    print(cache.report())
@@ -1,16 +1,16 @@
 from Setup import *
-from ManageData import DataLoader
-from PIL import Image
+from ManageData import DataLoader, Prefetcher, make_writer
+from Monitor import TraceWindow, MetricsWriter, ThroughputMeter, peak_memory
+from collections import OrderedDict
 import Networks
 import time
 import os
 
-# Saves the input and output images
+# Saves the input and output images (they are encoded and written in the background by the writer)
 def save_images(images, title, phase='train'):
     for label, image in images.items():  # .items() extracts the "packages" from the dictionary
-        img_path = os.path.join(opt.img_dir, 'epoch%.3d_%s.png' % (title, label))
-        image_pil = Image.fromarray(image)
-        image_pil.save(img_path)
+        img_path = os.path.join(opt.img_dir, 'epoch%.3d_%s.%s' % (title, label, writer.extension))
+        writer.save(image, img_path)
 
 # Prints the errors of the generator (+ vgg loss) and both discriminators, making it easier to detect model collapse
 def print_errors(epoch, i, errors, t):
@@ -18,42 +18,121 @@ def print_errors(epoch, i, errors, t):
     for k, v in errors.items():  # --> This is to extract from the Ordered Dictionary
         message += '%s: %.3f ' % (k, v)
     print(message)
-    with open(opt.log_name, "a") as log_file:
-        log_file.write('%s\n' % message)
+    log_file.write('%s\n' % message)
+
+# Logs the losses together with the throughput, memory and learning rate since the previous record
+def log_metrics(epoch, i, errors):
+    record = OrderedDict([('epoch', epoch), ('iters', i), ('steps', num_steps), ('time', time.time())])
+    record.update(errors)
+    record.update(throughput.summary())
+    record['peak_process_mb'], record['peak_device_mb'] = peak_memory(opt.device)
+    record['lr'] = the_model.old_lr
+    record['resolution'] = the_model.resolution
+    metrics.write(record)
+
+# Prints the mean time per step (in ms) of every phase of the training step (see --time_phases)
+def print_timings(epoch, i, timings):
+    message = '(epoch: %d, iters: %d, ms/step)' % (epoch, i)
+    for k, v in timings.items():
+        message += ' %s: %.1f' % (k, v)
+    print(message)
+    log_file.write('%s\n' % message)
 
 
 opt = process(TrainingSetup(DefaultSetup())) # Parse the training options that will be used
+is_main = opt.rank == 0  # With --distributed, only the first process logs and saves the images and the checkpoints
 data_loader = DataLoader(opt)
 dataset = data_loader.load() # Load the training dataloader
-print("Number of training images: %d" % len(data_loader))
+if is_main:
+    print("Number of training images: %d" % (len(data_loader) * opt.world_size))
 the_model = Networks.The_Model(opt)
+timer = the_model.timer
+if is_main:
+    writer = make_writer(opt)
+    trace = TraceWindow(opt.profile_steps, opt.save_dir, timer, opt.device) if opt.profile_steps else None
+    log_file = open(opt.log_name, 'a')  # Kept open for the whole run (the lines are written when the buffer fills up)
+    metrics = MetricsWriter(os.path.join(opt.save_dir, 'metrics.' + opt.metrics_format), opt.metrics_flush_secs)
+else:
+    trace = None
+throughput = ThroughputMeter()
 
 total_steps = 0
+num_steps = 0  # The number of training steps (total_steps counts the images)
+start_epoch = 1
+stages = parse_resolution_schedule(opt.resolution_schedule, opt.crop_size)
+if opt.resume:
+    progress = the_model.resume()
+    start_epoch, total_steps, num_steps = progress['epoch'] + 1, progress['total_steps'], progress['num_steps']
+    if is_main:
+        print('Resumed the training after epoch %d' % progress['epoch'])
 
-for epoch in range(1, opt.niter + opt.niter_decay+ 1):
+for epoch in range(start_epoch, opt.niter + opt.niter_decay+ 1):
     epoch_start_time = time.time()
-    for i, data in enumerate(dataset):  # For each call, __get_item__ is called for each image in the current batch. Takes the images, formats it into the desired dictionary format, and this dictionary is then represented by data
+    if stages and resolution_at(stages, epoch, opt.crop_size) != the_model.resolution:
+        size = resolution_at(stages, epoch, opt.crop_size)
+        data_loader.set_size(size)
+        the_model.set_resolution(size)
+        dataset = data_loader.load()
+        if is_main:
+            print('Training at %dx%d from epoch %d' % (size, size, epoch))
+    data_loader.set_epoch(epoch)  # Reshuffles the shards of the processes
+    batches = Prefetcher(dataset, opt.device, augment=True) if opt.prefetch else dataset
+    data_start_time = time.perf_counter()
+    for i, data in enumerate(batches):  # For each call, __get_item__ is called for each image in the current batch. Takes the images, formats it into the desired dictionary format, and this dictionary is then represented by data
+        data_wait = time.perf_counter() - data_start_time  # The time spent waiting for the DataLoader
+        timer.add('data_wait', data_wait)
+        throughput.data(data_wait)
+        if trace is not None:
+            trace.step(num_steps)
+        num_steps += 1
 
         iter_start_time = time.time()
+        step_start_time = time.perf_counter()
         total_steps += opt.batch_size
         epoch_iter = total_steps - len(data_loader) * (epoch - 1)
         the_model.set_input(data) # Insert the new data into the necessary containers to be read from during the forward and backward pass
         the_model.perform_update()
+        if opt.compile and is_main and epoch == start_epoch and i == 0:
+            print('The first step took %.1f sec (including the compilation)' % (time.perf_counter() - step_start_time))
+        throughput.step(time.perf_counter() - step_start_time, data['A'].size(0) * opt.world_size)  # Every process trains on a batch
 
         # Below prints diagnostic information such as time taken per an epoch
-        if total_steps % opt.display_freq == 0:
+        if is_main and total_steps % opt.display_freq == 0:
             save_images(the_model.for_displaying_images(), epoch)
 
-        if total_steps % opt.print_freq == 0:
+        if is_main and total_steps % opt.print_freq == 0:
             exec_time = (time.time() - iter_start_time) / opt.batch_size
-            print_errors(epoch, epoch_iter, the_model.get_model_errors(epoch), exec_time)
+            errors = the_model.get_model_errors(epoch)
+            print_errors(epoch, epoch_iter, errors, exec_time)
+            log_metrics(epoch, epoch_iter, errors)
 
-    if epoch % opt.save_epoch_freq == 0:
-        the_model.save_model(epoch)
+        timings = timer.step()
+        if timings is not None:
+            print_timings(epoch, epoch_iter, timings)
+        data_start_time = time.perf_counter()
 
-    print('End of epoch %d / %d \t Time Taken: %d sec' %
-          (epoch, opt.niter, time.time() - epoch_start_time))
+    if is_main:
+        print('End of epoch %d / %d \t Time Taken: %d sec' %
+              (epoch, opt.niter, time.time() - epoch_start_time))
+        if opt.prefetch:
+            print('Waited %.2f sec for the data (%.1f%% of the epoch)' % (batches.stall_time, 100 * batches.stall_time / max(time.time() - epoch_start_time, 1e-9)))
 
     # Detects when do we start decaying the learning rate (apparently improves results so that "the model does not get trapped in a local minima")
     if(epoch> opt.niter):
-        the_model.update_learning_rate()
+        lr = the_model.update_learning_rate()
+        if is_main:
+            print('learning rate = %.7f' % lr)
+
+    # Saved after the learning rate update, so that a resumed run starts the next epoch with the right learning rate
+    if is_main and epoch % opt.save_epoch_freq == 0:
+        the_model.save_model(epoch, {'epoch': epoch, 'total_steps': total_steps, 'num_steps': num_steps})
+
+if is_main:
+    if trace is not None:
+        trace.stop()  # In case the training ended within the window
+    metrics.close()
+    log_file.close()
+    writer.close()  # Wait until all the images have been written
+    the_model.close()  # And the last checkpoint
+if opt.distributed:
+    torch.distributed.destroy_process_group()